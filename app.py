@@ -3,6 +3,7 @@ from copy import deepcopy
 import gradio as gr
 import mdtex2html
 from model.openlamm import LAMMPEFTModel
+from model.utils.runtime import resolve_dtype
 import torch
 import json
 import openxlab
@@ -26,6 +27,9 @@ os.system('ls -l {}'.format(os.path.join(XLAB_CACHE, '.cache/model', 'LAMM_opena
 os.system('ls -l {}'.format(os.path.join(XLAB_CACHE, '.cache/model', 'LAMM_lamm_7b_lora32_186k', 'pytorch_model.pt')))
 
 # init the model
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+# fp16 on GPU; on CPU-only nodes fp32 unless LAMM_DTYPE=bf16
+dtype = resolve_dtype(os.environ.get('LAMM_DTYPE'), device)
 args = {
     'model': 'openllama_peft',
     'encoder_ckpt_path': os.path.join(XLAB_CACHE, '.cache/model', 'LAMM_openai_clip_vit_14-l', 'ViT-L-14.pt'),
@@ -42,13 +46,27 @@ args = {
     'num_vision_token': 256,
     'encoder_pretrain': 'clip',
     'system_header': True,
+    'llama_dtype': dtype,
+    # int8 / int4 decoder exported with `python -m model.utils.quantization`, used instead of vicuna + LoRA weights
+    'quantized_ckpt_path': os.environ.get('LAMM_QUANTIZED'),
 }
 
-model = LAMMPEFTModel(**args)
-# , map_location=torch.device('cpu')
-delta_ckpt = torch.load(args['delta_ckpt_path'])
-model.load_state_dict(delta_ckpt, strict=False)
-model = model.eval().half().cuda()
+if os.environ.get('LAMM_SNAPSHOT'):
+    # merged weights exported with `python -m model.utils.snapshot`
+    model = LAMMPEFTModel(snapshot_path=os.environ['LAMM_SNAPSHOT'], device=device)
+else:
+    model = LAMMPEFTModel(**args)
+    model.load_delta_checkpoint(args['delta_ckpt_path'])
+if model.llama_streams_layers():
+    # streamed decoder layers are paged into CPU memory and keep their unfused projections
+    device = 'cpu'
+    dtype = resolve_dtype(os.environ.get('LAMM_DTYPE'), device)
+elif not args['quantized_ckpt_path']:
+    model.fuse_llama_projections()
+model = model.to_inference(device=device, dtype=dtype)
+# per-request latency and memory figures, appended to LAMM_METRICS (jsonl) when set
+memory = model.enable_memory_accounting(metrics_path=os.environ.get('LAMM_METRICS'))
+print(memory.format_report())
 print(f'[!] init the 13b model over ...')
 
 """Override Chatbot.postprocess"""
@@ -112,11 +130,12 @@ def re_predict(
     temperature, 
     history, 
     modality_cache, 
+    request: gr.Request = None,
 ):
     # drop the latest query and answers and generate again
     q, a = history.pop()
     chatbot.pop()
-    return predict(q, image_path, chatbot, max_length, top_p, temperature, history, modality_cache)
+    return predict(q, image_path, chatbot, max_length, top_p, temperature, history, modality_cache, request)
 
 
 def predict(
@@ -128,6 +147,7 @@ def predict(
     temperature, 
     history, 
     modality_cache, 
+    request: gr.Request = None,
 ):
     if image_path is None:      # 
         return [(input, "There is no input data provided! Please upload your data and start the conversation.")]
@@ -158,6 +178,8 @@ def predict(
         response = response[0]
     chatbot.append((parse_text(input), parse_text(response)))
     history.append((input, response))
+    memory.update_session(request.session_hash if request is not None else id(history), modality_cache, history)
+    memory.prune_sessions(max_idle_s=3600)
     return chatbot, history, modality_cache
 
 
@@ -167,7 +189,9 @@ def reset_user_input():
 def reset_dialog():
     return [], []
 
-def reset_state():
+def reset_state(request: gr.Request = None):
+    if request is not None:
+        memory.end_session(request.session_hash)
     return None, [], [], []
 
 
@@ -1,16 +1,18 @@
 import hashlib
 import os
+import pickle
 import urllib
 import warnings
+import zipfile
 from typing import Any, Union, List
 from pkg_resources import packaging
 
 import torch
 from PIL import Image
-from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from .model import build_model
+from ..PROCESS.image_transform import VisionPreprocessor
+from .model import build_model, build_visual
 from .simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 try:
@@ -24,7 +26,7 @@ if packaging.version.parse(torch.__version__) < packaging.version.parse("1.7.1")
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
+__all__ = ["available_models", "load", "load_visual", "visual_from_state_dict", "extract_visual", "tokenize"]
 _tokenizer = _Tokenizer()
 
 _MODELS = {
@@ -72,18 +74,9 @@ def _download(url: str, root: str):
     return download_target
 
 
-def _convert_image_to_rgb(image):
-    return image.convert("RGB")
-
-
 def _transform(n_px):
-    return Compose([
-        Resize((n_px, n_px), interpolation=BICUBIC),
-        # CenterCrop(n_px),
-        _convert_image_to_rgb,
-        ToTensor(),
-        Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
-    ])
+    # squash to n_px x n_px (no center crop), decoded and normalized by the shared batched engine
+    return VisionPreprocessor(n_px, resize_mode="squash")
 
 
 def available_models() -> List[str]:
@@ -116,12 +109,7 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     preprocess : Callable[[PIL.Image], torch.Tensor]
         A torchvision transform that converts a PIL image into a tensor that the returned model can take as its input
     """
-    if name in _MODELS:
-        model_path = _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
-    elif os.path.isfile(name):
-        model_path = name
-    else:
-        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+    model_path = _model_path(name, download_root)
 
     with open(model_path, 'rb') as opened_file:
         try:
@@ -194,6 +182,141 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     return model, _transform(model.input_resolution.item())
 
 
+def _model_path(name: str, download_root: str = None):
+    if name in _MODELS:
+        return _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
+    elif os.path.isfile(name):
+        return name
+    raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+
+
+def _is_jit_archive(model_path: str):
+    """TorchScript archives store their code next to the pickled tensors"""
+    if not zipfile.is_zipfile(model_path):
+        return False
+    with zipfile.ZipFile(model_path) as archive:
+        return any(n.endswith("/constants.pkl") or "/code/" in n for n in archive.namelist())
+
+
+class _ScriptObject:
+    """stand-in for the TorchScript classes of a JIT archive, keeps the pickled attributes"""
+
+    def __setstate__(self, state):
+        self.attributes = state
+
+
+class _LazyTensor:
+    """a tensor of a JIT archive whose storage has not been read yet"""
+
+    def __init__(self, storage, storage_offset, size, stride):
+        self.storage, self.storage_offset, self.size, self.stride = storage, storage_offset, size, stride
+
+
+class _ArchiveUnpickler(pickle.Unpickler):
+    """unpickles the module tree of a JIT archive without reading any tensor data"""
+
+    def find_class(self, module, name):
+        if module.startswith("__torch__"):
+            return _ScriptObject
+        if (module, name) == ("torch._utils", "_rebuild_tensor_v2"):
+            return lambda storage, storage_offset, size, stride, *args: _LazyTensor(storage, storage_offset, size, stride)
+        if (module, name) == ("torch._utils", "_rebuild_parameter"):
+            return lambda data, *args: data
+        return super().find_class(module, name)
+
+    def persistent_load(self, saved_id):
+        _, storage_type, key, _, numel = saved_id           # ('storage', storage type, key, location, numel)
+        dtype = torch.uint8 if storage_type is getattr(torch, "UntypedStorage", None) else storage_type.dtype
+        return key, dtype, numel
+
+
+def _read_jit_visual_tensors(model_path: str):
+    """read only the `visual.*` tensors of a JIT archive; torch.jit.load would read and compile the whole model"""
+    with zipfile.ZipFile(model_path) as archive:
+        root = next(n for n in archive.namelist() if n.endswith("/data.pkl"))[:-len("data.pkl")]
+        with archive.open(root + "data.pkl") as f:
+            model = _ArchiveUnpickler(f).load()
+
+        tensors = {}
+
+        def collect(module, prefix):
+            for name, value in module.attributes.items():
+                if isinstance(value, _LazyTensor):
+                    tensors[prefix + name] = value
+                elif isinstance(value, _ScriptObject):
+                    collect(value, prefix + name + ".")
+
+        collect(model.attributes["visual"], "visual.")
+        storages, state_dict = {}, {}
+        for name, tensor in tensors.items():
+            key, dtype, _ = tensor.storage
+            if key not in storages:
+                data = bytearray(archive.read(f"{root}data/{key}"))
+                storages[key] = torch.frombuffer(data, dtype=dtype) if data else torch.empty(0, dtype=dtype)
+            state_dict[name] = storages[key].as_strided(tensor.size, tensor.stride, tensor.storage_offset).clone()
+    return state_dict
+
+
+def _load_visual_state_dict(model_path: str):
+    """read the `visual.*` tensors of a JIT archive or a (visual-only) state dict checkpoint"""
+    if _is_jit_archive(model_path):
+        return _read_jit_visual_tensors(model_path)
+    try:
+        # memory-map the checkpoint so that only the visual tensors are read from disk
+        state_dict = torch.load(model_path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        state_dict = torch.load(model_path, map_location="cpu")
+    return {k: v for k, v in state_dict.items() if k.startswith("visual.")}
+
+
+def load_visual(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", dtype: torch.dtype = None, download_root: str = None):
+    """Load only the image encoder of a CLIP model, skipping the text tower
+
+    Parameters
+    ----------
+    name : str
+        A model name listed by `clip.available_models()`, the path to a CLIP checkpoint, or a visual-only checkpoint written by `extract_visual`
+
+    device : Union[str, torch.device]
+        The device to put the loaded model
+
+    dtype : torch.dtype
+        The dtype of the encoder weights, by default float16 on GPU and float32 on CPU
+
+    Returns
+    -------
+    visual : torch.nn.Module
+        The CLIP image encoder
+
+    preprocess : Callable[[PIL.Image], torch.Tensor]
+        A transform that converts a PIL image into a tensor that the returned model can take as its input
+    """
+    model_path = _model_path(name, download_root)
+    if dtype is None:
+        dtype = torch.float32 if str(device) == "cpu" else torch.float16
+
+    state_dict = _load_visual_state_dict(model_path)
+    if "visual.proj" not in state_dict:
+        # ResNet image encoders are built with the full model
+        model, preprocess = load(model_path, device=device)
+        return model.visual.to(dtype), preprocess
+
+    return visual_from_state_dict(state_dict, device=device, dtype=dtype)
+
+
+def visual_from_state_dict(state_dict: dict, device: Union[str, torch.device] = "cpu", dtype: torch.dtype = torch.float16):
+    """Build the ViT image encoder and its preprocess from `visual.*` tensors, e.g. of an inference snapshot"""
+    visual = build_visual(state_dict, dtype=dtype, device=device)
+    return visual, _transform(visual.input_resolution)
+
+
+def extract_visual(name: str, output_path: str, dtype: torch.dtype = torch.float16, download_root: str = None):
+    """Save the `visual.*` tensors of a CLIP checkpoint, so that `load_visual` reads only the image encoder at startup"""
+    state_dict = _load_visual_state_dict(_model_path(name, download_root))
+    torch.save({k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}, output_path)
+    return output_path
+
+
 def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> Union[torch.IntTensor, torch.LongTensor]:
     """
     Returns the tokenized representation of given input string(s)
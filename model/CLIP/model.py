@@ -6,6 +6,8 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
+from .tome import bipartite_soft_matching, merge_schedule, merge_wavg, unmerge
+
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -158,6 +160,11 @@ class LayerNorm(nn.LayerNorm):
     """Subclass torch's LayerNorm to handle fp16."""
 
     def forward(self, x: torch.Tensor):
+        if x.dtype == torch.float16 and x.device.type == "cpu":
+            # no fp16 layer norm kernel on CPU, normalize in fp32
+            weight = self.weight.float() if self.weight is not None else None
+            bias = self.bias.float() if self.bias is not None else None
+            return F.layer_norm(x.float(), self.normalized_shape, weight, bias, self.eps).to(x.dtype)
         # orig_type = x.dtype
         ret = super().forward(x)        # .type(torch.float16))        # Warning: Originally avoid fp32 in clip
         return ret                      # .type(orig_type)
@@ -183,14 +190,77 @@ class ResidualAttentionBlock(nn.Module):
         self.attn_mask = attn_mask
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
+        if self.attn_mask is not None and (self.attn_mask.dtype != x.dtype or self.attn_mask.device != x.device):
+            self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device)     # cast once, not on every call
         return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, batch_first: bool = False, size: torch.Tensor = None, r: int = None):
+        """L x N x D inputs by default, N x L x D with `batch_first`, merging r tokens (ToMe) when `size` is given
+
+        every path is dispatched here so that module hooks (e.g. utils/profiling.py) see it
+        """
+        if size is not None:
+            return self.forward_merging(x, size, r)
+        if batch_first:
+            return self.forward_batch_first(x)
         x = x + self.attention(self.ln_1(x))
         x = x + self.mlp(self.ln_2(x))
         return x
 
+    def attention_batch_first(self, x: torch.Tensor, attn_bias: torch.Tensor = None, return_keys: bool = False):
+        """batch-first attention with one packed qkv projection and fused scaled dot product attention when available
+
+        :param tensor x: N x L x D
+        :param tensor attn_bias: additive bias broadcastable to N x heads x L x L
+        :return tensor (, tensor): attention output (N x L x D) (, mean key over heads, N x L x D/heads)
+        """
+        bsz, seq_len, width = x.shape
+        num_heads = self.attn.num_heads
+        head_dim = width // num_heads
+        qkv = F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias)
+        q, k, v = qkv.reshape(bsz, seq_len, 3, num_heads, head_dim).permute(2, 0, 3, 1, 4)       # N x H x L x d
+        if self.attn_mask is not None:
+            if self.attn_mask.dtype != x.dtype or self.attn_mask.device != x.device:
+                self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device)
+            attn_bias = self.attn_mask if attn_bias is None else attn_bias + self.attn_mask
+        if hasattr(F, 'scaled_dot_product_attention'):
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+        else:
+            attn = (q * head_dim ** -0.5) @ k.transpose(-2, -1)
+            if attn_bias is not None:
+                attn = attn + attn_bias
+            x = attn.softmax(dim=-1) @ v
+        x = x.transpose(1, 2).reshape(bsz, seq_len, width)
+        x = F.linear(x, self.attn.out_proj.weight, self.attn.out_proj.bias)
+        if return_keys:
+            return x, k.mean(1)
+        return x
+
+    def forward_batch_first(self, x: torch.Tensor):
+        x = x + self.attention_batch_first(self.ln_1(x))
+        x = x + self.mlp(self.ln_2(x))
+        return x
+
+    def attention_sized(self, x: torch.Tensor, size: torch.Tensor):
+        """batch-first attention with proportional attention for merged tokens (log size added to the logits)
+
+        :return tensor, tensor: attention output (N x L x D), mean key over heads as merging metric (N x L x D/heads)
+        """
+        return self.attention_batch_first(x, size.log()[:, None, None, :, 0].to(x.dtype), return_keys=True)
+
+    def forward_merging(self, x: torch.Tensor, size: torch.Tensor, r: int):
+        """batch-first forward that merges r tokens between attention and mlp (ToMe)
+
+        :return tensor, tensor, tensor: tokens, token sizes, new position of every input token (None if not merged)
+        """
+        x_attn, metric = self.attention_sized(self.ln_1(x), size)
+        x = x + x_attn
+        merge, new_pos = bipartite_soft_matching(metric, r)
+        if merge is not None:
+            x, size = merge_wavg(merge, x, size)
+        x = x + self.mlp(self.ln_2(x))
+        return x, size, new_pos
+
 
 class Transformer(nn.Module):
     def __init__(self, width: int, layers: int, heads: int, attn_mask: torch.Tensor = None):
@@ -199,8 +269,38 @@ class Transformer(nn.Module):
         self.layers = layers
         self.resblocks = nn.Sequential(*[ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
 
-    def forward(self, x: torch.Tensor):
-        return self.resblocks(x)
+    def forward(self, x: torch.Tensor, start: int = 0, end: int = None):
+        """run blocks [start, end), all blocks by default"""
+        if start == 0 and end is None:
+            return self.resblocks(x)
+        return self.resblocks[start:end](x)
+
+    def forward_batch_first(self, x: torch.Tensor, start: int = 0, end: int = None):
+        """run blocks [start, end) on N x L x D inputs"""
+        for block in self.resblocks[start:end]:
+            x = block(x, True)
+        return x
+
+    def forward_merging(self, x: torch.Tensor, ratio: float, start: int = 0, end: int = None, size: torch.Tensor = None, source: torch.Tensor = None):
+        """batch-first forward of blocks [start, end) with token merging
+
+        :param tensor x: N x L' x D, L' tokens left after merging in the previous blocks
+        :param float ratio: fraction of the patch tokens removed by the last layer
+        :param tensor size: N x L' x 1, number of original tokens in every token; None when starting from the first block
+        :param tensor source: N x L, current position of every original token; None when starting from the first block
+        :return tensor, tensor, tensor: merged tokens, sizes and source positions, see `unmerge`
+        """
+        if source is None:
+            bsz, seq_len, _ = x.shape
+            size = torch.ones(bsz, seq_len, 1, dtype=x.dtype, device=x.device)
+            source = torch.arange(seq_len, device=x.device).expand(bsz, -1)
+        schedule = merge_schedule(source.shape[1], self.layers, ratio)
+        end = self.layers if end is None else end
+        for idx in range(start, end):
+            x, size, new_pos = self.resblocks[idx](x, True, size, schedule[idx])
+            if new_pos is not None:
+                source = new_pos.gather(1, source)
+        return x, size, source
 
 
 class VisionTransformer(nn.Module):
@@ -219,38 +319,107 @@ class VisionTransformer(nn.Module):
 
         self.ln_post = LayerNorm(width)
         self.proj = nn.Parameter(scale * torch.randn(width, output_dim))
-
-    def forward(self, x: torch.Tensor):
+        self.tome_ratio = 0
+        self.fast_path = False
+
+    def set_fast_path(self, enabled: bool = True):
+        """batch-first blocks with fused attention and a matmul patch embedding; same weights as the default path"""
+        self.fast_path = enabled
+
+    def set_token_merging(self, ratio: float):
+        """merge `ratio` of the patch tokens over the transformer (ToMe); 0 disables merging"""
+        assert 0 <= ratio < 1, f'Token merging ratio should be in [0, 1), got {ratio}'
+        self.tome_ratio = ratio
+
+    def patch_embed(self, x: torch.Tensor):
+        """conv1 as unfold + matmul, directly in NLD layout"""
+        bsz, channels, height, width = x.shape
+        patch_size = self.conv1.kernel_size[0]
+        grid_h, grid_w = height // patch_size, width // patch_size
+        x = x[:, :, :grid_h * patch_size, :grid_w * patch_size]
+        x = x.reshape(bsz, channels, grid_h, patch_size, grid_w, patch_size)
+        x = x.permute(0, 2, 4, 1, 3, 5).reshape(bsz, grid_h * grid_w, channels * patch_size * patch_size)  # shape = [*, grid ** 2, 3 * patch ** 2]
+        return x @ self.conv1.weight.reshape(self.conv1.out_channels, -1).t()  # shape = [*, grid ** 2, width]
+
+    def embed(self, x: torch.Tensor):
+        if self.fast_path:
+            x = self.patch_embed(x)  # shape = [*, grid ** 2, width]
+            x = torch.cat([self.class_embedding.to(x.dtype).expand(x.shape[0], 1, -1), x], dim=1)  # shape = [*, grid ** 2 + 1, width]
+            x = x + self.positional_embedding.to(x.dtype)
+            return self.ln_pre(x)
         x = self.conv1(x)  # shape = [*, width, grid, grid]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
         x = torch.cat([self.class_embedding.to(x.dtype) + torch.zeros(x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device), x], dim=1)  # shape = [*, grid ** 2 + 1, width]
         x = x + self.positional_embedding.to(x.dtype)
         x = self.ln_pre(x)
+        return x
 
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
-        x = x.permute(1, 0, 2)  # LND -> NLD
+    def num_feature_blocks(self, feature_layer: int):
+        """number of blocks to run for the output of `feature_layer`: -1 for the last block, -2 for the penultimate, k > 0 for block k"""
+        num_blocks = self.transformer.layers + 1 + feature_layer if feature_layer < 0 else feature_layer
+        assert 1 <= num_blocks <= self.transformer.layers, f'Vision feature layer {feature_layer} out of range'
+        return num_blocks
+
+    def forward_features(self, x: torch.Tensor, feature_layer: int = -1, return_global: bool = False, return_local: bool = True):
+        """run the transformer only as deep as needed
+
+        patch features are taken after `feature_layer`; the remaining blocks, ln_post and proj only run for the global feature
+
+        :return tensor or (tensor, tensor): global feature (N x output_dim) and / or patch features (N x grid ** 2 x width)
+        """
+        num_blocks = self.num_feature_blocks(feature_layer) if return_local else self.transformer.layers
+        x = self.embed(x)
+
+        if self.tome_ratio > 0:
+            x, size, source = self.transformer.forward_merging(x, self.tome_ratio, 0, num_blocks)
+            local = unmerge(x, source)[:, 1:, :] if return_local else None
+            if return_global:
+                x, _, _ = self.transformer.forward_merging(x, self.tome_ratio, num_blocks, None, size, source)
+                x = x[:, 0, :]                          # the class token is never merged and stays first
+        elif self.fast_path:
+            x = self.transformer.forward_batch_first(x, 0, num_blocks)
+            local = x[:, 1:, :] if return_local else None
+            if return_global:
+                x = self.transformer.forward_batch_first(x, num_blocks)[:, 0, :]
+        else:
+            x = x.permute(1, 0, 2)  # NLD -> LND
+            x = self.transformer(x, 0, num_blocks)
+            local = x[1:].permute(1, 0, 2) if return_local else None    # LND -> NLD
+            if return_global:
+                x = self.transformer(x, num_blocks)
+                x = x[0]
 
-        x = self.ln_post(x[:, 0, :])
+        if not return_global:
+            return local
 
+        x = self.ln_post(x)
         if self.proj is not None:
             x = x @ self.proj
 
-        return x
+        if not return_local:
+            return x
+        return x, local
 
-    def forward_patch_features(self, x: torch.Tensor):
-        x = self.conv1(x)  # shape = [*, width, grid, grid]
-        x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
-        x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
-        x = torch.cat([self.class_embedding.to(x.dtype) + torch.zeros(x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device), x], dim=1)  # shape = [*, grid ** 2 + 1, width]
-        x = x + self.positional_embedding.to(x.dtype)
-        x = self.ln_pre(x)
+    def forward(self, x: torch.Tensor, feature_layer: int = -1, return_global: bool = True, return_local: bool = False):
+        return self.forward_features(x, feature_layer, return_global, return_local)
+
+    def forward_patch_features(self, x: torch.Tensor, feature_layer: int = -1):
+        # through __call__ so that module hooks (e.g. utils/profiling.py) see it
+        return self(x, feature_layer, False, True)
 
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
-        x = x.permute(1, 0, 2)  # LND -> NLD
-        return x[:, 1:, :]
+
+@torch.no_grad()
+def compare_fast_path(visual: VisionTransformer, images: torch.Tensor, feature_layer: int = -1):
+    """max absolute difference between the fast and the default encoder outputs (global, local)"""
+    fast_path = visual.fast_path
+    outputs = []
+    for enabled in [False, True]:
+        visual.set_fast_path(enabled)
+        outputs.append(visual.forward_features(images, feature_layer, return_global=True))
+    visual.set_fast_path(fast_path)
+    (global_ref, local_ref), (global_fast, local_fast) = outputs
+    return (global_fast - global_ref).abs().max().item(), (local_fast - local_ref).abs().max().item()
 
 
 class CLIP(nn.Module):
@@ -446,4 +615,30 @@ def build_model(state_dict: dict):
 
     convert_weights(model)
     model.load_state_dict(state_dict)
-    return model.eval()
\ No newline at end of file
+    return model.eval()
+
+def build_visual(state_dict: dict, dtype: torch.dtype = torch.float16, device: Union[str, torch.device] = "cpu"):
+    """Build only the ViT image encoder from `visual.*` weights, allocated directly in `dtype` on `device`"""
+    vision_width = state_dict["visual.conv1.weight"].shape[0]
+    vision_layers = len([k for k in state_dict.keys() if k.startswith("visual.") and k.endswith(".attn.in_proj_weight")])
+    vision_patch_size = state_dict["visual.conv1.weight"].shape[-1]
+    grid_size = round((state_dict["visual.positional_embedding"].shape[0] - 1) ** 0.5)
+    kwargs = dict(
+        input_resolution=vision_patch_size * grid_size,
+        patch_size=vision_patch_size,
+        width=vision_width,
+        layers=vision_layers,
+        heads=vision_width // 64,
+        output_dim=state_dict["visual.proj"].shape[1],
+    )
+
+    if hasattr(nn.Module, "to_empty") and hasattr(torch.device, "__enter__"):
+        # skip the random init: build on the meta device, then allocate uninitialized storage in the target dtype
+        with torch.device("meta"):
+            visual = VisionTransformer(**kwargs)
+        visual = visual.to(dtype).to_empty(device=device)
+    else:
+        visual = VisionTransformer(**kwargs).to(device=device, dtype=dtype)
+
+    visual.load_state_dict({k[len("visual."):]: v for k, v in state_dict.items() if k.startswith("visual.")})
+    return visual.eval()
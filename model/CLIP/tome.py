@@ -0,0 +1,116 @@
+# Token Merging (ToMe) for the CLIP ViT, based on https://github.com/facebookresearch/ToMe
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+def bipartite_soft_matching(metric: torch.Tensor, r: int, class_token: bool = True):
+    """
+    Split tokens into two alternating sets, and merge the r most similar tokens of set A into set B.
+
+    :param tensor metric: bsz x tokens x c, similarity metric of the tokens (mean attention keys)
+    :param int r: number of tokens to remove
+    :param bool class_token: protect the first token from merging
+    :return callable, tensor: merge function on bsz x tokens x c tensors, new position of every token (bsz x tokens)
+    """
+    bsz, t, _ = metric.shape
+    protected = int(class_token)
+    r = min(r, (t - protected) // 2)
+    if r <= 0:
+        return None, None
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)                        # bsz x ta x tb
+        if class_token:
+            scores[..., 0, :] = -math.inf
+
+        node_max, node_idx = scores.max(dim=-1)                 # bsz x ta
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]                          # unmerged tokens of A
+        src_idx = edge_idx[..., :r, :]                          # merged tokens of A
+        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
+        if class_token:
+            unm_idx = unm_idx.sort(dim=1)[0]                    # keep the class token first
+
+        # new position of every current token: [unmerged A, B]
+        ta, tb = a.shape[1], b.shape[1]
+        num_unm = ta - r
+        new_pos = torch.empty(bsz, t, dtype=torch.long, device=metric.device)
+        arange_unm = torch.arange(num_unm, device=metric.device).expand(bsz, -1)
+        new_pos.scatter_(1, 2 * unm_idx[..., 0], arange_unm)
+        new_pos.scatter_(1, 2 * src_idx[..., 0], num_unm + dst_idx[..., 0])
+        new_pos[:, 1::2] = num_unm + torch.arange(tb, device=metric.device)
+
+    def merge(x: torch.Tensor, mode="sum") -> torch.Tensor:
+        src, dst = x[..., ::2, :], x[..., 1::2, :]
+        n, t1, c = src.shape
+        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge, new_pos
+
+
+def merge_wavg(merge, x: torch.Tensor, size: torch.Tensor):
+    """
+    Merge tokens with a weighted average by their size.
+
+    :param tensor x: bsz x tokens x c
+    :param tensor size: bsz x tokens x 1, number of original patches in every token
+    :return tensor, tensor: merged tokens, merged sizes
+    """
+    x = merge(x * size, mode="sum")
+    size = merge(size, mode="sum")
+    return x / size, size
+
+
+def merge_schedule(num_tokens: int, layers: int, ratio: float):
+    """constant number of tokens merged per layer, removing `ratio` of the patch tokens in total"""
+    if ratio <= 0:
+        return [0] * layers
+    r = int(round(ratio * (num_tokens - 1) / layers))
+    return [r] * layers
+
+
+def unmerge(x: torch.Tensor, source: torch.Tensor):
+    """map merged tokens back to the original token positions (bsz x tokens x c)"""
+    return x.gather(1, source.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
+
+@torch.no_grad()
+def tome_report(visual, images: torch.Tensor, ratios=(0.25, 0.5, 0.75), repeats: int = 3):
+    """
+    Measure the encode speedup and the patch feature drift of token merging.
+
+    :param VisionTransformer visual: vision encoder
+    :param tensor images: bsz x 3 x H x W preprocessed images
+    :return list: one dict per ratio with encode time, speedup and cosine similarity to the unmerged features
+    """
+    original_ratio = visual.tome_ratio
+
+    def run(ratio):
+        visual.set_token_merging(ratio)
+        features = visual.forward_patch_features(images)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            visual.forward_patch_features(images)
+        return features, (time.perf_counter() - start) / repeats
+
+    base_features, base_time = run(0)
+    report = [{'ratio': 0, 'encode_time': base_time, 'speedup': 1.0, 'cosine_similarity': 1.0}]
+    for ratio in ratios:
+        features, encode_time = run(ratio)
+        similarity = F.cosine_similarity(features.float(), base_features.float(), dim=-1).mean().item()
+        report.append({
+            'ratio': ratio,
+            'encode_time': encode_time,
+            'speedup': base_time / encode_time,
+            'cosine_similarity': similarity,
+        })
+    visual.set_token_merging(original_ratio)
+    return report
@@ -5,10 +5,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-import io
-import os
 import math
-import requests
 
 import torch
 import torch.nn as nn
@@ -17,6 +14,8 @@ import logging
 
 # from .ImageBind.models.multimodal_preprocessors import SimpleTokenizer
 from .multimodal_preprocessors import SimpleTokenizer
+from .pipeline import ImagePipeline
+from .image_transform import VisionPreprocessor
 from PIL import Image
 # from pytorchvideo import transforms as pv_transforms
 # from pytorchvideo.data.clip_sampling import ConstantClipsPerVideoSampler
@@ -80,60 +79,27 @@ def get_clip_timepoints(clip_sampler, duration):
     return all_clips_timepoints
 
 
+VISION_TRANSFORM = VisionPreprocessor(224, resize_mode="shorter")
+
+_vision_pipeline = None
+
+
+def get_vision_pipeline():
+    global _vision_pipeline
+    if _vision_pipeline is None:
+        _vision_pipeline = ImagePipeline(VISION_TRANSFORM)
+    return _vision_pipeline
+
+
 def load_and_transform_vision_data(image_paths, device, client=None):
     if image_paths is None:
         return None
+    return get_vision_pipeline().load(image_paths, device, client=client)
 
-    image_ouputs = []
-    for image_path in image_paths:
-        data_transform = transforms.Compose(
-            [
-                transforms.Resize(
-                    224, interpolation=transforms.InterpolationMode.BICUBIC
-                ),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=(0.48145466, 0.4578275, 0.40821073),
-                    std=(0.26862954, 0.26130258, 0.27577711),
-                ),
-            ]
-        )
-        if os.path.exists(image_path):
-            with open(image_path, "rb") as fopen:
-                image = Image.open(fopen).convert("RGB")
-        elif image_path.startswith("s3://") and client is not None:
-            image = Image.open(io.BytesIO(client.get(image_path))).convert("RGB")
-        elif image_path.startswith("http"):
-            image = Image.open(requests.get(image_path, stream=True).raw).convert(
-                "RGB"
-            )
-        else:
-            raise ValueError(f"Invalid image path: {image_path}")
-
-        image = data_transform(image).to(device)
-        image_ouputs.append(image)
-    return torch.stack(image_ouputs, dim=0)
 
 def transform_vision_data(images, device):
-    image_ouputs = []
-    for img in images:
-        data_transform = transforms.Compose(
-            [
-                transforms.Resize(
-                    224, interpolation=transforms.InterpolationMode.BICUBIC
-                ),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=(0.48145466, 0.4578275, 0.40821073),
-                    std=(0.26862954, 0.26130258, 0.27577711),
-                ),
-            ]
-        )
-        image = data_transform(img).to(device)
-        image_ouputs.append(image)
-    return torch.stack(image_ouputs, dim=0)
+    image_ouputs = [VISION_TRANSFORM.to_tensor(img) for img in images]
+    return VISION_TRANSFORM.batch(image_ouputs).to(device)
 
 
 def load_and_transform_thermal_data(thermal_paths, device):
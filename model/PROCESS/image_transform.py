@@ -0,0 +1,148 @@
+import io
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision import transforms
+
+from .pipeline import open_image
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class VisionPreprocessor:
+    """
+    Image preprocessing engine shared by the CLIP and ImageBind-style paths.
+
+    Images are decoded to uint8 at reduced resolution when possible (JPEG DCT
+    scaling through PIL `draft()`), then a whole batch is resized, center
+    cropped and normalized with tensor ops. Images of the same size share one
+    `interpolate` call.
+
+    Args:
+        n_px (int): output resolution.
+        resize_mode (str): "squash" resizes both sides to `n_px` (CLIP `_transform`),
+            "shorter" resizes the shorter side to `n_px` and center crops
+            (`data.transform_vision_data`).
+        draft_factor (float): JPEGs are decoded at the smallest DCT scale whose
+            shorter side is at least `draft_factor * n_px`; 0 disables reduced decode.
+    """
+
+    def __init__(self, n_px=224, resize_mode="shorter", draft_factor=2.0, mean=CLIP_MEAN, std=CLIP_STD):
+        assert resize_mode in ["squash", "shorter"], f"Resize mode {resize_mode} not supported"
+        self.n_px = n_px
+        self.resize_mode = resize_mode
+        self.draft_factor = draft_factor
+        std = torch.tensor(std).view(1, 3, 1, 1)
+        # (x / 255 - mean) / std == x * scale - shift
+        self.scale = 1.0 / (255.0 * std)
+        self.shift = torch.tensor(mean).view(1, 3, 1, 1) / std
+
+    def draft(self, image):
+        """Ask the JPEG decoder for a reduced scale that keeps the shorter side above the draft size."""
+        if not self.draft_factor or image.format != "JPEG":
+            return image
+        min_size = self.n_px * self.draft_factor
+        width, height = image.size
+        ratio = min_size / min(width, height)
+        if ratio < 1:
+            image.draft("RGB", (math.ceil(width * ratio), math.ceil(height * ratio)))
+        return image
+
+    def to_tensor(self, image):
+        """PIL image -> 3 x H x W uint8 tensor"""
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+
+    def decode(self, image_path, client=None):
+        """Open, draft-decode and convert one image; safe to run on worker threads"""
+        return self.to_tensor(open_image(image_path, client, prepare=self.draft))
+
+    def decode_bytes(self, data):
+        """Draft-decode and convert one encoded image held in memory, e.g. a tar shard member"""
+        return self.to_tensor(self.draft(Image.open(io.BytesIO(data))))
+
+    def resize_size(self, height, width):
+        if self.resize_mode == "squash":
+            return self.n_px, self.n_px
+        # same rounding as torchvision Resize(int)
+        if height <= width:
+            return self.n_px, int(self.n_px * width / height)
+        return int(self.n_px * height / width), self.n_px
+
+    def batch(self, images):
+        """
+        Resize, crop and normalize a batch of images.
+        Args:
+            images (list): 3 x H x W uint8 tensors, sizes may differ.
+        Returns:
+            images (tensor): B x 3 x n_px x n_px normalized float images.
+        """
+        outputs = torch.empty(len(images), 3, self.n_px, self.n_px)
+        buckets = {}
+        for idx, image in enumerate(images):
+            buckets.setdefault(tuple(image.shape[-2:]), []).append(idx)
+        for (height, width), indices in buckets.items():
+            x = torch.stack([images[idx] for idx in indices]).float()         # b x 3 x H x W
+            new_height, new_width = self.resize_size(height, width)
+            if (new_height, new_width) != (height, width):
+                x = F.interpolate(x, size=(new_height, new_width), mode="bicubic", align_corners=False, antialias=True)
+            top = int(round((new_height - self.n_px) / 2.0))
+            left = int(round((new_width - self.n_px) / 2.0))
+            outputs[indices] = x[:, :, top:top + self.n_px, left:left + self.n_px]
+        # round like the uint8 PIL resize, then normalize the whole batch at once
+        outputs = outputs.round_().clamp_(0, 255)
+        return outputs.mul_(self.scale).sub_(self.shift)
+
+    def __call__(self, image):
+        """PIL image -> 3 x n_px x n_px tensor, a drop-in for the torchvision transforms"""
+        return self.batch([self.to_tensor(image)])[0]
+
+
+def legacy_transform(n_px=224, resize_mode="shorter"):
+    """The per-image torchvision transforms replaced by VisionPreprocessor, kept for parity checks"""
+    if resize_mode == "squash":
+        resize = [transforms.Resize((n_px, n_px), interpolation=transforms.InterpolationMode.BICUBIC)]
+    else:
+        resize = [
+            transforms.Resize(n_px, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.CenterCrop(n_px),
+        ]
+    return transforms.Compose(
+        resize + [
+            transforms.ToTensor(),
+            transforms.Normalize(mean=CLIP_MEAN, std=CLIP_STD),
+        ]
+    )
+
+
+def check_parity(images, n_px=224, resize_mode="shorter"):
+    """
+    Compare VisionPreprocessor against the legacy torchvision transforms.
+    Args:
+        images (list): PIL images (or paths) to compare on.
+    Returns:
+        report (dict): max / mean absolute difference of the normalized outputs,
+            for full decode and for reduced (draft) decode.
+    """
+    engine = VisionPreprocessor(n_px, resize_mode, draft_factor=0)
+    draft_engine = VisionPreprocessor(n_px, resize_mode)
+    reference = legacy_transform(n_px, resize_mode)
+    report = {}
+    for name, preprocessor in [("full", engine), ("draft", draft_engine)]:
+        diffs = []
+        for image in images:
+            if isinstance(image, str):
+                expected = reference(open_image(image))
+                actual = preprocessor.batch([preprocessor.decode(image)])[0]
+            else:
+                expected = reference(image.convert("RGB"))
+                actual = preprocessor(image)
+            diffs.append((actual - expected).abs())
+        diffs = torch.stack(diffs)
+        report[name] = {"max_abs_diff": diffs.max().item(), "mean_abs_diff": diffs.mean().item()}
+    return report
@@ -0,0 +1,123 @@
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+from ..utils.storage import get_default_storage
+
+
+class ImageLoadError(ValueError):
+    """Raised when an image path can not be opened or decoded."""
+
+
+def open_image(image_path, client=None, prepare=None):
+    """
+    Open and decode one image as RGB.
+    Args:
+        image_path (str): local path, s3:// path or http(s) url.
+        client: optional storage client with a `get(path)` method returning bytes,
+            e.g. utils.storage.Storage; remote paths default to a shared pooled
+            http(s) storage.
+        prepare (callable): optional hook called on the opened image before it is
+            decoded, e.g. to request a reduced-scale JPEG decode with `draft()`.
+    Returns:
+        image (PIL.Image): the decoded RGB image.
+    Raises:
+        ImageLoadError: the path is not supported or the image can not be decoded.
+    """
+    try:
+        if os.path.exists(image_path):
+            image = Image.open(image_path)
+        elif image_path.startswith(("s3://", "http://", "https://")):
+            storage = client if client is not None else get_default_storage()
+            image = Image.open(io.BytesIO(storage.get(image_path)))
+        else:
+            raise ImageLoadError(f"Invalid image path: {image_path}")
+        if prepare is not None:
+            image = prepare(image)
+        image = image.convert("RGB")
+    except ImageLoadError:
+        raise
+    except Exception as e:
+        raise ImageLoadError(f"Can not load image {image_path}: {e}") from e
+    return image
+
+
+class ImagePipeline:
+    """
+    Decode and preprocess images on a thread pool. PIL releases the GIL while
+    decoding and resizing, so the workers run in parallel with each other and
+    with the vision encoder on the calling thread.
+
+    `transform` is either a per-image callable (PIL image -> tensor), or a
+    batched engine with `decode(path, client)` run per image on the decode
+    workers and `batch(decoded)` run once per batch, like VisionPreprocessor.
+    """
+
+    def __init__(self, transform, num_workers=8):
+        self.transform = transform
+        self.num_workers = num_workers
+        self.batched = hasattr(transform, "decode") and hasattr(transform, "batch")
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="image-decode")
+        # batches are assembled on a separate thread so the decode workers never wait on each other
+        self.batch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-batch")
+
+    def load_one(self, image_path, client=None):
+        if self.batched:
+            return self.transform.decode(image_path, client)
+        return self.transform(open_image(image_path, client))  # 3 x H x W
+
+    def assemble(self, futures):
+        images = [future.result() for future in futures]
+        if self.batched:
+            return self.transform.batch(images)
+        return torch.stack(images, dim=0)  # B x 3 x H x W
+
+    def submit(self, image_paths, client=None):
+        futures = [self.executor.submit(self.load_one, image_path, client) for image_path in image_paths]
+        return self.batch_executor.submit(self.assemble, futures)
+
+    @staticmethod
+    def collect(future, device=None):
+        images = future.result()
+        return images.to(device) if device is not None else images
+
+    def load(self, image_paths, device=None, client=None):
+        """
+        Load one batch of images.
+        Args:
+            image_paths (list): image paths of the batch.
+            device: device to move the batch to.
+            client: optional storage client for remote paths.
+        Returns:
+            images (tensor): B x 3 x H x W preprocessed images.
+        """
+        return self.collect(self.submit(image_paths, client), device)
+
+    def prefetch(self, batches, device=None, client=None, max_prefetch=2):
+        """
+        Iterate over batches of image paths, decoding up to `max_prefetch` batches
+        ahead of the one being consumed, e.g. batch N+1 is decoded while batch N
+        runs through the vision encoder.
+        Args:
+            batches (iterable): lists of image paths.
+            max_prefetch (int): number of batches decoded ahead of the consumer.
+        Yields:
+            (image_paths, images): the paths and B x 3 x H x W images of each batch.
+        """
+        pending = deque()
+        for image_paths in batches:
+            pending.append((image_paths, self.submit(image_paths, client)))
+            if len(pending) > max_prefetch:
+                image_paths, future = pending.popleft()
+                yield image_paths, self.collect(future, device)
+        while pending:
+            image_paths, future = pending.popleft()
+            yield image_paths, self.collect(future, device)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.batch_executor.shutdown(wait=False)
@@ -1,7 +1,9 @@
 # This script is based on https://github.com/huggingface/transformers/blob/main/src/transformers/models/llama/modeling_llama.py
 
 """ PyTorch LLaMA model."""
+import json
 import math
+import os
 from typing import List, Optional, Tuple, Union
 
 import torch
@@ -54,6 +56,15 @@ def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int]
     return inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(dtype).min)
 
 
+def _expand_segment_mask(segment_ids: torch.Tensor, dtype: torch.dtype):
+    """
+    Expands the segment ids of packed sequences `[bsz, seq_len]` to `[bsz, 1, seq_len, seq_len]`: tokens attend only
+    to tokens of their own segment (padding, segment 0, only to padding).
+    """
+    same_segment = segment_ids[:, None, :, None] == segment_ids[:, None, None, :]
+    return torch.zeros(same_segment.shape, dtype=dtype, device=segment_ids.device).masked_fill(~same_segment, torch.finfo(dtype).min)
+
+
 class LlamaRMSNorm(nn.Module):
     def __init__(self, hidden_size, eps=1e-6):
         """
@@ -62,6 +73,8 @@ class LlamaRMSNorm(nn.Module):
         super().__init__()
         self.weight = nn.Parameter(torch.ones(hidden_size))
         self.variance_epsilon = eps
+        # False once the weight is folded into the following projection, see `fold_weight`
+        self.elementwise_affine = True
 
     def forward(self, hidden_states):
         variance = hidden_states.to(torch.float32).pow(2).mean(-1, keepdim=True)
@@ -71,35 +84,85 @@ class LlamaRMSNorm(nn.Module):
         if self.weight.dtype in [torch.float16, torch.bfloat16]:
             hidden_states = hidden_states.to(self.weight.dtype)
 
+        if not self.elementwise_affine:
+            return hidden_states
         return self.weight * hidden_states
 
+    @torch.no_grad()
+    def fold_weight(self):
+        """
+        Hand the norm weight over to the projection that consumes the output: W @ (g * x) == (W * g) @ x.
+        Returns the fp32 weight to scale the input columns of that projection with.
+        """
+        weight = self.weight.float().clone()
+        self.weight.fill_(1.0)
+        self.elementwise_affine = False
+        return weight
+
+
+def merged_linear_weight(linear: nn.Module) -> torch.Tensor:
+    """
+    Weight of a projection with its LoRA delta applied, (out_features, in_features).
+    Unmerged peft LoRA layers are merged in place first, so they skip the low-rank side path afterwards.
+    """
+    if hasattr(linear, "lora_A") and hasattr(linear, "merge") and not getattr(linear, "disable_adapters", False):
+        if not linear.merged:
+            linear.merge()
+    if getattr(linear, "fan_in_fan_out", False):
+        return linear.weight.t()
+    return linear.weight
+
+
+@torch.no_grad()
+def fused_linear(linears, input_scale: Optional[torch.Tensor] = None) -> nn.Linear:
+    """
+    One bias-free linear layer computing the concatenated outputs of `linears` on the same input.
+
+    Args:
+        linears: projections reading the same hidden state, plain or peft LoRA layers (merged on the way)
+        input_scale (`torch.Tensor`, *optional*): per-input-feature scale folded into the weight, e.g. from
+            `LlamaRMSNorm.fold_weight`
+    """
+    weights = [merged_linear_weight(linear) for linear in linears]
+    weight = torch.cat([w.float() for w in weights], dim=0)
+    if input_scale is not None:
+        weight = weight * input_scale.to(weight.device)[None, :]
+    fused = nn.Linear(weight.shape[1], weight.shape[0], bias=False, device=weight.device, dtype=weights[0].dtype)
+    fused.weight.copy_(weight)
+    return fused
+
 
 class LlamaRotaryEmbedding(torch.nn.Module):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
         super().__init__()
+        self.dim = dim
+        self.base = base
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
         self.register_buffer("inv_freq", inv_freq)
 
         # Build here to make `torch.jit.trace` work.
-        self.max_seq_len_cached = max_position_embeddings
-        t = torch.arange(self.max_seq_len_cached, device=self.inv_freq.device, dtype=self.inv_freq.dtype)
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        self._set_cos_sin_cache(max_position_embeddings, device=self.inv_freq.device)
+
+    def _set_cos_sin_cache(self, seq_len, device):
+        """(Re)build the non-persistent cos/sin tables, also needed after allocating the module with `to_empty`."""
+        self.max_seq_len_cached = seq_len
+        t = torch.arange(self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype)
+        freqs = torch.einsum("i,j->ij", t, self.inv_freq.to(device))
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
         self.register_buffer("cos_cached", emb.cos()[None, None, :, :], persistent=False)
         self.register_buffer("sin_cached", emb.sin()[None, None, :, :], persistent=False)
 
+    def reset_buffers(self, device=None):
+        """Recompute inv_freq and the cos/sin tables, e.g. after allocating the module with `to_empty`."""
+        self.inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2, device=device).float() / self.dim))
+        self._set_cos_sin_cache(self.max_seq_len_cached, device=device)
+
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
         # This `if` block is unlikely to be run after we build sin/cos in `__init__`. Keep the logic here just in case.
         if seq_len > self.max_seq_len_cached:
-            self.max_seq_len_cached = seq_len
-            t = torch.arange(self.max_seq_len_cached, device=x.device, dtype=self.inv_freq.dtype)
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            # Different from paper, but it uses a different permutation in order to obtain the same calculation
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            self.register_buffer("cos_cached", emb.cos()[None, None, :, :], persistent=False)
-            self.register_buffer("sin_cached", emb.sin()[None, None, :, :], persistent=False)
+            self._set_cos_sin_cache(seq_len, device=x.device)
         return (
             self.cos_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
             self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
@@ -135,8 +198,19 @@ class LlamaMLP(nn.Module):
         self.down_proj = nn.Linear(intermediate_size, hidden_size, bias=False)
         self.up_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
         self.act_fn = ACT2FN[hidden_act]
+        self.intermediate_size = intermediate_size
+        self.gate_up_proj = None
+
+    def fuse_projections(self, input_scale: Optional[torch.Tensor] = None):
+        """Replace gate_proj / up_proj by one gate_up_proj GEMM; inference only, call after loading all weights."""
+        self.gate_up_proj = fused_linear([self.gate_proj, self.up_proj], input_scale)
+        del self.gate_proj, self.up_proj
+        merged_linear_weight(self.down_proj)
 
     def forward(self, x):
+        if self.gate_up_proj is not None:
+            gate, up = self.gate_up_proj(x).split(self.intermediate_size, dim=-1)
+            return self.down_proj(self.act_fn(gate) * up)
         return self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
 
 
@@ -161,6 +235,13 @@ class LlamaAttention(nn.Module):
         self.v_proj = nn.Linear(self.hidden_size, self.num_heads * self.head_dim, bias=False)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
         self.rotary_emb = LlamaRotaryEmbedding(self.head_dim, max_position_embeddings=self.max_position_embeddings)
+        self.qkv_proj = None
+
+    def fuse_projections(self, input_scale: Optional[torch.Tensor] = None):
+        """Replace q_proj / k_proj / v_proj by one qkv_proj GEMM; inference only, call after loading all weights."""
+        self.qkv_proj = fused_linear([self.q_proj, self.k_proj, self.v_proj], input_scale)
+        del self.q_proj, self.k_proj, self.v_proj
+        merged_linear_weight(self.o_proj)
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
@@ -176,9 +257,15 @@ class LlamaAttention(nn.Module):
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         bsz, q_len, _ = hidden_states.size()
 
-        query_states = self.q_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
-        key_states = self.k_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
-        value_states = self.v_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+        if self.qkv_proj is not None:
+            query_states, key_states, value_states = self.qkv_proj(hidden_states).split(self.num_heads * self.head_dim, dim=-1)
+        else:
+            query_states = self.q_proj(hidden_states)
+            key_states = self.k_proj(hidden_states)
+            value_states = self.v_proj(hidden_states)
+        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+        key_states = key_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+        value_states = value_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
 
         kv_seq_len = key_states.shape[-2]
         if past_key_value is not None:
@@ -221,7 +308,8 @@ class LlamaAttention(nn.Module):
             )
 
         attn_output = attn_output.transpose(1, 2)
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        # num_heads are the local heads under tensor parallelism, o_proj reduces back to hidden_size
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         attn_output = self.o_proj(attn_output)
 
@@ -244,6 +332,11 @@ class LlamaDecoderLayer(nn.Module):
         self.input_layernorm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.post_attention_layernorm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
+    def fuse_projections(self, fold_norm: bool = True):
+        """Fused QKV and gate-up GEMMs, with the RMSNorm weights folded into them if `fold_norm`."""
+        self.self_attn.fuse_projections(self.input_layernorm.fold_weight() if fold_norm else None)
+        self.mlp.fuse_projections(self.post_attention_layernorm.fold_weight() if fold_norm else None)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -429,17 +522,30 @@ class LlamaModel(LlamaPreTrainedModel):
         self.norm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
         self.gradient_checkpointing = False
+        # pages decoder layer weights in before each layer runs, see model/utils/layer_streaming.py
+        self.layer_streamer = None
         # Initialize weights and apply final processing
         self.post_init()
 
     def get_input_embeddings(self):
         return self.embed_tokens
 
+    def fuse_projections(self, fold_norm: bool = True):
+        """
+        Switch every decoder layer to fused QKV / gate-up projections for inference. LoRA deltas (peft) of the
+        projections are merged into the weights. Not reversible: load all weights (including LoRA deltas) first.
+        Not available with layer streaming, the streamed weights are stored under the unfused parameter names.
+        """
+        if self.layer_streamer is not None:
+            raise ValueError("Fused projections can not be combined with layer streaming")
+        for layer in self.layers:
+            layer.fuse_projections(fold_norm)
+
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
     # Copied from transformers.models.bart.modeling_bart.BartDecoder._prepare_decoder_attention_mask
-    def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+    def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length, segment_ids=None):
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
@@ -451,7 +557,13 @@ class LlamaModel(LlamaPreTrainedModel):
                 past_key_values_length=past_key_values_length,
             )
 
-        if attention_mask is not None:
+        if segment_ids is not None:
+            # packed sequences (see utils/packing.py): a segment id per token -> block-diagonal mask
+            expanded_attn_mask = _expand_segment_mask(segment_ids.to(inputs_embeds.device), inputs_embeds.dtype)
+            combined_attention_mask = (
+                expanded_attn_mask if combined_attention_mask is None else expanded_attn_mask + combined_attention_mask
+            )
+        elif attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
             expanded_attn_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1]).to(
                 inputs_embeds.device
@@ -471,6 +583,7 @@ class LlamaModel(LlamaPreTrainedModel):
         past_key_values: Optional[List[torch.FloatTensor]] = None,
         inputs_embeds: Optional[torch.FloatTensor] = None,
         query_embeds: Optional[torch.FloatTensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
         use_cache: Optional[bool] = None,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
@@ -521,8 +634,10 @@ class LlamaModel(LlamaPreTrainedModel):
             attention_mask = torch.ones(
                 (batch_size, seq_length_with_past), dtype=torch.bool, device=inputs_embeds.device
             )
+        if segment_ids is not None and past_key_values_length > 0:
+            raise ValueError("`segment_ids` of packed sequences can not be combined with `past_key_values`")
         attention_mask = self._prepare_decoder_attention_mask(
-            attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
+            attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length, segment_ids
         )
 
         hidden_states = inputs_embeds
@@ -545,6 +660,9 @@ class LlamaModel(LlamaPreTrainedModel):
 
             past_key_value = past_key_values[idx] if past_key_values is not None else None
 
+            if self.layer_streamer is not None:
+                self.layer_streamer.load(idx)
+
             if self.gradient_checkpointing and self.training:
 
                 def create_custom_forward(module):
@@ -624,6 +742,9 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
     def get_decoder(self):
         return self.model
 
+    def fuse_projections(self, fold_norm: bool = True):
+        self.model.fuse_projections(fold_norm)
+
     @add_start_docstrings_to_model_forward(LLAMA_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=CausalLMOutputWithPast, config_class=_CONFIG_FOR_DOC)
     def forward(
@@ -634,6 +755,7 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         past_key_values: Optional[List[torch.FloatTensor]] = None,
         inputs_embeds: Optional[torch.FloatTensor] = None,
         query_embeds: Optional[torch.FloatTensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
         labels: Optional[torch.LongTensor] = None,
         use_cache: Optional[bool] = None,
         output_attentions: Optional[bool] = None,
@@ -680,6 +802,7 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             past_key_values=past_key_values,
             inputs_embeds=inputs_embeds,
             query_embeds=query_embeds,
+            segment_ids=segment_ids,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
@@ -753,3 +876,75 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past),)
         return reordered_past
 
+
+
+def load_state_dict_file(path: str):
+    """Read a weight file on CPU, memory-mapped when possible so that tensors are paged in as they are copied."""
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(path, device="cpu")
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or a legacy (non-zip) checkpoint
+        return torch.load(path, map_location="cpu")
+
+
+def checkpoint_shards(ckpt_path: str) -> List[str]:
+    """Weight files of a HuggingFace checkpoint directory, sharded or not."""
+    for index_name in ["model.safetensors.index.json", "pytorch_model.bin.index.json"]:
+        index_path = os.path.join(ckpt_path, index_name)
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                weight_map = json.load(f)["weight_map"]
+            return [os.path.join(ckpt_path, name) for name in dict.fromkeys(weight_map.values())]
+    for name in ["model.safetensors", "pytorch_model.bin"]:
+        if os.path.isfile(os.path.join(ckpt_path, name)):
+            return [os.path.join(ckpt_path, name)]
+    raise FileNotFoundError(f"No LLaMA weights found in {ckpt_path}")
+
+
+@torch.no_grad()
+def load_pretrained_llama(ckpt_path: str, torch_dtype: torch.dtype = torch.float16, device: Union[str, torch.device] = "cpu"):
+    """
+    Load a LlamaForCausalLM directly in `torch_dtype`, with a peak memory close to the final model size.
+
+    The model is built on the meta device (no random init), allocated once in `torch_dtype` and filled shard by
+    shard, so at most one shard is resident next to the model. Replaces `LlamaForCausalLM.from_pretrained`, which
+    materializes the randomly initialized fp32 model first.
+    """
+    config = LlamaConfig.from_pretrained(ckpt_path)
+    if hasattr(nn.Module, "to_empty") and hasattr(torch.device, "__enter__"):
+        with torch.device("meta"):
+            model = LlamaForCausalLM(config)
+        model = model.to(torch_dtype).to_empty(device=device)
+    else:
+        model = LlamaForCausalLM(config).to(device=device, dtype=torch_dtype)
+
+    parameters = dict(model.named_parameters())
+    tensors = dict(parameters, **dict(model.named_buffers()))
+    loaded = set()
+    for shard_path in checkpoint_shards(ckpt_path):
+        shard = load_state_dict_file(shard_path)
+        for name, value in shard.items():
+            if name in tensors:
+                tensors[name].copy_(value)
+                loaded.add(name)
+        del shard
+    missing = [name for name in parameters if name not in loaded]
+    if missing:
+        raise ValueError(f"Weights missing from {ckpt_path}: {missing[:8]}{'...' if len(missing) > 8 else ''}")
+
+    # non-persistent buffers are not in the checkpoint and were left uninitialized by to_empty
+    for module in model.modules():
+        if isinstance(module, LlamaRotaryEmbedding):
+            module.reset_buffers(device)
+    try:
+        from transformers import GenerationConfig
+
+        model.generation_config = GenerationConfig.from_pretrained(ckpt_path)
+    except (ImportError, OSError):
+        pass
+    model.config.torch_dtype = torch_dtype
+    return model.eval()
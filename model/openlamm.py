@@ -1,7 +1,6 @@
-import io
 import os
+from contextlib import nullcontext
 
-import requests
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -9,7 +8,7 @@ import torch.nn.functional as F
 from PIL import Image, ImageFile
 from torch.nn.utils import rnn
 from types import SimpleNamespace
-from peft import LoraConfig, TaskType, get_peft_model
+from peft import LoraConfig, PeftModel, TaskType, get_peft_model
 from transformers import LlamaTokenizer, LlamaForCausalLM, LlamaConfig
 
 import numpy as np
@@ -17,9 +16,21 @@ import numpy as np
 
 from transformers import StoppingCriteria, StoppingCriteriaList
 
-from .CLIP import load as load_clip
+from .CLIP import load_visual as load_clip_visual, visual_from_state_dict
 from .PROCESS import data
-from .modeling_llama import LlamaForCausalLM
+from .PROCESS.pipeline import ImagePipeline
+from .modeling_llama import LlamaForCausalLM, load_pretrained_llama, load_state_dict_file
+from .utils.feature_store import VisionFeatureStore
+from .utils.memory import MemoryTracker
+from .utils.packing import pack_sequences
+from .utils.quantization import load_quantized, quantize_model
+from .utils.tensor_parallel import init_distributed, shard_llama, shard_state_dict
+from .utils.snapshot import llama_from_snapshot, load_snapshot, sub_state_dict
+from .utils.profiling import ModuleProfiler
+from .utils.runtime import configure_threads, parse_dtype, resolve_device, resolve_dtype
+from .utils.storage import build_storage
+from .utils.token_compression import VisionTokenCompressor
+from .utils.tokenization import TokenizationService, encode_texts
 from .utils.pcl_utils import MEAN_COLOR_RGB, RandomCuboid, random_sampling
 from .conversations import conversation_dict, default_conversation
 
@@ -59,7 +70,7 @@ class StoppingCriteriaSub(StoppingCriteria):
 class MyStoppingCriteria(StoppingCriteria):
     def __init__(self, stops, input_ids):
         super().__init__()
-        self.stops = [torch.tensor(stop).to('cuda:0') for stop in stops]
+        self.stops = [torch.tensor(stop, device=input_ids.device) for stop in stops]
         self.stop_flag = [0]*input_ids.shape[0]
 
     def check_stop(self, input_ids):
@@ -82,46 +93,60 @@ class MyStoppingCriteria(StoppingCriteria):
         return False
 
 
-def build_one_instance(tokenizer, conversation, vision_type='image'):
+def conversation_turns(conversation, vision_type='image'):
+    """
+    :return list, list: the text of every turn and whether it is an answer the loss is taken on
+    """
     pos = VISION_TAGS['pos'][vision_type]
     # sov = VISION_TAGS['sov'][vision_type]
     eov = VISION_TAGS['eov'][vision_type]
 
-    text_list = []
-    turn_num = len(conversation)
-    input_ids, target_ids = [], []
-    for i in range(turn_num):
-        turn = conversation[i]
+    text_list, is_target = [], []
+    for i, turn in enumerate(conversation):
         role = turn['from']
         if i == 0: # the first human turn
             assert role == 'human'
             turn['value'] = turn['value'].replace(f'{pos}\n', '').replace(f'\n{pos}', '')
             text = f'{eov} ' + turn['value'] + '\n### Assistant:'
-            one_input_id = tokenizer(text, add_special_tokens=False).input_ids
-            input_ids += one_input_id
-            target_ids += [-100]*len(one_input_id) # do not perform loss regression on human prompt
+            is_target.append(False) # do not perform loss regression on human prompt
         else:
             if role == 'human':
                 text = 'Human: ' + turn['value'] + '\n### Assistant:'
-                one_input_id = tokenizer(text, add_special_tokens=False).input_ids
-                input_ids += one_input_id
-                target_ids += [-100]*len(one_input_id)
+                is_target.append(False)
             elif role == 'gpt':
                 text = turn['value'] + '\n###'
-                one_input_id = tokenizer(text, add_special_tokens=False).input_ids
-                input_ids += one_input_id
-                target_ids += one_input_id
+                is_target.append(True)
             else:
                 raise Exception('Wrong Role!!!')
         text_list.append(text)
-        assert len(input_ids) == len(target_ids)
+    return text_list, is_target
+
+
+def assemble_instance(turn_ids, is_target):
+    """concatenate the token ids of the turns, targets are -100 outside the answers"""
+    input_ids, target_ids = [], []
+    for one_input_id, target in zip(turn_ids, is_target):
+        input_ids += one_input_id
+        target_ids += one_input_id if target else [-100]*len(one_input_id)
+    assert len(input_ids) == len(target_ids)
+    return input_ids, target_ids
+
+
+def build_one_instance(tokenizer, conversation, vision_type='image'):
+    text_list, is_target = conversation_turns(conversation, vision_type)
+    input_ids, target_ids = assemble_instance(encode_texts(tokenizer, text_list), is_target)
     return text_list, input_ids, target_ids
 
 
 def process_batch_instance(tokenizer, batch_of_conversations, max_tgt_len, vision_type='image'):
+    # the turns of all conversations are tokenized in one call
+    turns = [conversation_turns(conversation, vision_type) for conversation in batch_of_conversations]
+    turn_ids = encode_texts(tokenizer, [text for text_list, _ in turns for text in text_list])
     batch_input_ids, batch_target_ids = [], []
-    for conversation in batch_of_conversations:
-        _, one_input_ids, one_target_ids = build_one_instance(tokenizer, conversation, vision_type=vision_type)
+    begin = 0
+    for text_list, is_target in turns:
+        one_input_ids, one_target_ids = assemble_instance(turn_ids[begin: begin + len(text_list)], is_target)
+        begin += len(text_list)
         batch_input_ids.append(torch.LongTensor(one_input_ids))
         batch_target_ids.append(torch.LongTensor(one_target_ids))
     input_ids = rnn.pad_sequence(batch_input_ids, batch_first=True, padding_value=tokenizer.pad_token_id)
@@ -152,20 +177,36 @@ class LAMMPEFTModel(nn.Module):
 
     def __init__(self, **args):
         super(LAMMPEFTModel, self).__init__()
+        # inference snapshot written by model/utils/snapshot.py: model args, merged weights and tokenizer in one place
+        snapshot_path = args['snapshot_path'] if 'snapshot_path' in args else None
+        snapshot_tensors = None
+        if snapshot_path:
+            snapshot_args, snapshot_tensors = load_snapshot(snapshot_path)
+            args = dict(snapshot_args, **args)
         self.args = args
-        # self.client = Client('~/petreloss.conf')
-        self.client = None
+        # remote images: pooled http(s) with an optional read-through disk cache, s3 through petrel
+        s3_client = None
+        if 'petrel_conf' in args:
+            from petrel_client.client import Client
+            s3_client = Client(args['petrel_conf'])
+        self.client = build_storage(
+            cache_dir=args['image_cache_dir'] if 'image_cache_dir' in args else None,
+            s3_client=s3_client,
+            pool_size=args['num_decode_workers'] if 'num_decode_workers' in args else 8,
+        )
 
         self.vision_type = args['vision_type'] if 'vision_type' in args else 'image'
         encoder_pretrain = args['encoder_pretrain'] if 'encoder_pretrain' in args else 'clip'
         self.encoder_pretrain = encoder_pretrain
         assert encoder_pretrain in ['imagebind', 'clip', 'epcl'], f'Encoder_pretrain: {encoder_pretrain} Not Implemented'
-        if not encoder_pretrain == 'clip' or os.path.isfile(args['encoder_ckpt_path']):
-            encoder_ckpt_path = args['encoder_ckpt_path'] 
-        elif not os.path.isfile(args['encoder_ckpt_path']):
-            encoder_ckpt_path = 'ViT-L/14'
-            
-        vicuna_ckpt_path = args['vicuna_ckpt_path']
+        if snapshot_path:
+            encoder_ckpt_path = vicuna_ckpt_path = snapshot_path
+        else:
+            if not encoder_pretrain == 'clip' or os.path.isfile(args['encoder_ckpt_path']):
+                encoder_ckpt_path = args['encoder_ckpt_path']
+            elif not os.path.isfile(args['encoder_ckpt_path']):
+                encoder_ckpt_path = 'ViT-L/14'
+            vicuna_ckpt_path = args['vicuna_ckpt_path']
         
         system_header = args['system_header'] if 'system_header' in args else False
         stage = args['stage']
@@ -174,22 +215,52 @@ class LAMMPEFTModel(nn.Module):
         # -1 for last embedding; -2 for transformer output
         self.vision_feature_type = args['vision_feature_type']
         self.num_vision_token = args['num_vision_token']
+        # transformer block of the patch features: -1 for the last block, -2 for the penultimate, ...
+        self.vision_feature_layer = args['vision_feature_layer'] if 'vision_feature_layer' in args else -1
 
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        device = resolve_device(args['device'] if 'device' in args else None)
         print (f'Initializing [{encoder_pretrain}] visual encoder from {encoder_ckpt_path} [{device}]...')
 
         # TODO: Make sure the number of vision tokens is correct
         if args['encoder_pretrain'].lower() == 'clip':
-            clip_encoder, self.visual_preprocess = load_clip(encoder_ckpt_path, device=device)
-            self.visual_encoder = clip_encoder.visual
+            # only the image encoder is loaded, the text tower is never built
+            if snapshot_tensors is not None:
+                visual_state_dict = {k: v for k, v in snapshot_tensors.items() if k.startswith('visual.')}
+                self.visual_encoder, self.visual_preprocess = visual_from_state_dict(
+                    visual_state_dict, device=device, dtype=visual_state_dict['visual.proj'].dtype)
+            else:
+                self.visual_encoder, self.visual_preprocess = load_clip_visual(encoder_ckpt_path, device=device)
+            # optional token merging inside the ViT; merged tokens are mapped back to all patches
+            self.visual_encoder.set_token_merging(args['tome_ratio'] if 'tome_ratio' in args else 0)
+            # batch-first encoder with fused attention, check with CLIP.model.compare_fast_path
+            self.visual_encoder.set_fast_path(args['vision_fast_path'] if 'vision_fast_path' in args else False)
+            # decode & preprocess images on worker threads
+            num_decode_workers = args['num_decode_workers'] if 'num_decode_workers' in args else 8
+            self.image_pipeline = ImagePipeline(self.visual_preprocess, num_workers=num_decode_workers)
             if self.vision_feature_type == 'global':          # global feature from CLIP
-                self.vision_hidden_size = 768
+                self.vision_hidden_size = self.visual_encoder.output_dim            # 768 for ViT-L/14
                 self.num_vision_token = 1
                 assert self.num_vision_token == 1, 'Only 1 global token is available!'
             elif self.vision_feature_type == 'local':        # patch features from CLIP ViT
-                self.vision_hidden_size = 1024
+                self.vision_hidden_size = self.visual_encoder.proj.shape[0]         # width, 1024 for ViT-L/14
                 self.num_vision_token = min(self.num_vision_token, 256)         # may cut partial tokens
 
+        # optional compression of the patch tokens before llama_proj; num_vision_token counts the compressed tokens
+        self.num_patch_token = self.num_vision_token
+        self.vision_token_compressor = VisionTokenCompressor(
+            args['vision_token_compression'] if 'vision_token_compression' in args else 'none',
+            args['num_compressed_token'] if 'num_compressed_token' in args else None,
+        )
+        if self.vision_feature_type == 'local':
+            self.num_vision_token = self.vision_token_compressor.num_output_tokens(self.num_patch_token)
+
+        # encoder features precomputed offline with model/utils/feature_store.py, looked up by vision path in training
+        self.vision_feature_store = None
+        if 'vision_feature_store' in args and args['vision_feature_store']:
+            self.vision_feature_store = VisionFeatureStore(args['vision_feature_store'])
+            self.vision_feature_store.check_compatible(self.vision_feature_type, self.vision_feature_layer, self.num_patch_token,
+                                                       tome_ratio=getattr(self.visual_encoder, 'tome_ratio', 0))
+
         # freeze vision encoder
         for name, param in self.visual_encoder.named_parameters():
             param.requires_grad = False
@@ -197,33 +268,152 @@ class LAMMPEFTModel(nn.Module):
         print ('Visual encoder initialized.')
 
         print (f'Initializing language decoder from {vicuna_ckpt_path} ...')
-        # add the lora module
-        peft_config = LoraConfig(
-            task_type=TaskType.CAUSAL_LM, 
-            inference_mode=False, 
-            r=self.args['lora_r'], 
-            lora_alpha=self.args['lora_alpha'], 
-            lora_dropout=self.args['lora_dropout'],
-            target_modules=self.args['lora_target_modules']
-        )
+        # tensor-parallel decoder across the ranks of torch.distributed, see model/utils/tensor_parallel.py
+        self.tensor_parallel = None
+        if 'tensor_parallel' in args and args['tensor_parallel']:
+            self.tensor_parallel = init_distributed()
+            torch.manual_seed(args['seed'] if 'seed' in args else 0)       # every rank samples the same tokens
+        if snapshot_tensors is not None:
+            # the LoRA deltas are merged into the snapshot weights, no adapters; each rank reads only its shard
+            # stream_layers: number of decoder layers held in memory, the others stay on disk
+            self.llama_model = llama_from_snapshot(snapshot_path, snapshot_tensors, shard=self.tensor_parallel,
+                                                   stream_layers=args['stream_layers'] if 'stream_layers' in args else None)
+        elif 'quantized_ckpt_path' in args and args['quantized_ckpt_path']:
+            # weight-only int8 / int4 decoder written by model/utils/quantization.py, the LoRA deltas are merged: no adapters
+            assert self.tensor_parallel is None, 'tensor parallelism of a quantized checkpoint is not supported'
+            llama_dtype = parse_dtype(args['llama_dtype'] if 'llama_dtype' in args else torch.float32)
+            self.llama_model = load_quantized(args['quantized_ckpt_path'], dtype=llama_dtype)
+        else:
+            # add the lora module
+            peft_config = LoraConfig(
+                task_type=TaskType.CAUSAL_LM,
+                inference_mode=False,
+                r=self.args['lora_r'],
+                lora_alpha=self.args['lora_alpha'],
+                lora_dropout=self.args['lora_dropout'],
+                target_modules=self.args['lora_target_modules']
+            )
 
-        self.llama_model = LlamaForCausalLM.from_pretrained(vicuna_ckpt_path)
-        self.llama_model = get_peft_model(self.llama_model, peft_config)
-        self.llama_model.print_trainable_parameters()
+            # allocated once in the target dtype and filled shard by shard; fp32 keeps the training behaviour
+            llama_dtype = parse_dtype(args['llama_dtype'] if 'llama_dtype' in args else torch.float32)
+            self.llama_model = load_pretrained_llama(vicuna_ckpt_path, torch_dtype=llama_dtype)
+            self.llama_model = get_peft_model(self.llama_model, peft_config)
+            self.llama_model.print_trainable_parameters()
+            if self.tensor_parallel is not None:
+                shard_llama(self.llama_base_model(), *self.tensor_parallel)
 
         self.llama_tokenizer = LlamaTokenizer.from_pretrained(vicuna_ckpt_path, use_fast=False)
         self.llama_tokenizer.pad_token = self.llama_tokenizer.eos_token
         self.llama_tokenizer.padding_side = "right"
+        # batched encoding through the fast tokenizer when it gives the ids of the slow one
+        self.tokenizer_service = TokenizationService.from_pretrained(
+            vicuna_ckpt_path, self.llama_tokenizer, backend=args['tokenizer_backend'] if 'tokenizer_backend' in args else 'fast')
         print ('Language decoder initialized.')
 
         self.llama_proj = nn.Linear(
             self.vision_hidden_size, self.llama_model.config.hidden_size
         )
+        if snapshot_tensors is not None:
+            self.llama_proj.load_state_dict(sub_state_dict(snapshot_tensors, 'llama_proj.'))
         print ('LLaMa projection layer initialized.')
 
         self.max_tgt_len = args['max_tgt_len']
         self.system_header = system_header
-        self.device = torch.cuda.current_device()
+        # sequence packing in training, see model/utils/packing.py; max_pack_len defaults to the padded batch length
+        self.pack_sequences = args['pack_sequences'] if 'pack_sequences' in args else False
+        self.max_pack_len = args['max_pack_len'] if 'max_pack_len' in args else None
+        self.packing_stats = None       # padding efficiency before / after packing of the last batch
+        self.profiler = None
+        self.memory = None
+
+    @property
+    def device(self):
+        '''device the model currently lives on, follows .to() / .cuda()'''
+        return self.llama_proj.weight.device
+
+    def to_inference(self, device=None, dtype=None, num_threads=None, num_interop_threads=None):
+        '''move the model for inference on GPU or CPU
+
+        :param device: defaults to cuda if available
+        :param dtype: torch.dtype or 'fp32' / 'bf16' / 'fp16'; defaults to fp16 on GPU and fp32 on CPU
+        :param int num_threads: intra-op threads on CPU
+        :param int num_interop_threads: inter-op threads on CPU
+        :return self:
+        '''
+        device = resolve_device(device)
+        dtype = resolve_dtype(dtype, device)
+        if self.llama_streams_layers() and device.type != 'cpu':
+            raise ValueError('Layer streaming runs on CPU only, the streamed decoder layers are paged into CPU memory')
+        if device.type == 'cpu':
+            num_threads, num_interop_threads = configure_threads(num_threads, num_interop_threads)
+            print(f'[!] CPU inference in {dtype} with {num_threads} intra-op / {num_interop_threads} inter-op threads')
+        if not self.llama_streams_layers():
+            return self.eval().to(device=device, dtype=dtype)
+
+        # the streamed decoder layers hold meta parameters, only the resident modules are moved;
+        # LayerStreamer casts the layer weights to the dtype of embed_tokens as it reads them
+        decoder = self.llama_base_model().model
+        decoder.layer_streamer.release()
+        layers = decoder.layers
+        decoder.layers = nn.ModuleList()
+        try:
+            self.to(device=device, dtype=dtype)
+        finally:
+            decoder.layers = layers
+        return self.eval()
+
+    def enable_profiling(self, trace_sample_rate=0.0, trace_dir=None):
+        '''time the decoder and vision encoder modules of every generate call, see model/utils/profiling.py
+
+        :return ModuleProfiler: report() / format_report() give the self time per module of the last request
+        '''
+        if self.profiler is None:
+            self.profiler = ModuleProfiler(self, trace_sample_rate=trace_sample_rate, trace_dir=trace_dir)
+        return self.profiler.enable()
+
+    def disable_profiling(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def enable_memory_accounting(self, metrics_path=None):
+        '''account weights, live KV cache, sessions and the peak memory of every generate call, see model/utils/memory.py
+
+        :param str metrics_path: optional jsonl file, one line of latency and memory figures per request
+        :return MemoryTracker: report() / format_report() / sessions_that_fit()
+        '''
+        if self.memory is None:
+            self.memory = MemoryTracker(self, metrics_path=metrics_path)
+        return self.memory.enable()
+
+    def load_delta_checkpoint(self, delta_ckpt_path):
+        '''load the trained LoRA / projection weights, memory-mapped so the file is not held in memory next to the model'''
+        state_dict = load_state_dict_file(delta_ckpt_path)
+        if self.tensor_parallel is not None:
+            state_dict = shard_state_dict(state_dict, *self.tensor_parallel)      # LoRA factors split like their projections
+        return self.load_state_dict(state_dict, strict=False)
+
+    def llama_base_model(self):
+        '''the LlamaForCausalLM below the peft wrapper (models loaded from a snapshot have none)'''
+        if isinstance(self.llama_model, PeftModel):
+            return self.llama_model.base_model.model
+        return self.llama_model
+
+    def embed_tokens(self, token_ids):
+        return self.llama_model.get_input_embeddings()(token_ids)
+
+    def llama_streams_layers(self):
+        '''whether the decoder layers are paged in from the snapshot as they run, see model/utils/layer_streaming.py'''
+        return getattr(self.llama_base_model().model, 'layer_streamer', None) is not None
+
+    def fuse_llama_projections(self, fold_norm=True):
+        '''one QKV and one gate-up GEMM per decoder layer for inference, with the LoRA deltas merged;
+        call after loading the delta checkpoint; not available with layer streaming'''
+        self.llama_base_model().fuse_projections(fold_norm)
+
+    def quantize_llama(self, bits=8, group_size=128):
+        '''weight-only int8 / int4 LLaMA linear layers and lm_head for inference, the LoRA deltas are merged first;
+        call after loading the delta checkpoint'''
+        quantize_model(self.llama_base_model(), bits=bits, group_size=group_size)
 
     def encode_image(self, image_paths):
         """encode images to llama inputs
@@ -257,7 +447,25 @@ class LAMMPEFTModel(nn.Module):
             return inputs_llama, atts_llama
         else:
             raise NotImplementedError("Encoder pretrain [{}] not implemented".format(self.encoder_pretrain))
-    
+
+    def encode_image_batch(self, image_paths=None, images=None):
+        """encode image paths and loaded image objects together in one CLIP forward
+
+        :param list image_paths: (n1, ) image paths, optional
+        :param list images: (n2, ) loaded image objects, optional
+        :return tensor, tensor: input feature to llama (n1+n2 x num_vision_token x llama_size), attention mask to llama
+        """
+        if self.encoder_pretrain != 'clip':
+            raise NotImplementedError("Encoder pretrain [{}] not implemented".format(self.encoder_pretrain))
+        vision_inputs = []
+        if image_paths:
+            vision_inputs.append(self.load_and_transform_vision_data_clip(image_paths, self.device))  # n1 x 3 x 224 x 224
+        if images:
+            vision_inputs.append(data.transform_vision_data(images, self.device))                  # n2 x 3 x 224 x 224
+        inputs_llama = self.clip_encode_image(torch.cat(vision_inputs, dim=0))                      # (n1+n2) x 1/256 x llama_size
+        atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device)
+        return inputs_llama, atts_llama
+
     def encode_pcl(self, pcl_paths):
         # load pcl data
         inputs = self.load_and_transform_pcl_data(pcl_paths, self.device) # bsz x 40000 x 3
@@ -267,43 +475,62 @@ class LAMMPEFTModel(nn.Module):
             if self.vision_feature_type == 'global':
                 raise NotImplementedError("Global feature not implemented for pcl")
             elif self.vision_feature_type == 'local':
-                embeddings = self.visual_encoder(inputs)[1][:, :self.num_vision_token]      # bsz x 256 x 1024;
-                image_embeds = embeddings.reshape(-1, self.vision_hidden_size).to(self.llama_model.dtype)       # bsz*num vision token x 1024
-                inputs_llama = self.llama_proj(image_embeds).reshape(-1, self.num_vision_token, self.llama_model.config.hidden_size) # bsz x num_vision_token x llama_size
+                embeddings = self.visual_encoder(inputs)[1][:, :self.num_patch_token]       # bsz x 256 x 1024;
+                inputs_llama = self.project_vision_features(embeddings)                     # bsz x num_vision_token x llama_size
                 atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device)                     # bsz x 1/256
         return inputs_llama, atts_llama
     
-    def clip_encode_image(self, inputs):
+    def clip_extract_features(self, inputs):
+        """run the frozen CLIP encoder
+
+        :param tensor inputs: bsz x 3 x 224 x 224
+        :return tensor: bsz x 768 global features, or bsz x num_patch_token x 1024 patch features
+        """
         inputs = inputs.to(self.llama_model.dtype)                                  # clip requires torch.float32
         with torch.no_grad():
             if self.vision_feature_type == 'global':
                 embeddings = self.visual_encoder(inputs)                            # bsz x 768
-                image_embeds = embeddings.to(self.llama_model.dtype)
-                inputs_llama = self.llama_proj(image_embeds).unsqueeze(1)           # bsz x 1 x llama_size
             elif self.vision_feature_type == 'local':
-                embeddings = self.visual_encoder.forward_patch_features(inputs)[:, :self.num_vision_token]      # bsz x self.num_vision_token x 1024
-                image_embeds = embeddings.reshape(-1, self.vision_hidden_size).to(self.llama_model.dtype)       # bsz*num vision token x 1024
-                inputs_llama = self.llama_proj(image_embeds).reshape(-1, self.num_vision_token, self.llama_model.config.hidden_size) # bsz x num_vision_token x llama_size
+                embeddings = self.visual_encoder.forward_patch_features(inputs, self.vision_feature_layer)[:, :self.num_patch_token]       # bsz x self.num_patch_token x 1024
             else:
                 raise NotImplementedError("{} not Implemented".format(self.vision_feature_type))
+        return embeddings
+
+    def project_vision_features(self, embeddings):
+        """compress and project encoder features to llama inputs
+
+        :param tensor embeddings: output of clip_extract_features or rows of a precomputed feature store
+        :return tensor: bsz x num_vision_token x llama_size
+        """
+        if self.vision_feature_type == 'global':
+            image_embeds = embeddings.to(self.llama_model.dtype)
+            inputs_llama = self.llama_proj(image_embeds).unsqueeze(1)           # bsz x 1 x llama_size
+        else:
+            embeddings = self.vision_token_compressor(embeddings[:, :self.num_patch_token])                 # bsz x self.num_vision_token x 1024
+            image_embeds = embeddings.reshape(-1, self.vision_hidden_size).to(self.llama_model.dtype)       # bsz*num vision token x 1024
+            inputs_llama = self.llama_proj(image_embeds).reshape(-1, self.num_vision_token, self.llama_model.config.hidden_size) # bsz x num_vision_token x llama_size
+        return inputs_llama
+
+    def clip_encode_image(self, inputs):
+        embeddings = self.clip_extract_features(inputs)
+        with torch.no_grad():
+            inputs_llama = self.project_vision_features(embeddings)
         return inputs_llama
 
+    def encode_vision_features(self, features):
+        """encode precomputed encoder features (e.g. from a VisionFeatureStore) to llama inputs"""
+        features = features.to(self.device)
+        if self.vision_feature_type == 'global' and features.dim() == 3:
+            features = features[:, 0]                                               # stored as bsz x 1 x 768
+        with torch.no_grad():
+            inputs_llama = self.project_vision_features(features)
+        atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device)
+        return inputs_llama, atts_llama
+
     def load_and_transform_vision_data_clip(self, image_paths, device):
         if image_paths is None:
             return None
-        image_ouputs = []
-        for image_path in image_paths:
-            if os.path.exists(image_path):
-                image = Image.open(image_path)
-            elif image_path.startswith('s3://') and self.client is not None:
-                image = Image.open(io.BytesIO(self.client.get(image_path, update_cache=True))).convert("RGB")
-            elif image_path.startswith('http://'):
-                image = Image.open(requests.get(image_path, stream=True).raw)
-            else:
-                print("can not load image: ", image_path)
-            image_outpt = self.visual_preprocess(image).to(device)                      # 3 x 224 x 224
-            image_ouputs.append(image_outpt)
-        return torch.stack(image_ouputs, dim=0)                                         # B x 3 x 224 x 224
+        return self.image_pipeline.load(image_paths, device, client=self.client)       # B x 3 x 224 x 224
     
     def load_and_transform_pcl_data(self, pcl_paths, device):
         if pcl_paths is None:
@@ -341,23 +568,20 @@ class LAMMPEFTModel(nn.Module):
         # return list of headers if multiple tasks
         p_before = make_prompt_start(system_header=system_header, vision_type=self.vision_type, task_type=task_type)
         if isinstance(p_before, list):
-            p_before_tokens = [self.llama_tokenizer(p, 
-                return_tensors="pt", add_special_tokens=False).input_ids[0].to(self.device) for p in p_before]
+            p_before_tokens = [torch.tensor(self.tokenizer_service.encode_cached(p), dtype=torch.long, device=self.device) for p in p_before]
             # TODO: fix bug here
             p_before_token_ids = rnn.pad_sequence(p_before_tokens, batch_first=True, padding_value=self.llama_tokenizer.pad_token_id) # bsz x s1
             p_before_attn_mask = p_before_token_ids.ne(self.llama_tokenizer.pad_token_id)
         else:
-            p_before_tokens = self.llama_tokenizer(p_before, 
-                return_tensors="pt", add_special_tokens=False).to(self.device)  # [s1, s1...] list of batch size
-            p_before_token_ids = p_before_tokens.input_ids.expand(batch_size, -1) # bsz x s1
-            p_before_attn_mask = p_before_tokens.attention_mask.expand(batch_size, -1) # bsz x s1
-        # peft model need deeper call
-        p_before_embeds = self.llama_model.model.model.embed_tokens(p_before_token_ids) #.expand(batch_size, -1, -1) # bsz x s1 x embed_dim
-        p_after_embeds = self.llama_model.model.model.embed_tokens(input_ids).expand(batch_size, -1, -1) # bsz x s2 x embed_dim
+            p_before_token_ids = torch.tensor([self.tokenizer_service.encode_cached(p_before)],
+                dtype=torch.long, device=self.device).expand(batch_size, -1) # bsz x s1
+            p_before_attn_mask = torch.ones_like(p_before_token_ids) # bsz x s1
+        p_before_embeds = self.embed_tokens(p_before_token_ids) #.expand(batch_size, -1, -1) # bsz x s1 x embed_dim
+        p_after_embeds = self.embed_tokens(input_ids).expand(batch_size, -1, -1) # bsz x s2 x embed_dim
         bos = torch.ones([batch_size, 1],
                          dtype=p_before_token_ids.dtype,
                          device=p_before_token_ids.device) * self.llama_tokenizer.bos_token_id # bsz x 1
-        bos_embeds = self.llama_model.model.model.embed_tokens(bos) # bsz x 1 x embed_dim
+        bos_embeds = self.embed_tokens(bos) # bsz x 1 x embed_dim
         inputs_embeds = torch.cat([bos_embeds, p_before_embeds, img_embeds, p_after_embeds], dim=1) # bsz x (1+s1+NumToken+s2) x embed_dim
 
         # make target ids for prefix part
@@ -385,21 +609,40 @@ class LAMMPEFTModel(nn.Module):
         # image_paths = inputs['image_paths']
         assert self.vision_type == inputs['vision_type']    # single modal case
         task_type = inputs['task_type']
-        vision_paths = inputs['vision_paths']
-        if self.vision_type == 'image':
+        vision_paths = inputs.get('vision_paths')
+        if 'vision_features' in inputs and inputs['vision_features'] is not None:
+            vision_embeds, _ = self.encode_vision_features(inputs['vision_features'])      # precomputed encoder features
+        elif self.vision_feature_store is not None and vision_paths and self.vision_feature_store.contains_all(vision_paths):
+            vision_embeds, _ = self.encode_vision_features(self.vision_feature_store.get(vision_paths))
+        elif 'image_tensors' in inputs and inputs['image_tensors'] is not None:
+            # preprocessed (pinned) by the workers of model/utils/data_pipeline.py
+            vision_embeds = self.clip_encode_image(inputs['image_tensors'].to(self.device, non_blocking=True))
+        elif self.vision_type == 'image':
             vision_embeds, _ = self.encode_image(vision_paths)
         elif self.vision_type == 'pcl':
             vision_embeds, _ = self.encode_pcl(vision_paths)        # Bsz x N token x C
         else:
             raise ValueError('vision type [{}] not supported'.format(self.vision_type))
 
-        output_texts = inputs['output_texts']
-        input_ids, target_ids, attention_mask = process_batch_instance(self.llama_tokenizer, output_texts, self.max_tgt_len, self.vision_type)
+        if 'input_ids' in inputs and inputs['input_ids'] is not None:
+            # tokenized by the data loader workers
+            input_ids, target_ids, attention_mask = inputs['input_ids'], inputs['target_ids'], inputs['attention_mask']
+        else:
+            output_texts = inputs['output_texts']
+            input_ids, target_ids, attention_mask = process_batch_instance(self.tokenizer_service, output_texts, self.max_tgt_len, self.vision_type)
         inputs_embeds, targets, attention_mask = self.prompt_wrap(vision_embeds, input_ids, target_ids, attention_mask, self.system_header, task_type)
+        position_ids, segment_ids = None, None
+        if self.pack_sequences:
+            # several conversations per row, attention and positions kept per conversation
+            inputs_embeds, targets, segment_ids, position_ids, self.packing_stats = pack_sequences(
+                inputs_embeds, targets, attention_mask, self.max_pack_len)
+            attention_mask = segment_ids.ne(0).long()
 
         outputs = self.llama_model(
             inputs_embeds=inputs_embeds,
             attention_mask=attention_mask,
+            position_ids=position_ids,
+            segment_ids=segment_ids,
             return_dict=True,
             labels=targets,
         )
@@ -416,29 +659,38 @@ class LAMMPEFTModel(nn.Module):
     def extract_multimodal_feature(self, inputs):
         """Extract multimodal features from the input in Generation (Test)
 
+        Every sample keeps its own features: image paths and image objects are encoded
+        in one CLIP forward (paths first), and different modalities of the same sample
+        are summed together.
+
         :param Dict inputs: input dict; modality: path
-        :return _type_: _description_
+        :return tensor: bsz x num_vision_token x llama_size
         """
         features = []
-        if inputs['image_paths']:
-            image_embeds, _ = self.encode_image(inputs['image_paths'])
+        image_paths = inputs['image_paths'] if 'image_paths' in inputs and inputs['image_paths'] else []
+        images = inputs['images'] if 'images' in inputs and inputs['images'] else []    # image objects input in testing
+        if image_paths or images:
+            image_embeds, _ = self.encode_image_batch(image_paths, images)
             features.append(image_embeds)
-        if 'images' in inputs and inputs['images']:        # image objects input in testing
-            image_embeds, _ = self.my_encode_image(inputs['images'])
-            return image_embeds
-            # features.append(image_embeds)
         if 'pcl_paths' in inputs and inputs['pcl_paths']:
             pcl_embeds, _ = self.encode_pcl(inputs['pcl_paths'])
             features.append(pcl_embeds)
+        if len(features) == 0:
+            raise ValueError('No modality input provided for generation')
+        batch_size = features[0].shape[0]
+        if any(feature.shape[0] != batch_size for feature in features):
+            raise ValueError('Modalities have different batch size: {}'.format([feature.shape[0] for feature in features]))
         # TODO: Cautions HERE! Multimodality allowed in test ONLY!
-        feature_embeds = torch.cat(features).sum(dim=0).unsqueeze(0)        # sum all modality features together
+        feature_embeds = torch.stack(features).sum(dim=0)       # sum all modality features of each sample together
         return feature_embeds
 
     def prepare_generation_embedding(self, inputs):
         """prepare for generation
 
+        Samples are left padded so that every prompt ends right before the generated tokens.
+
         :param class inputs: model
-        :return Dict: generation input
+        :return tensor, tensor: generation input embeddings (bsz x s x embed_dim), attention mask (bsz x s)
         """
         eov = VISION_TAGS['eov'][self.vision_type]
         # TODO: add System header & image token size
@@ -449,39 +701,45 @@ class LAMMPEFTModel(nn.Module):
             feature_embeds = self.extract_multimodal_feature(inputs)
             inputs['modality_embeds'].append(feature_embeds)
 
-        batch_size = feature_embeds.shape[0]
+        batch_size = len(prompt_list)
+        if feature_embeds.shape[0] == 1 and batch_size > 1:
+            feature_embeds = feature_embeds.expand(batch_size, -1, -1)     # one input shared by all prompts
+        elif feature_embeds.shape[0] != batch_size:
+            raise ValueError('Got {} modality inputs for {} prompts'.format(feature_embeds.shape[0], batch_size))
+
         p_before = make_prompt_start(vision_type=self.vision_type)      # no system header in test
-        p_before_tokens = self.llama_tokenizer(p_before, 
-            return_tensors="pt", add_special_tokens=False).to(self.device)
-        p_before_embeds = self.llama_model.model.model.embed_tokens(p_before_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
-        p_after_embeds_list = []
-        p_after_tokens_list = []
-        for prompt in prompt_list:
-            # text = '</Img> ' + prompt + '\n### Assistant:'
-            text = f'{eov} ' + prompt + '\n### Assistant:'
-            p_after_tokens = self.llama_tokenizer(text, add_special_tokens=False, return_tensors='pt').to(self.device)
-
-            p_after_tokens_list.append(p_after_tokens.input_ids.squeeze(0))
+        p_before_token_ids = torch.tensor([self.tokenizer_service.encode_cached(p_before)], dtype=torch.long, device=self.device) # 1 x s1
+        p_before_embeds = self.embed_tokens(p_before_token_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
+        # text = '</Img> ' + prompt + '\n### Assistant:'
+        texts = [f'{eov} ' + prompt + '\n### Assistant:' for prompt in prompt_list]
+        p_after_tokens_list = [torch.tensor(ids, dtype=torch.long, device=self.device)
+                               for ids in self.tokenizer_service.encode_batch(texts)]
 
         p_after_tokens = rnn.pad_sequence(p_after_tokens_list, batch_first=True, padding_value=self.llama_tokenizer.pad_token_id)
+        p_after_embeds = self.embed_tokens(p_after_tokens) # bsz x s2 x embed_dim
 
-        p_after_embeds = self.llama_model.model.model.embed_tokens(p_after_tokens)
-        
-        # text = f'{eov} ' + prompt + '\n### Assistant:'
-        # p_after_tokens = self.llama_tokenizer(text, add_special_tokens=False, return_tensors='pt').to(self.device)
-        # p_after_embeds = self.llama_model.model.model.embed_tokens(p_after_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
         bos = torch.ones([batch_size, 1],
-                         dtype=p_before_tokens.input_ids.dtype,
-                         device=p_before_tokens.input_ids.device) * self.llama_tokenizer.bos_token_id # bsz x 1
-        bos_embeds = self.llama_model.model.model.embed_tokens(bos) # bsz x 1 x embed_dim
-        # print(bos_embeds.shape, p_before_embeds.shape, feature_embeds.shape, p_after_embeds.shape)
-        inputs_embeds = torch.cat([bos_embeds, p_before_embeds, feature_embeds, p_after_embeds], dim=1) # bsz x (1+s1+NumVisionToken+s2) x embed_dim
-        return inputs_embeds
+                         dtype=p_before_token_ids.dtype,
+                         device=p_before_token_ids.device) * self.llama_tokenizer.bos_token_id # bsz x 1
+        bos_embeds = self.embed_tokens(bos) # bsz x 1 x embed_dim
+        inputs_embeds = torch.cat([bos_embeds, p_before_embeds, feature_embeds.to(p_after_embeds.dtype), p_after_embeds], dim=1) # bsz x (1+s1+NumVisionToken+s2) x embed_dim
+
+        # move the right padding of the prompts to the left
+        seq_len = inputs_embeds.shape[1]
+        pad_lens = torch.tensor([p_after_tokens.shape[1] - len(t) for t in p_after_tokens_list], device=inputs_embeds.device) # bsz
+        positions = torch.arange(seq_len, device=inputs_embeds.device).unsqueeze(0)              # 1 x s
+        attention_mask = (positions >= pad_lens.unsqueeze(1)).long()                            # bsz x s
+        gather_index = (positions - pad_lens.unsqueeze(1)).clamp(min=0)                         # bsz x s
+        inputs_embeds = inputs_embeds.gather(1, gather_index.unsqueeze(-1).expand(-1, -1, inputs_embeds.shape[-1]))
+        inputs_embeds = inputs_embeds * attention_mask.unsqueeze(-1).to(inputs_embeds.dtype)
+        return inputs_embeds, attention_mask
 
     def generate(self, inputs):
         '''
             inputs = {
-                'image_paths': optional,
+                'image_paths': optional, one path per prompt (or one shared by all prompts)
+                'images': optional, loaded image objects
+                'pcl_paths': optional
                 'audio_paths': optional
                 'video_paths': optional
                 'thermal_paths': optional
@@ -494,18 +752,22 @@ class LAMMPEFTModel(nn.Module):
                 'modality_cache': save the image cache
             }
         '''
-        input_embeds = self.prepare_generation_embedding(inputs)
-        # stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=[2277], encounters=1)])
-        stopping_criteria = StoppingCriteriaList([MyStoppingCriteria([[2277]], input_embeds)])
-        outputs = self.llama_model.generate(
-            inputs_embeds=input_embeds,
-            max_new_tokens=inputs['max_tgt_len'],
-            top_p=inputs['top_p'],
-            temperature=inputs['temperature'],
-            do_sample=True,
-            use_cache=True,
-            stopping_criteria=stopping_criteria,
-        )
-        #output_text = self.llama_tokenizer.decode(outputs[0][:-2], skip_special_tokens=True)
-        output_text = self.llama_tokenizer.batch_decode(outputs, skip_special_tokens=True)
-        return output_text
+        profiling = self.profiler.request() if self.profiler is not None and self.profiler.enabled else nullcontext()
+        accounting = self.memory.request() if self.memory is not None and self.memory.enabled else nullcontext()
+        with profiling, accounting:
+            input_embeds, attention_mask = self.prepare_generation_embedding(inputs)
+            # stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=[2277], encounters=1)])
+            stopping_criteria = StoppingCriteriaList([MyStoppingCriteria([[2277]], input_embeds)])
+            outputs = self.llama_model.generate(
+                inputs_embeds=input_embeds,
+                attention_mask=attention_mask,
+                max_new_tokens=inputs['max_tgt_len'],
+                top_p=inputs['top_p'],
+                temperature=inputs['temperature'],
+                do_sample=True,
+                use_cache=True,
+                stopping_criteria=stopping_criteria,
+            )
+            #output_text = self.llama_tokenizer.decode(outputs[0][:-2], skip_special_tokens=True)
+            output_text = self.llama_tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            return output_text
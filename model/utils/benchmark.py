@@ -0,0 +1,429 @@
+"""CPU micro-benchmarks of the LAMM inference paths on tiny random-weight models.
+
+No downloaded weights are needed: the LLaMA decoder, the CLIP ViT and a full
+LAMMPEFTModel (LoRA, tokenizer, llama_proj) are built from small synthetic configs,
+with a SentencePiece tokenizer trained on a synthetic corpus. Throughput is the
+median over repeated runs after warm-up, for every batch size / sequence length:
+
+    llama_prefill   tokens/s of a forward over the whole prompt
+    llama_decode    tokens/s of cached single-token steps after a prompt
+    vision_encode   images/s of the ViT patch features
+    preprocess      images/s of JPEG decode + CLIP preprocessing (ImagePipeline)
+    tokenize        conversations/s of the training tokenization (process_batch_instance)
+    prompt_build    prompts/s of prepare_generation_embedding with cached image features
+
+Run, then compare against a baseline run (exit status 1 on regressions):
+
+    python -m model.utils.benchmark run --config tiny --output bench/baseline.json
+    python -m model.utils.benchmark run --config tiny --output bench/current.json
+    python -m model.utils.benchmark compare bench/baseline.json bench/current.json --threshold 0.05
+
+--quantize-bits 8 / 4 runs the LLaMA benchmarks on the weight-only quantized decoder
+(quantization.py); compare it against an fp32 run for the decode speed-up.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import torch
+
+from .memory import kv_bytes_per_token, weight_bytes
+from .runtime import configure_threads, resolve_dtype
+
+# synthetic model sizes; heads of the ViT are width // 64 like CLIP
+CONFIGS = {
+    'tiny': {
+        'llama': dict(hidden_size=256, intermediate_size=688, num_hidden_layers=4, num_attention_heads=4),
+        'vision': dict(input_resolution=224, patch_size=14, width=256, layers=4, output_dim=256),
+        'vocab_size': 1000,
+    },
+    'small': {
+        'llama': dict(hidden_size=1024, intermediate_size=2752, num_hidden_layers=8, num_attention_heads=16),
+        'vision': dict(input_resolution=224, patch_size=14, width=512, layers=8, output_dim=512),
+        'vocab_size': 4000,
+    },
+}
+BENCHMARKS = ['llama_prefill', 'llama_decode', 'vision_encode', 'preprocess', 'tokenize', 'prompt_build']
+
+_WORDS = (
+    'the a an image picture photo shows there is are of in on with and man woman dog cat car street table red blue '
+    'green white black small large two three people sitting standing next to near front behind building tree sky '
+    'describe what color how many where why question answer assistant human detailed object left right top bottom'
+).split()
+
+
+def synthetic_sentence(rng, min_words=6, max_words=24):
+    return ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(min_words, max_words))).capitalize() + '.'
+
+
+def synthetic_conversation(rng, turns=2):
+    conversation = [{'from': 'human', 'value': '<image>\n' + synthetic_sentence(rng)}]
+    for i in range(turns * 2 - 1):
+        conversation.append({'from': 'gpt' if i % 2 == 0 else 'human', 'value': synthetic_sentence(rng)})
+    return conversation
+
+
+def train_tokenizer(output_dir, vocab_size=1000, seed=0):
+    """LLaMA-style SentencePiece BPE tokenizer (unk 0, bos 1, eos 2) trained on synthetic text
+
+    :return LlamaTokenizer: also saved to `output_dir`
+    """
+    import sentencepiece as spm
+    from transformers import LlamaTokenizer
+    from ..conversations import default_conversation
+
+    rng = random.Random(seed)
+    corpus = [default_conversation.system, '### Human: <Img> </Img> ### Assistant:'] + \
+        [synthetic_sentence(rng) for _ in range(5000)]
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(corpus), model_writer=model, vocab_size=vocab_size, model_type='bpe',
+        unk_id=0, bos_id=1, eos_id=2, pad_id=-1, byte_fallback=True, hard_vocab_limit=False, minloglevel=2,
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    vocab_file = os.path.join(output_dir, 'tokenizer.model')
+    with open(vocab_file, 'wb') as f:
+        f.write(model.getvalue())
+    tokenizer = LlamaTokenizer(vocab_file)
+    tokenizer.save_pretrained(output_dir)
+    return tokenizer
+
+
+def build_llama(config_name='tiny', vocab_size=None, seed=0):
+    """random-weight LlamaForCausalLM of a synthetic config"""
+    from transformers.models.llama.configuration_llama import LlamaConfig
+    from ..modeling_llama import LlamaForCausalLM
+
+    preset = CONFIGS[config_name]
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=vocab_size or preset['vocab_size'], **preset['llama'])
+    return LlamaForCausalLM(config).eval()
+
+
+def build_visual(config_name='tiny', seed=0):
+    """random-weight CLIP VisionTransformer of a synthetic config"""
+    from ..CLIP.model import VisionTransformer
+
+    vision = dict(CONFIGS[config_name]['vision'])
+    torch.manual_seed(seed)
+    return VisionTransformer(heads=vision['width'] // 64, **vision).eval()
+
+
+def write_synthetic_checkpoints(output_dir, config_name='tiny', seed=0):
+    """LLaMA checkpoint directory (config, weights, tokenizer) and visual-only CLIP checkpoint with random weights
+
+    :return str, str: vicuna_ckpt_path, encoder_ckpt_path for LAMMPEFTModel
+    """
+    vicuna_ckpt_path = os.path.join(output_dir, 'llama')
+    encoder_ckpt_path = os.path.join(output_dir, 'visual.pt')
+    tokenizer = train_tokenizer(vicuna_ckpt_path, CONFIGS[config_name]['vocab_size'], seed)
+    llama = build_llama(config_name, vocab_size=len(tokenizer), seed=seed)
+    llama.config.save_pretrained(vicuna_ckpt_path)
+    torch.save(llama.state_dict(), os.path.join(vicuna_ckpt_path, 'pytorch_model.bin'))
+    visual = build_visual(config_name, seed)
+    torch.save({'visual.' + name: tensor for name, tensor in visual.state_dict().items()}, encoder_ckpt_path)
+    return vicuna_ckpt_path, encoder_ckpt_path
+
+
+def build_lamm_model(output_dir, config_name='tiny', seed=0, **args):
+    """LAMMPEFTModel on random synthetic checkpoints written to `output_dir`; `args` override the model args"""
+    from ..openlamm import LAMMPEFTModel
+
+    vicuna_ckpt_path, encoder_ckpt_path = write_synthetic_checkpoints(output_dir, config_name, seed)
+    model_args = dict(
+        encoder_ckpt_path=encoder_ckpt_path,
+        vicuna_ckpt_path=vicuna_ckpt_path,
+        encoder_pretrain='clip',
+        stage=2,
+        max_tgt_len=128,
+        lora_r=8,
+        lora_alpha=16,
+        lora_dropout=0.0,
+        lora_target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj'],
+        vision_type='image',
+        vision_feature_type='local',
+        num_vision_token=256,
+        device='cpu',
+    )
+    model_args.update(args)
+    return LAMMPEFTModel(**model_args).eval()
+
+
+def write_synthetic_images(output_dir, num_images, size=(640, 480), seed=0):
+    """random-noise JPEGs, which decode about as slowly as photos of the same size"""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(num_images):
+        path = os.path.join(output_dir, f'image_{i}.jpg')
+        Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def measure(fn, warmup=1, repeats=5):
+    """
+    :return dict: median and min seconds of `repeats` calls of fn() after `warmup` calls
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'repeats': repeats}
+
+
+def _result(name, params, metric, units, timing):
+    """one benchmark row; `units` of work per call give the throughput, higher is better"""
+    return dict(name=name, params=params, metric=metric, value=units / timing['median_s'], **timing)
+
+
+@torch.no_grad()
+def bench_llama_prefill(llama, batch_sizes, seq_lens, warmup=1, repeats=5):
+    results = []
+    for batch_size in batch_sizes:
+        for seq_len in seq_lens:
+            input_ids = torch.randint(3, llama.config.vocab_size, (batch_size, seq_len))
+            timing = measure(lambda: llama(input_ids, use_cache=False), warmup, repeats)
+            results.append(_result('llama_prefill', {'batch_size': batch_size, 'seq_len': seq_len}, 'tokens_per_s', batch_size * seq_len, timing))
+    return results
+
+
+@torch.no_grad()
+def bench_llama_decode(llama, batch_sizes, seq_lens, new_tokens=16, warmup=1, repeats=5):
+    """greedy single-token steps on the kv cache of a `seq_len` prompt, the prefill is not timed"""
+    results = []
+    for batch_size in batch_sizes:
+        for seq_len in seq_lens:
+            input_ids = torch.randint(3, llama.config.vocab_size, (batch_size, seq_len))
+            prefill = llama(input_ids, use_cache=True)
+
+            def decode():
+                past_key_values, logits = prefill.past_key_values, prefill.logits
+                for _ in range(new_tokens):
+                    next_ids = logits[:, -1:].argmax(dim=-1)
+                    outputs = llama(next_ids, past_key_values=past_key_values, use_cache=True)
+                    past_key_values, logits = outputs.past_key_values, outputs.logits
+
+            timing = measure(decode, warmup, repeats)
+            params = {'batch_size': batch_size, 'seq_len': seq_len, 'new_tokens': new_tokens}
+            results.append(_result('llama_decode', params, 'tokens_per_s', batch_size * new_tokens, timing))
+    return results
+
+
+@torch.no_grad()
+def bench_vision_encode(visual, batch_sizes, warmup=1, repeats=5):
+    results = []
+    dtype = visual.conv1.weight.dtype
+    for batch_size in batch_sizes:
+        images = torch.randn(batch_size, 3, visual.input_resolution, visual.input_resolution, dtype=dtype)
+        timing = measure(lambda: visual.forward_patch_features(images), warmup, repeats)
+        results.append(_result('vision_encode', {'batch_size': batch_size}, 'images_per_s', batch_size, timing))
+    return results
+
+
+def bench_preprocess(image_pipeline, image_paths, batch_sizes, warmup=1, repeats=5):
+    results = []
+    for batch_size in batch_sizes:
+        paths = [image_paths[i % len(image_paths)] for i in range(batch_size)]
+        timing = measure(lambda: image_pipeline.load(paths, 'cpu'), warmup, repeats)
+        results.append(_result('preprocess', {'batch_size': batch_size}, 'images_per_s', batch_size, timing))
+    return results
+
+
+def bench_tokenize(tokenizer, batch_sizes, max_tgt_len=128, warmup=1, repeats=5, seed=0):
+    import copy
+    from ..openlamm import process_batch_instance
+
+    results = []
+    rng = random.Random(seed)
+    for batch_size in batch_sizes:
+        conversations = [synthetic_conversation(rng) for _ in range(batch_size)]
+        # build_one_instance strips the image tag in place, every call gets fresh copies
+        timing = measure(lambda: process_batch_instance(tokenizer, copy.deepcopy(conversations), max_tgt_len), warmup, repeats)
+        results.append(_result('tokenize', {'batch_size': batch_size}, 'conversations_per_s', batch_size, timing))
+    return results
+
+
+@torch.no_grad()
+def bench_prompt_build(model, batch_sizes, warmup=1, repeats=5, seed=0):
+    """left-padded generation embeddings from prompts and cached image features, as in every chat turn"""
+    results = []
+    rng = random.Random(seed)
+    hidden_size = model.llama_model.config.hidden_size
+    for batch_size in batch_sizes:
+        prompts = [synthetic_sentence(rng) for _ in range(batch_size)]
+        features = torch.randn(batch_size, model.num_vision_token, hidden_size, dtype=model.llama_proj.weight.dtype)
+        timing = measure(lambda: model.prepare_generation_embedding({'prompt': prompts, 'modality_embeds': [features]}), warmup, repeats)
+        results.append(_result('prompt_build', {'batch_size': batch_size}, 'prompts_per_s', batch_size, timing))
+    return results
+
+
+def environment():
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'num_threads': torch.get_num_threads(),
+        'num_interop_threads': torch.get_num_interop_threads(),
+    }
+    try:
+        import transformers
+
+        info['transformers'] = transformers.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def run(config_name='tiny', benchmarks=None, batch_sizes=(1, 4), seq_lens=(32, 128), new_tokens=16,
+        dtype=None, warmup=1, repeats=5, seed=0, workdir=None, quantize_bits=None):
+    """
+    :param list benchmarks: subset of BENCHMARKS, all when None
+    :param dtype: 'fp32' / 'bf16' for the models, fp32 when None
+    :param int quantize_bits: 8 / 4 to quantize the LLaMA decoder weights, see quantization.py
+    :return dict: {'environment', 'settings', 'memory', 'results'}, memory in bytes (see memory.py)
+    """
+    benchmarks = benchmarks or BENCHMARKS
+    unknown = [name for name in benchmarks if name not in BENCHMARKS]
+    assert not unknown, f'unknown benchmarks {unknown}, choose from {BENCHMARKS}'
+    dtype = resolve_dtype(dtype, 'cpu')
+    results = []
+    with tempfile.TemporaryDirectory(prefix='lamm_bench_') as tmpdir:
+        workdir = workdir or tmpdir
+        print(f'[!] building the [{config_name}] LAMM model on random weights in {workdir} ...')
+        model = build_lamm_model(os.path.join(workdir, 'checkpoints'), config_name, seed)
+        if quantize_bits:
+            model.quantize_llama(bits=quantize_bits)
+        model = model.to_inference('cpu', dtype)
+        llama = model.llama_base_model()
+        memory = {'weights': weight_bytes(model), 'kv_bytes_per_token': kv_bytes_per_token(llama)}
+        for name in benchmarks:
+            print(f'[!] running {name} ...')
+            if name == 'llama_prefill':
+                results += bench_llama_prefill(llama, batch_sizes, seq_lens, warmup, repeats)
+            elif name == 'llama_decode':
+                results += bench_llama_decode(llama, batch_sizes, seq_lens, new_tokens, warmup, repeats)
+            elif name == 'vision_encode':
+                results += bench_vision_encode(model.visual_encoder, batch_sizes, warmup, repeats)
+            elif name == 'preprocess':
+                image_paths = write_synthetic_images(os.path.join(workdir, 'images'), max(batch_sizes), seed=seed)
+                results += bench_preprocess(model.image_pipeline, image_paths, batch_sizes, warmup, repeats)
+            elif name == 'tokenize':
+                results += bench_tokenize(model.tokenizer_service, batch_sizes, model.max_tgt_len, warmup, repeats, seed)
+            elif name == 'prompt_build':
+                results += bench_prompt_build(model, batch_sizes, warmup, repeats, seed)
+    settings = {
+        'config': config_name, 'dtype': str(dtype), 'batch_sizes': list(batch_sizes), 'seq_lens': list(seq_lens),
+        'new_tokens': new_tokens, 'warmup': warmup, 'repeats': repeats, 'seed': seed, 'quantize_bits': quantize_bits,
+    }
+    return {'environment': environment(), 'settings': settings, 'memory': memory, 'results': results}
+
+
+def result_key(result):
+    return result['name'] + '[' + ','.join(f'{key}={value}' for key, value in sorted(result['params'].items())) + ']'
+
+
+def compare(baseline, current, threshold=0.05):
+    """
+    :param dict baseline: output of run(), e.g. loaded from json
+    :param float threshold: relative throughput drop counted as a regression
+    :return list: per benchmark key baseline / current throughput, relative change and status
+    """
+    baseline_results = {result_key(result): result for result in baseline['results']}
+    rows = []
+    for result in current['results']:
+        key = result_key(result)
+        if key not in baseline_results:
+            rows.append({'key': key, 'metric': result['metric'], 'baseline': None, 'current': result['value'], 'change': None, 'status': 'new'})
+            continue
+        reference = baseline_results[key]['value']
+        change = result['value'] / reference - 1
+        status = 'regression' if change < -threshold else 'improvement' if change > threshold else 'ok'
+        rows.append({'key': key, 'metric': result['metric'], 'baseline': reference, 'current': result['value'], 'change': change, 'status': status})
+    return rows
+
+
+def format_comparison(rows):
+    lines = [f'{"benchmark":<56} {"metric":<20} {"baseline":>12} {"current":>12} {"change":>8}  status']
+    for row in rows:
+        baseline = f'{row["baseline"]:.2f}' if row['baseline'] is not None else '-'
+        change = f'{row["change"]:+.1%}' if row['change'] is not None else '-'
+        lines.append(f'{row["key"]:<56} {row["metric"]:<20} {baseline:>12} {row["current"]:>12.2f} {change:>8}  {row["status"]}')
+    return '\n'.join(lines)
+
+
+def format_results(report):
+    lines = [f'{"benchmark":<56} {"metric":<20} {"value":>12} {"median ms":>10}']
+    for result in report['results']:
+        lines.append(f'{result_key(result):<56} {result["metric"]:<20} {result["value"]:>12.2f} {result["median_s"] * 1000:>10.2f}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LAMM CPU micro-benchmarks on tiny random-weight models')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmarks and write the results as json')
+    run_parser.add_argument('--config', default='tiny', choices=list(CONFIGS))
+    run_parser.add_argument('--benchmarks', nargs='+', default=None, choices=BENCHMARKS)
+    run_parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4])
+    run_parser.add_argument('--seq-lens', nargs='+', type=int, default=[32, 128])
+    run_parser.add_argument('--new-tokens', type=int, default=16)
+    run_parser.add_argument('--dtype', default=None, help='fp32 (default) or bf16')
+    run_parser.add_argument('--warmup', type=int, default=1)
+    run_parser.add_argument('--repeats', type=int, default=5)
+    run_parser.add_argument('--num-threads', type=int, default=None)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--quantize-bits', type=int, default=None, choices=[8, 4], help='weight-only quantized LLaMA decoder')
+    run_parser.add_argument('--output', default=None, help='json file of the results')
+    compare_parser = subparsers.add_parser('compare', help='compare a run against a baseline run')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.05, help='relative throughput drop counted as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        configure_threads(args.num_threads)
+        report = run(args.config, args.benchmarks, args.batch_sizes, args.seq_lens, args.new_tokens,
+                     args.dtype, args.warmup, args.repeats, args.seed, quantize_bits=args.quantize_bits)
+        print(format_results(report))
+        if args.output:
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f'[!] saved benchmark results to {args.output}')
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    for key in ['config', 'dtype', 'quantize_bits']:
+        if baseline['settings'].get(key) != current['settings'].get(key):
+            print(f'[!] {key} differs: baseline {baseline["settings"].get(key)}, current {current["settings"].get(key)}')
+    if baseline['environment']['num_threads'] != current['environment']['num_threads']:
+        print(f'[!] thread count differs: baseline {baseline["environment"]["num_threads"]}, current {current["environment"]["num_threads"]}')
+    rows = compare(baseline, current, args.threshold)
+    print(format_comparison(rows))
+    regressions = [row['key'] for row in rows if row['status'] == 'regression']
+    if regressions:
+        print(f'[!] {len(regressions)} regression(s) beyond {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,454 @@
+"""Streaming training data for LAMMPEFTModel: tar shards, worker processes and a resumable order.
+
+Training samples (image + conversation json) are packed into tar shards once, so that an
+epoch streams a few hundred large files instead of opening millions of small images:
+
+    python -m model.utils.data_pipeline pack --data-file LAMM_instruct_186k.json --vision-root images/ --output shards/
+
+Worker processes of a torch DataLoader read the shards, decode and preprocess the images
+and tokenize the conversations; finished batches reach the training process through
+shared memory and are pinned for an asynchronous copy to the GPU. Every epoch shuffles the
+shard order from (seed, epoch), ranks and workers take interleaved slices of it, and the
+loader state (epoch, shard / sample cursor of every worker) resumes without repeating or
+skipping a sample:
+
+    loader = TrainLoader(TrainDataset(TarShardSource('shards/'), 'vicuna_7b/', batch_size=8), num_workers=8)
+    for batch in loader:
+        loss, acc = model(batch)
+    torch.save({'loader': loader.state_dict(), ...}, 'ckpt.pt')
+
+InstructionDataset gives random access to the samples for batch samplers, e.g. the
+token-budget batches of sampler.py.
+"""
+import argparse
+import copy
+import io
+import json
+import math
+import os
+import random
+import tarfile
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+
+SHARD_INDEX = 'shards.json'
+
+
+def _sample_record(sample, vision_path, index=None):
+    """the fields of an instruction sample the training step needs; `index` in the data file finds its tokens in a token store"""
+    return {
+        'index': index,
+        'vision_path': vision_path,
+        'conversations': sample['conversations'],
+        'task_type': sample['task_type'] if 'task_type' in sample else 'normal',
+    }
+
+
+def write_tar_shards(samples, vision_root, output_dir, samples_per_shard=1000, seed=0):
+    """pack instruction samples and their images into tar shards, `<key>.json` followed by `<key>.<image ext>`
+
+    Samples are shuffled once before packing so that every shard mixes tasks; the loader shuffles the shard order.
+
+    :param list samples: instruction samples with "image" (relative to vision_root) and "conversations"
+    :return list: shard entries of the index, name and number of samples
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    samples = list(enumerate(samples))
+    random.Random(seed).shuffle(samples)
+    shards, tar, num_written = [], None, 0
+    for index, sample in samples:
+        vision_path = os.path.join(vision_root, sample['image'])
+        if not os.path.isfile(vision_path):
+            print(f'[!] skip sample without image: {vision_path}')
+            continue
+        if tar is None or shards[-1]['num_samples'] == samples_per_shard:
+            if tar is not None:
+                tar.close()
+            shards.append({'name': f'shard-{len(shards):05d}.tar', 'num_samples': 0})
+            tar = tarfile.open(os.path.join(output_dir, shards[-1]['name']), 'w')
+        key = f'{num_written:09d}'
+        record = json.dumps(_sample_record(sample, vision_path, index)).encode('utf-8')
+        info = tarfile.TarInfo(key + '.json')
+        info.size = len(record)
+        tar.addfile(info, io.BytesIO(record))
+        tar.add(vision_path, arcname=key + os.path.splitext(vision_path)[1].lower(), recursive=False)
+        shards[-1]['num_samples'] += 1
+        num_written += 1
+        print(f'[!] packed {num_written}/{len(samples)} samples', end='\r')
+    if tar is not None:
+        tar.close()
+    print()
+    with open(os.path.join(output_dir, SHARD_INDEX), 'w') as f:
+        json.dump({'shards': shards, 'num_samples': num_written}, f, indent=2)
+    return shards
+
+
+def read_tar_shard(path, skip=0):
+    """stream (sample, encoded image) pairs of a tar shard; the members of skipped samples are not read"""
+    with tarfile.open(path, 'r|') as tar:
+        index, sample = -1, None
+        for member in tar:
+            if not member.isfile():
+                continue
+            if member.name.endswith('.json'):
+                index += 1
+                sample = json.load(tar.extractfile(member)) if index >= skip else None
+            elif sample is not None:
+                yield sample, tar.extractfile(member).read()
+                sample = None
+
+
+class TarShardSource:
+    """samples of the tar shards written by `write_tar_shards`
+
+    :param str root: shard directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, SHARD_INDEX)) as f:
+            self.shards = json.load(f)['shards']
+
+    def __len__(self):
+        return len(self.shards)
+
+    def num_samples(self):
+        return sum(shard['num_samples'] for shard in self.shards)
+
+    def shard_samples(self, shard):
+        return self.shards[shard]['num_samples']
+
+    def read(self, shard, skip=0):
+        yield from read_tar_shard(os.path.join(self.root, self.shards[shard]['name']), skip)
+
+
+class JsonSource:
+    """samples of an instruction json with one image file each, split into virtual shards of `shard_size` samples
+
+    :param str data_file: instruction json
+    :param str vision_root: directory the "image" entries are relative to
+    """
+
+    def __init__(self, data_file, vision_root='', shard_size=1000):
+        with open(data_file) as f:
+            self.samples = json.load(f)
+        self.vision_root = vision_root
+        self.shard_size = shard_size
+
+    def __len__(self):
+        return math.ceil(len(self.samples) / self.shard_size)
+
+    def num_samples(self):
+        return len(self.samples)
+
+    def shard_samples(self, shard):
+        return min(self.shard_size, len(self.samples) - shard * self.shard_size)
+
+    def read(self, shard, skip=0):
+        begin = shard * self.shard_size
+        for index, sample in enumerate(self.samples[begin + skip: begin + self.shard_size], start=begin + skip):
+            vision_path = os.path.join(self.vision_root, sample['image'])
+            try:
+                with open(vision_path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                print(f'[!] skip sample: {e}')
+                data = b''
+            yield _sample_record(sample, vision_path, index), data
+
+
+class BatchBuilder:
+    """decodes, preprocesses and tokenizes on the loader workers; the tokenizer is built (and its fast backend checked)
+    once here and pickled to the workers
+
+    :param str tokenizer_path: LLaMA checkpoint directory holding the tokenizer
+    :param str token_store: optional store of token_store.py, read instead of tokenizing
+    :param int num_samples: samples of the data file, checked against the token store when known
+    """
+
+    def __init__(self, tokenizer_path, max_tgt_len=1024, vision_type='image', n_px=224, token_store=None, num_samples=None):
+        from ..PROCESS.image_transform import VisionPreprocessor
+
+        self.tokenizer_path = tokenizer_path
+        self.max_tgt_len = max_tgt_len
+        self.vision_type = vision_type
+        # the CLIP preprocessing of LAMMPEFTModel (see CLIP._transform)
+        self.preprocess = VisionPreprocessor(n_px, resize_mode='squash')
+        self.token_store_path = token_store
+        self.num_samples = num_samples
+        self.tokenizer = None
+        self.token_store = None
+        self.load_tokenizer()
+
+    def load_tokenizer(self):
+        if self.tokenizer is None:
+            from transformers import LlamaTokenizer
+            from .tokenization import TokenizationService
+
+            tokenizer = LlamaTokenizer.from_pretrained(self.tokenizer_path, use_fast=False)
+            tokenizer.pad_token = tokenizer.eos_token
+            tokenizer.padding_side = 'right'
+            self.tokenizer = TokenizationService.from_pretrained(self.tokenizer_path, tokenizer)
+        return self.tokenizer
+
+    def load_token_store(self):
+        if self.token_store is None and self.token_store_path:
+            from .token_store import TokenStore
+
+            token_store = TokenStore(self.token_store_path)             # memory-mapped once per worker
+            # written from the same data file with the same tokenizer and vision type
+            token_store.check_compatible(self.load_tokenizer().slow, self.vision_type, self.num_samples)
+            self.token_store = token_store
+        return self.token_store
+
+    def tokenize(self, samples):
+        """
+        :return tensor, tensor, tensor: input ids, target ids and attention mask as process_batch_instance
+        """
+        from ..openlamm import process_batch_instance
+
+        token_store = self.load_token_store()
+        # shards packed before the token store existed carry no sample index
+        if token_store is not None and all(sample.get('index') is not None for sample in samples):
+            if max(sample['index'] for sample in samples) >= len(token_store):
+                raise ValueError(f'Token store {token_store.root} holds {len(token_store)} samples, '
+                                 f'the shards refer to sample {max(sample["index"] for sample in samples)}')
+            return token_store.batch([sample['index'] for sample in samples], self.max_tgt_len)
+        # build_one_instance strips the vision tag in place
+        conversations = [copy.deepcopy(sample['conversations']) for sample in samples]
+        return process_batch_instance(self.load_tokenizer(), conversations, self.max_tgt_len, self.vision_type)
+
+    def decode(self, data):
+        return self.preprocess.decode_bytes(data)                       # 3 x H x W uint8
+
+    def collate(self, samples, images):
+        """
+        :param list samples: sample records (vision_path, conversations, task_type)
+        :param list images: decoded images of the samples
+        :return dict: training inputs of LAMMPEFTModel.forward
+        """
+        input_ids, target_ids, attention_mask = self.tokenize(samples)
+        return {
+            'vision_type': self.vision_type,
+            'task_type': [sample['task_type'] for sample in samples],
+            'vision_paths': [sample['vision_path'] for sample in samples],
+            'output_texts': [sample['conversations'] for sample in samples],
+            'image_tensors': self.preprocess.batch(images),             # bsz x 3 x 224 x 224
+            'input_ids': input_ids,                                     # bsz x s2
+            'target_ids': target_ids,                                   # bsz x s2
+            'attention_mask': attention_mask,                           # bsz x s2
+        }
+
+
+class InstructionDataset(Dataset):
+    """random access to an instruction json for batch samplers such as sampler.TokenBudgetBatchSampler;
+    pass `collate` as the collate_fn of the DataLoader
+
+    :param str data_file: instruction json
+    :param str vision_root: directory the "image" entries are relative to
+    """
+
+    def __init__(self, data_file, vision_root, tokenizer_path, max_tgt_len=1024, vision_type='image', n_px=224, token_store=None):
+        with open(data_file) as f:
+            self.samples = json.load(f)
+        self.vision_root = vision_root
+        self.builder = BatchBuilder(tokenizer_path, max_tgt_len, vision_type, n_px, token_store, len(self.samples))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        sample = self.samples[index]
+        vision_path = os.path.join(self.vision_root, sample['image'])
+        with open(vision_path, 'rb') as f:
+            image = self.builder.decode(f.read())
+        return _sample_record(sample, vision_path, index), image
+
+    def collate(self, items):
+        return self.builder.collate([sample for sample, _ in items], [image for _, image in items])
+
+
+class TrainDataset(IterableDataset):
+    """batches of preprocessed images and tokenized conversations, built on the DataLoader workers
+
+    :param source: TarShardSource or JsonSource
+    :param str tokenizer_path: LLaMA checkpoint directory holding the tokenizer, loaded once and shared by the workers
+    :param int batch_size: samples per batch, batches never mix workers
+    :param int rank, world_size: data-parallel slice of the shards
+    :param bool drop_last: drop the last incomplete batch of every worker, otherwise fill it with repeated samples
+    :param str token_store: optional pre-tokenized conversations (token_store.py) of the packed data file
+    """
+
+    def __init__(self, source, tokenizer_path, batch_size, max_tgt_len=1024, vision_type='image', n_px=224,
+                 seed=0, rank=0, world_size=1, drop_last=True, token_store=None):
+        self.source = source
+        # tar shards leave out samples without an image, only a json source has the sample count of the data file
+        num_samples = source.num_samples() if isinstance(source, JsonSource) else None
+        self.builder = BatchBuilder(tokenizer_path, max_tgt_len, vision_type, n_px, token_store, num_samples)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.resume_states = None
+
+    def set_epoch(self, epoch, resume_states=None):
+        self.epoch = epoch
+        self.resume_states = resume_states
+
+    def shard_order(self, worker_id=0, num_workers=1, rank=None):
+        """shards read by one worker of a rank (this one by default) in the current epoch"""
+        order = list(range(len(self.source)))
+        random.Random(self.seed + self.epoch).shuffle(order)
+        rank = self.rank if rank is None else rank
+        return order[rank::self.world_size][worker_id::num_workers]
+
+    def worker_batches(self, num_workers=1):
+        """batches of every worker of this rank in the current epoch
+
+        All ranks yield the same number of batches, otherwise DDP waits forever for the rank that ran out: with
+        drop_last the ranks stop at the batch count of the smallest rank, otherwise the smaller ranks repeat samples
+        from the start of their shards, like sampler.TokenBudgetBatchSampler.batches.
+        """
+        rounding = math.floor if self.drop_last else math.ceil
+        rank_batches, samples = [], None
+        for rank in range(self.world_size):
+            worker_samples = [sum(self.source.shard_samples(shard) for shard in self.shard_order(worker_id, num_workers, rank))
+                              for worker_id in range(num_workers)]
+            rank_batches.append(sum(rounding(n / self.batch_size) for n in worker_samples))
+            if rank == self.rank:
+                samples = worker_samples
+        target = min(rank_batches) if self.drop_last else max(rank_batches)
+        batches = [rounding(n / self.batch_size) for n in samples]
+        readers = [worker_id for worker_id in range(num_workers) if samples[worker_id]]
+        if target and not readers:
+            raise ValueError(f'Rank {self.rank} has no samples, the data has {len(self.source)} shards for {self.world_size} ranks')
+        # trim the workers with the most batches, extend the ones with the fewest
+        while sum(batches) > target:
+            batches[max(range(num_workers), key=lambda worker_id: batches[worker_id])] -= 1
+        while sum(batches) < target:
+            batches[min(readers, key=lambda worker_id: batches[worker_id])] += 1
+        return batches
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        shards = self.shard_order(worker_id, num_workers)
+        num_batches = self.worker_batches(num_workers)[worker_id]
+        state = self.resume_states[worker_id] if self.resume_states else {'position': 0, 'offset': 0, 'batches': 0}
+        # the position runs past the last shard when a worker repeats samples to fill its batches
+        position, offset, batch_index = state['position'], state['offset'], state.get('batches', 0)
+
+        samples, images = [], []
+        idle = 0            # shards read in a row without a usable sample
+        while batch_index < num_batches:
+            if idle > len(shards):
+                raise RuntimeError(f'Worker {worker_id} of rank {self.rank} found no readable sample in its shards')
+            idle += 1
+            for sample, data in self.source.read(shards[position % len(shards)], skip=offset):
+                offset += 1
+                try:
+                    images.append(self.builder.decode(data))
+                except Exception as e:
+                    print(f'[!] skip sample {sample["vision_path"]}: {e}')
+                    continue
+                idle = 0
+                samples.append(sample)
+                if len(samples) == self.batch_size:
+                    batch_index += 1
+                    # the cursor after the last sample of the batch, where this worker resumes
+                    yield dict(self.builder.collate(samples, images), _worker=worker_id,
+                               _state={'position': position, 'offset': offset, 'batches': batch_index})
+                    samples, images = [], []
+                    if batch_index == num_batches:
+                        break
+            else:
+                position, offset = position + 1, 0
+
+
+class TrainLoader:
+    """multi-process loader of a TrainDataset with a resumable state
+
+    :param int num_workers: worker processes; the state can only be resumed with the same number
+    :param bool pin_memory: pin the batches for non_blocking copies, default when CUDA is available
+    """
+
+    def __init__(self, dataset, num_workers=8, prefetch_factor=2, pin_memory=None):
+        self.dataset = dataset
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.epoch = 0
+        self.resume_states = None
+        self.worker_states = None
+
+    def __iter__(self):
+        self.dataset.set_epoch(self.epoch, self.resume_states)
+        self.worker_states = copy.deepcopy(self.resume_states) or self.start_states()
+        kwargs = {'prefetch_factor': self.prefetch_factor} if self.num_workers > 0 else {}
+        # batch_size=None: the workers return whole batches, sent through shared memory
+        loader = DataLoader(self.dataset, batch_size=None, num_workers=self.num_workers, pin_memory=self.pin_memory, **kwargs)
+        for batch in loader:
+            self.worker_states[batch.pop('_worker')] = batch.pop('_state')
+            yield batch
+        # a state saved between epochs starts the next one from the beginning
+        self.epoch += 1
+        self.resume_states = None
+        self.worker_states = self.start_states()
+
+    def start_states(self):
+        return [{'position': 0, 'offset': 0, 'batches': 0} for _ in range(max(self.num_workers, 1))]
+
+    def state_dict(self):
+        """epoch and the cursor of every worker after the batches consumed so far"""
+        return {'epoch': self.epoch, 'num_workers': self.num_workers, 'worker_states': copy.deepcopy(self.worker_states)}
+
+    def load_state_dict(self, state):
+        if state['worker_states'] is not None and state['num_workers'] != self.num_workers:
+            raise ValueError(f'Loader state of {state["num_workers"]} workers can not be resumed with {self.num_workers} workers')
+        self.epoch = state['epoch']
+        self.resume_states = state['worker_states']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LAMM training data: pack tar shards or measure the loader')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack_parser = subparsers.add_parser('pack', help='pack an instruction json and its images into tar shards')
+    pack_parser.add_argument('--data-file', required=True)
+    pack_parser.add_argument('--vision-root', default='')
+    pack_parser.add_argument('--output', required=True)
+    pack_parser.add_argument('--samples-per-shard', type=int, default=1000)
+    pack_parser.add_argument('--seed', type=int, default=0)
+    read_parser = subparsers.add_parser('read', help='samples/s of the loader over tar shards or an instruction json')
+    read_parser.add_argument('--shards', help='tar shard directory')
+    read_parser.add_argument('--data-file', help='instruction json, read with --vision-root when no shards are given')
+    read_parser.add_argument('--vision-root', default='')
+    read_parser.add_argument('--tokenizer', required=True, help='LLaMA checkpoint directory')
+    read_parser.add_argument('--batch-size', type=int, default=8)
+    read_parser.add_argument('--num-workers', type=int, default=8)
+    read_parser.add_argument('--max-batches', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        with open(args.data_file) as f:
+            samples = json.load(f)
+        shards = write_tar_shards(samples, args.vision_root, args.output, args.samples_per_shard, args.seed)
+        print(f'[!] wrote {len(shards)} shards to {args.output}')
+        return
+
+    source = TarShardSource(args.shards) if args.shards else JsonSource(args.data_file, args.vision_root)
+    loader = TrainLoader(TrainDataset(source, args.tokenizer, args.batch_size), num_workers=args.num_workers)
+    start, num_samples = time.perf_counter(), 0
+    for index, batch in enumerate(loader):
+        num_samples += len(batch['vision_paths'])
+        if index + 1 == args.max_batches:
+            break
+    elapsed = time.perf_counter() - start
+    print(f'[!] {num_samples} samples in {elapsed:.1f}s: {num_samples / elapsed:.1f} samples/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Offline store of frozen vision encoder features for training.
+
+Features are written once into a memory-mapped fp16 array (features.npy,
+N x tokens x C) with an index from vision path to row (index.json), so that
+training steps skip image loading and the CLIP forward:
+
+    python -m model.utils.feature_store --encoder-ckpt ViT-L-14.pt \
+        --data-file LAMM_instruct_186k.json --vision-root images/ --output clip_features/
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+
+class VisionFeatureStore:
+    """read-only access to a feature store written by `build_feature_store`
+
+    :param str root: store directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.features = np.load(os.path.join(root, 'features.npy'), mmap_mode='r')     # N x tokens x C
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def contains_all(self, paths):
+        return all(path in self.index for path in paths)
+
+    def get(self, paths):
+        """
+        :param list paths: vision paths of the batch
+        :return tensor: bsz x tokens x C fp16 features
+        """
+        rows = [self.index[path] for path in paths]
+        return torch.from_numpy(self.features[rows])           # fancy indexing copies the rows out of the memmap
+
+    def check_compatible(self, feature_type, feature_layer, num_tokens, tome_ratio=0):
+        """the stored features must come from the encoder configuration of the model
+
+        Stores written before these settings were recorded hold features of the default encoder (no token merging).
+        The fast path computes the same features (see CLIP.model.compare_fast_path) and is not checked.
+        Token compression runs on the stored features, the store must hold uncompressed patch tokens.
+        """
+        meta = self.meta
+        if meta['feature_type'] != feature_type or meta['feature_layer'] != feature_layer:
+            raise ValueError(f'Feature store {self.root} holds {meta["feature_type"]} features of layer {meta["feature_layer"]}, '
+                             f'model expects {feature_type} features of layer {feature_layer}')
+        if feature_type == 'local' and self.features.shape[1] < num_tokens:
+            raise ValueError(f'Feature store {self.root} holds {self.features.shape[1]} tokens per sample, model expects {num_tokens}')
+        if meta.get('tome_ratio', 0) != tome_ratio:
+            raise ValueError(f'Feature store {self.root} was encoded with token merging ratio {meta.get("tome_ratio", 0)}, '
+                             f'model uses {tome_ratio}')
+        if meta.get('token_compression', 'none') != 'none':
+            raise ValueError(f'Feature store {self.root} holds {meta["token_compression"]} compressed tokens, '
+                             f'the model compresses the encoder features itself')
+
+
+@torch.no_grad()
+def build_feature_store(encode_fn, image_pipeline, image_paths, root, batch_size=64, device='cpu', meta=None):
+    """encode every unique image once and write the feature store
+
+    :param callable encode_fn: bsz x 3 x 224 x 224 images -> bsz x C or bsz x tokens x C features
+    :param ImagePipeline image_pipeline: decodes the next batches while the current one is encoded
+    :param list image_paths: image paths, duplicates are stored once
+    :param str root: output directory
+    :param dict meta: feature_type / feature_layer / encoder of the features, checked when training loads the store
+    :return VisionFeatureStore: the written store
+    """
+    image_paths = list(dict.fromkeys(image_paths))
+    if not image_paths:
+        raise ValueError('No image paths to encode, the feature store would be empty')
+    os.makedirs(root, exist_ok=True)
+    batches = [image_paths[i: i + batch_size] for i in range(0, len(image_paths), batch_size)]
+
+    features, row = None, 0
+    for paths, images in image_pipeline.prefetch(batches, device=device):
+        embeddings = encode_fn(images)
+        if embeddings.dim() == 2:
+            embeddings = embeddings.unsqueeze(1)                    # global features: bsz x 1 x C
+        if features is None:
+            features = open_memmap(os.path.join(root, 'features.npy'), mode='w+', dtype=np.float16,
+                                   shape=(len(image_paths),) + tuple(embeddings.shape[1:]))
+        features[row: row + len(paths)] = embeddings.to(torch.float16).cpu().numpy()
+        row += len(paths)
+        print(f'[!] encoded {row}/{len(image_paths)} images', end='\r')
+    features.flush()
+    print()
+
+    with open(os.path.join(root, 'index.json'), 'w') as f:
+        json.dump({path: i for i, path in enumerate(image_paths)}, f)
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump(dict(meta or {}, num_samples=len(image_paths), shape=list(features.shape)), f)
+    return VisionFeatureStore(root)
+
+
+def main():
+    from ..CLIP import load_visual
+    from ..PROCESS.pipeline import ImagePipeline
+
+    parser = argparse.ArgumentParser(description='Precompute CLIP features of a LAMM instruction dataset')
+    parser.add_argument('--encoder-ckpt', required=True, help='CLIP checkpoint or model name')
+    parser.add_argument('--data-file', required=True, help='instruction json with an "image" entry per sample')
+    parser.add_argument('--vision-root', default='', help='directory the "image" entries are relative to')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--vision-feature-type', default='local', choices=['local', 'global'])
+    parser.add_argument('--vision-feature-layer', type=int, default=-1)
+    parser.add_argument('--tome-ratio', type=float, default=0, help='token merging ratio of the model that reads the store')
+    parser.add_argument('--vision-fast-path', action='store_true', help='encode with the batch-first fused attention path')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    visual, preprocess = load_visual(args.encoder_ckpt, device=device)
+    visual.eval()
+    visual.set_token_merging(args.tome_ratio)
+    visual.set_fast_path(args.vision_fast_path)
+    with open(args.data_file) as f:
+        samples = json.load(f)
+    # keys are the paths the training data loader passes as vision_paths
+    image_paths = [os.path.join(args.vision_root, sample['image']) for sample in samples]
+
+    def encode_fn(images):
+        images = images.to(next(visual.parameters()).dtype)
+        if args.vision_feature_type == 'global':
+            return visual(images)
+        return visual.forward_patch_features(images, args.vision_feature_layer)
+
+    meta = {
+        'encoder': args.encoder_ckpt,
+        'feature_type': args.vision_feature_type,
+        'feature_layer': args.vision_feature_layer,
+        'tome_ratio': args.tome_ratio,
+        'token_compression': 'none',        # patch tokens before VisionTokenCompressor
+    }
+    build_feature_store(encode_fn, ImagePipeline(preprocess, num_workers=args.num_workers), image_paths, args.output,
+                        batch_size=args.batch_size, device=device, meta=meta)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Layer streaming: run the LLaMA decoder with only a few decoder layers resident in memory.
+
+The embeddings, final norm and lm_head stay loaded; the weights of each decoder layer
+stay in the memory-mapped inference snapshot (see snapshot.py) and are copied in right
+before the layer runs, while a background thread already reads the next layer. At most
+`max_resident_layers` layers (including the one being prefetched) hold memory, the
+least recently used layer is dropped first. Every forward reads all layer weights once,
+so streaming suits batch jobs where a large batch shares each read. Streaming runs on
+CPU only: the layers are paged into CPU memory and their parameters return to the meta
+device when evicted, so the model can not be moved to a GPU. The streamed weights keep
+their unfused names, so the fused QKV / gate-up projections are not available either:
+
+    LAMMPEFTModel(snapshot_path='lamm_snapshot/', stream_layers=2)
+"""
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class LayerStreamer:
+    """pages the decoder layers of a LlamaModel in and out, driven by `LlamaModel.forward`
+
+    :param layers: decoder layers, their parameters start on the meta device
+    :param list layer_state_dicts: per layer, parameter name -> (memory-mapped) tensor
+    :param int max_resident_layers: layers holding weights at once; prefetch needs at least 2
+    :param dtype_source: module whose weight dtype the streamed weights are cast to, follows later .to(dtype)
+    """
+
+    def __init__(self, layers, layer_state_dicts, max_resident_layers=2, dtype_source=None):
+        assert max_resident_layers >= 1, 'at least one decoder layer must be resident'
+        self.layers = layers
+        self.layer_state_dicts = layer_state_dicts
+        self.max_resident_layers = max_resident_layers
+        self.dtype_source = dtype_source
+        self.resident = OrderedDict()       # layer index -> None, least recently used first
+        self.pending = {}                   # layer index -> future of the prefetched weights
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='layer-stream') if max_resident_layers > 1 else None
+        self.stats = {'loads': 0, 'prefetch_hits': 0, 'wait_time': 0.0}
+
+    def _read(self, index):
+        """copy the weights of a layer out of the mapping, page faults (disk reads) happen here"""
+        dtype = self.dtype_source.weight.dtype if self.dtype_source is not None else None
+        return {name: tensor.to(dtype) if dtype is not None and tensor.dtype != dtype else tensor.clone()
+                for name, tensor in self.layer_state_dicts[index].items()}
+
+    def _evict(self, index):
+        for param in self.layers[index].parameters():
+            param.data = torch.empty_like(param.data, device='meta')
+        del self.resident[index]
+
+    def _make_room(self, keep):
+        while len(self.resident) + len(self.pending) >= self.max_resident_layers:
+            victim = next((index for index in self.resident if index != keep), None)
+            if victim is None:
+                return False
+            self._evict(victim)
+        return True
+
+    def load(self, index):
+        """make layer `index` resident and start reading the next one"""
+        if index in self.resident:
+            self.resident.move_to_end(index)
+        else:
+            start = time.perf_counter()
+            if index in self.pending:
+                tensors = self.pending.pop(index).result()
+                self.stats['prefetch_hits'] += 1
+            else:
+                self._make_room(keep=None)
+                tensors = self._read(index)
+            self.stats['wait_time'] += time.perf_counter() - start
+            for name, param in self.layers[index].named_parameters():
+                param.data = tensors[name]
+            self.resident[index] = None
+            self.stats['loads'] += 1
+        self.prefetch((index + 1) % len(self.layers), current=index)
+
+    def prefetch(self, index, current=None):
+        if self.executor is None or index in self.resident or index in self.pending:
+            return
+        if self._make_room(keep=current):
+            self.pending[index] = self.executor.submit(self._read, index)
+
+    def release(self):
+        """drop all streamed weights, e.g. between batch jobs"""
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        for index in list(self.resident):
+            self._evict(index)
+
+
+def stream_llama_layers(model, layer_state_dicts, max_resident_layers=2):
+    """switch a LlamaForCausalLM (decoder layers on the meta device) to layer streaming
+
+    :return LayerStreamer: also reachable as model.model.layer_streamer
+    """
+    decoder = model.model
+    assert len(layer_state_dicts) == len(decoder.layers), 'one state dict per decoder layer is required'
+    decoder.layer_streamer = LayerStreamer(decoder.layers, layer_state_dicts, max_resident_layers, dtype_source=decoder.embed_tokens)
+    return decoder.layer_streamer
@@ -0,0 +1,315 @@
+"""Memory accounting of a LAMMPEFTModel: weights, KV caches, cached modality embeddings and sessions.
+
+Weights are counted once per tensor (tied and shared tensors once, streamed layers on
+the meta device not at all). While a generate call runs, a hook on the LLaMA decoder
+keeps the size of its live KV cache; every request records the peak memory above its
+start through prefill and through the whole request (CUDA allocator statistics on GPU,
+the process peak RSS on Linux CPU hosts) next to its prefill and decode latency.
+Sessions of the demo report the modality embeddings and history they hold:
+
+    memory = model.enable_memory_accounting(metrics_path='metrics.jsonl')
+    model.generate(inputs)
+    memory.update_session(session_id, modality_cache, history)
+    print(memory.format_report())
+    memory.sessions_that_fit(seq_len=1024)
+"""
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+
+_MIB = 1024 ** 2
+
+
+def _mib(value):
+    return f'{value / _MIB:.1f} MiB' if value is not None else '-'
+
+
+def tensor_bytes(tensors, seen=None):
+    """bytes of `tensors`, each tensor counted once; meta tensors hold no memory
+
+    :param set seen: (data_ptr, numel, dtype) of tensors already counted, shared across calls
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    for tensor in tensors:
+        if not isinstance(tensor, torch.Tensor) or tensor.is_meta:
+            continue
+        key = (tensor.data_ptr(), tensor.numel(), tensor.dtype)
+        if key in seen:
+            continue
+        seen.add(key)
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def nested_tensors(value):
+    """tensors in nested lists / tuples / dicts, e.g. past_key_values or a modality cache"""
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from nested_tensors(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from nested_tensors(item)
+
+
+def weight_bytes(model):
+    """
+    :param model: LAMMPEFTModel
+    :return dict: bytes of the llama (without LoRA), lora, clip, llama_proj and other weights, and their total
+    """
+    seen = set()
+    llama, lora = [], []
+    for name, tensor in list(model.llama_base_model().named_parameters()) + list(model.llama_base_model().named_buffers()):
+        (lora if 'lora_' in name else llama).append(tensor)
+    breakdown = {
+        'lora': tensor_bytes(lora, seen),
+        'llama': tensor_bytes(llama, seen),
+        'clip': tensor_bytes(list(model.visual_encoder.parameters()) + list(model.visual_encoder.buffers()), seen),
+        'llama_proj': tensor_bytes(model.llama_proj.parameters(), seen),
+    }
+    breakdown['other'] = tensor_bytes(list(model.parameters()) + list(model.buffers()), seen)
+    breakdown['total'] = sum(breakdown.values())
+    return breakdown
+
+
+def kv_cache_bytes(past_key_values):
+    """
+    :return int, int, int: bytes of a KV cache, per sequence of its batch, and its length in tokens
+    """
+    if not past_key_values:
+        return 0, 0, 0
+    key = past_key_values[0][0]                                 # bsz x num_heads x seq x head_dim
+    total = tensor_bytes(nested_tensors(past_key_values))
+    return total, total // key.shape[0], key.shape[2]
+
+
+def kv_bytes_per_token(llama):
+    """KV cache bytes of one token of one sequence, for the heads held by this rank"""
+    total = 0
+    for layer in llama.model.layers:
+        attention = layer.self_attn
+        total += 2 * attention.num_heads * attention.head_dim
+    return total * llama.model.embed_tokens.weight.element_size()
+
+
+def _proc_status(field):
+    """bytes of a /proc/self/status field (VmRSS, VmHWM), None off Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _available_bytes(device):
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemoryTracker:
+    """
+    Every generate call runs on one thread (e.g. a Gradio worker), its record is kept per thread so that overlapping
+    requests do not mix their prefill and decode figures. Memory peaks are process-wide: the peak of a request that
+    overlaps others (`concurrent_requests` > 0) includes their memory as well.
+
+    :param model: LAMMPEFTModel
+    :param str metrics_path: jsonl file, one line of latency and memory figures per request
+    :param int max_records: requests kept in memory for `records`
+    """
+
+    def __init__(self, model, metrics_path=None, max_records=1000):
+        self.model = model
+        self.metrics_path = metrics_path
+        self.records = deque(maxlen=max_records)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.handle = None
+        self.live_kv = {'bytes': 0, 'bytes_per_sequence': 0, 'tokens': 0, 'batch_size': 0}
+        self.active = {}                    # thread id -> record of the request running on that thread
+
+    @property
+    def enabled(self):
+        return self.handle is not None
+
+    def enable(self):
+        if self.handle is None:
+            self.handle = self.model.llama_base_model().model.register_forward_hook(self._decoder_hook)
+        return self
+
+    def disable(self):
+        if self.handle is not None:
+            self.handle.remove()
+            self.handle = None
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def _memory_now(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.memory_allocated(self.device)
+        return _proc_status('VmRSS')
+
+    def _reset_peak(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')                                    # resets VmHWM to the current RSS
+        except OSError:
+            pass
+
+    def _peak(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device)
+        return _proc_status('VmHWM')
+
+    def _decoder_hook(self, module, inputs, output):
+        past_key_values = getattr(output, 'past_key_values', None)
+        if past_key_values is None and isinstance(output, tuple) and len(output) > 1:
+            past_key_values = output[1]
+        total, per_sequence, tokens = kv_cache_bytes(past_key_values)
+        self.live_kv = {'bytes': total, 'bytes_per_sequence': per_sequence, 'tokens': tokens,
+                        'batch_size': past_key_values[0][0].shape[0] if past_key_values else 0}
+        record = self.active.get(threading.get_ident())
+        if record is None:
+            return
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        if record['prefill_s'] is None:
+            # the first decoder forward of a request runs over the whole prompt; image encoding is included
+            record['prefill_s'] = time.perf_counter() - record['start']
+            record['prefill_tokens'] = tokens
+            record['prefill_peak_bytes'] = self._above(self._peak(), record['start_bytes'])
+        else:
+            record['decode_steps'] += 1
+        record['kv_cache_bytes'] = max(record['kv_cache_bytes'], total)
+        record['kv_cache_bytes_per_sequence'] = max(record['kv_cache_bytes_per_sequence'], per_sequence)
+
+    @staticmethod
+    def _above(value, start):
+        return value - start if value is not None and start is not None else None
+
+    @contextmanager
+    def request(self, request_id=None):
+        """record the latency and memory figures of one generate call, run on the calling thread"""
+        thread_id = threading.get_ident()
+        with self.lock:
+            concurrent_requests = len(self.active)
+            if not concurrent_requests:
+                self._reset_peak()                              # would drop the peak of the requests in flight
+        record = {
+            'request_id': request_id, 'time': time.time(), 'start': time.perf_counter(), 'start_bytes': self._memory_now(),
+            'prefill_s': None, 'prefill_tokens': 0, 'prefill_peak_bytes': None, 'decode_steps': 0,
+            'kv_cache_bytes': 0, 'kv_cache_bytes_per_sequence': 0, 'concurrent_requests': concurrent_requests,
+        }
+        with self.lock:
+            self.active[thread_id] = record
+        try:
+            yield record
+        finally:
+            with self.lock:
+                del self.active[thread_id]
+                if not self.active:
+                    self.live_kv = {'bytes': 0, 'bytes_per_sequence': 0, 'tokens': 0, 'batch_size': 0}
+            record['total_s'] = time.perf_counter() - record.pop('start')
+            if record['prefill_s'] is not None:
+                record['decode_s'] = record['total_s'] - record['prefill_s']
+            record['request_peak_bytes'] = self._above(self._peak(), record['start_bytes'])
+            with self.lock:
+                self.records.append(record)
+                if self.metrics_path:
+                    with open(self.metrics_path, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+
+    def update_session(self, session_id, modality_cache=None, history=None):
+        """account the modality embeddings and chat history a session holds"""
+        embedding_bytes = tensor_bytes(nested_tensors(modality_cache or []))
+        history_bytes = sum(len(str(text).encode('utf-8')) for turn in (history or []) for text in turn)
+        with self.lock:
+            self.sessions[session_id] = {'modality_cache_bytes': embedding_bytes, 'history_bytes': history_bytes, 'last_seen': time.time()}
+
+    def end_session(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def prune_sessions(self, max_idle_s):
+        """forget sessions idle for more than `max_idle_s` seconds, e.g. closed browser tabs"""
+        deadline = time.time() - max_idle_s
+        with self.lock:
+            for session_id in [key for key, session in self.sessions.items() if session['last_seen'] < deadline]:
+                del self.sessions[session_id]
+
+    def session_bytes(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {
+            'sessions': len(sessions),
+            'modality_cache_bytes': sum(session['modality_cache_bytes'] for session in sessions),
+            'history_bytes': sum(session['history_bytes'] for session in sessions),
+        }
+
+    def sessions_that_fit(self, seq_len, available_bytes=None):
+        """sessions that fit in the free memory: a KV cache of `seq_len` tokens and the average cached embeddings each
+
+        :param int available_bytes: defaults to the free device memory (MemAvailable on CPU)
+        """
+        available_bytes = _available_bytes(self.device) if available_bytes is None else available_bytes
+        if available_bytes is None:
+            return None
+        sessions = self.session_bytes()
+        per_session = kv_bytes_per_token(self.model.llama_base_model()) * seq_len
+        if sessions['sessions']:
+            per_session += (sessions['modality_cache_bytes'] + sessions['history_bytes']) // sessions['sessions']
+        return available_bytes // per_session
+
+    def report(self):
+        """
+        :return dict: weights, live KV cache, sessions, the last request and the current / available memory, in bytes
+        """
+        with self.lock:
+            last_request = dict(self.records[-1]) if self.records else None
+        return {
+            'weights': weight_bytes(self.model),
+            'kv_bytes_per_token': kv_bytes_per_token(self.model.llama_base_model()),
+            'live_kv_cache': dict(self.live_kv),
+            'sessions': self.session_bytes(),
+            'last_request': last_request,
+            'device': str(self.device),
+            'memory_bytes': self._memory_now(),
+            'available_bytes': _available_bytes(self.device),
+        }
+
+    def format_report(self):
+        report = self.report()
+        lines = ['weights: ' + ', '.join(f'{name} {_mib(value)}' for name, value in report['weights'].items())]
+        live = report['live_kv_cache']
+        lines.append(f'kv cache: {_mib(report["kv_bytes_per_token"] * 1024)} per 1k tokens per sequence; '
+                     f'live {_mib(live["bytes"])} ({live["batch_size"]} x {live["tokens"]} tokens)')
+        sessions = report['sessions']
+        lines.append(f'sessions: {sessions["sessions"]}, modality cache {_mib(sessions["modality_cache_bytes"])}, '
+                     f'history {_mib(sessions["history_bytes"])}')
+        request = report['last_request']
+        if request is not None:
+            lines.append(f'last request: prefill {request["prefill_tokens"]} tokens, peak +{_mib(request["prefill_peak_bytes"])}; '
+                         f'request peak +{_mib(request["request_peak_bytes"])}, kv cache {_mib(request["kv_cache_bytes"])}')
+        lines.append(f'{report["device"]}: in use {_mib(report["memory_bytes"])}, available {_mib(report["available_bytes"])}')
+        return '\n'.join(lines)
@@ -0,0 +1,83 @@
+"""Sequence packing for instruction tuning.
+
+The rows of a training batch (bos, header, image tokens and conversation, right padded)
+are compacted and packed first-fit-decreasing into fewer rows, so that short LAMM
+conversations share a row instead of being padded to the longest one. Every packed
+conversation keeps its own attention: a segment id per token (1, 2, ... within a row,
+0 for padding) is passed to LlamaModel as `segment_ids` and expanded to a block-diagonal
+causal mask, and the position ids restart at 0 for every conversation. The prefix
+targets of every conversation are -100, so no loss crosses a conversation boundary.
+"""
+import torch
+
+
+def first_fit_decreasing(lengths, capacity):
+    """
+    :param list lengths: length of every sequence
+    :param int capacity: maximum tokens per bin; longer sequences get a bin of their own
+    :return list: bins as lists of sequence indices, fullest first
+    """
+    bins, free = [], []
+    for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = lengths[index]
+        target = next((b for b, space in enumerate(free) if space >= length), None)
+        if target is None:
+            bins.append([index])
+            free.append(capacity - length)
+        else:
+            bins[target].append(index)
+            free[target] -= length
+    return bins
+
+
+def padding_efficiency(attention_mask):
+    """share of the positions of a batch that hold tokens"""
+    return (attention_mask != 0).sum().item() / max(attention_mask.numel(), 1)
+
+
+def pack_sequences(inputs_embeds, targets, attention_mask, max_len=None):
+    """pack the rows of a right-padded (or middle-padded) batch
+
+    :param tensor inputs_embeds: bsz x s x embed_dim
+    :param tensor targets: bsz x s, -100 where no loss is taken
+    :param tensor attention_mask: bsz x s, 1 for tokens
+    :param int max_len: tokens per packed row, defaults to the unpacked length s
+    :return tensor, tensor, tensor, tensor, dict: packed embeddings (rows x L x embed_dim), targets (rows x L),
+        segment ids (rows x L), position ids (rows x L) and the padding efficiency before / after packing
+    """
+    keep = attention_mask.bool()
+    lengths = keep.sum(dim=1).tolist()
+    bins = first_fit_decreasing(lengths, max_len or attention_mask.shape[1])
+    row_len = max(sum(lengths[index] for index in bin_) for bin_ in bins)
+    device = inputs_embeds.device
+
+    # destination row / offset of every sequence, in the order its tokens appear in inputs_embeds[keep]
+    rows, starts, segments = [0] * len(lengths), [0] * len(lengths), [0] * len(lengths)
+    for row, bin_ in enumerate(bins):
+        offset = 0
+        for segment, index in enumerate(bin_, start=1):
+            rows[index], starts[index], segments[index] = row, offset, segment
+            offset += lengths[index]
+    lengths_t = torch.tensor(lengths, device=device)
+    first_token = torch.cumsum(lengths_t, dim=0) - lengths_t                          # bsz
+    token_offset = torch.arange(int(lengths_t.sum()), device=device) - torch.repeat_interleave(first_token, lengths_t)
+    destination = torch.repeat_interleave(torch.tensor(rows, device=device) * row_len + torch.tensor(starts, device=device), lengths_t) + token_offset
+
+    num_positions = len(bins) * row_len
+    embed_dim = inputs_embeds.shape[-1]
+    packed_embeds = inputs_embeds.new_zeros(num_positions, embed_dim).index_copy(0, destination, inputs_embeds[keep])
+    packed_targets = targets.new_full((num_positions,), -100).index_copy(0, destination, targets[keep])
+    segment_ids = torch.zeros(num_positions, dtype=torch.long, device=device).index_copy(
+        0, destination, torch.repeat_interleave(torch.tensor(segments, device=device), lengths_t))
+    position_ids = torch.zeros(num_positions, dtype=torch.long, device=device).index_copy(0, destination, token_offset)
+
+    stats = {
+        'sequences': len(lengths),
+        'rows_before': attention_mask.shape[0],
+        'rows_after': len(bins),
+        'tokens': int(lengths_t.sum()),
+        'efficiency_before': padding_efficiency(attention_mask),
+        'efficiency_after': int(lengths_t.sum()) / max(num_positions, 1),
+    }
+    return (packed_embeds.view(len(bins), row_len, embed_dim), packed_targets.view(len(bins), row_len),
+            segment_ids.view(len(bins), row_len), position_ids.view(len(bins), row_len), stats)
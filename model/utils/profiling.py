@@ -0,0 +1,155 @@
+"""Opt-in per-module timing for the LLaMA decoder and the CLIP vision encoder.
+
+Hooks are only attached while the profiler is enabled, so a disabled profiler costs
+nothing. Every request aggregates the self time (time minus instrumented children)
+and the call count per module, per module name and per module class; a sampled
+fraction of requests is also recorded with torch.profiler and exported as a Chrome
+trace (chrome://tracing, Perfetto), with every instrumented module as a labelled range.
+Only calls through `Module.__call__` are seen: the batch-first and token-merging paths
+of the CLIP blocks and VisionTransformer.forward_patch_features are dispatched that way:
+
+    profiler = model.enable_profiling(trace_sample_rate=0.01, trace_dir='traces/')
+    model.generate(inputs)
+    print(profiler.format_report())
+"""
+import os
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+# module classes timed by default; lm_head and llama_proj are matched by name
+DEFAULT_MODULE_TYPES = [
+    'LlamaDecoderLayer', 'LlamaAttention', 'LlamaMLP', 'LlamaRMSNorm',
+    'VisionTransformer', 'ResidualAttentionBlock', 'QuantLinear',
+]
+DEFAULT_MODULE_NAMES = ['lm_head', 'llama_proj']
+
+
+class ModuleProfiler:
+    """
+    :param model: root module, instrumented modules are reported by their name below it
+    :param list module_types: class names to time
+    :param list module_names: last name components to time, e.g. lm_head
+    :param float trace_sample_rate: fraction of requests recorded with torch.profiler
+    :param str trace_dir: directory of the Chrome traces
+    :param bool synchronize: wait for CUDA kernels at module boundaries, needed for GPU timings
+    """
+
+    def __init__(self, model, module_types=None, module_names=None, trace_sample_rate=0.0, trace_dir=None, synchronize=None):
+        self.model = model
+        self.module_types = set(module_types or DEFAULT_MODULE_TYPES)
+        self.module_names = set(module_names or DEFAULT_MODULE_NAMES)
+        self.trace_sample_rate = trace_sample_rate
+        self.trace_dir = trace_dir
+        self.synchronize = torch.cuda.is_available() if synchronize is None else synchronize
+        self.handles = []
+        self.stack = []
+        self.tracing = False
+        self.num_requests = 0
+        self.module_types_of = {}
+        self.reset()
+
+    def reset(self):
+        self.self_time = defaultdict(float)       # module name -> seconds
+        self.calls = defaultdict(int)
+
+    def modules(self):
+        for name, module in self.model.named_modules():
+            if type(module).__name__ in self.module_types or name.split('.')[-1] in self.module_names:
+                yield name, module
+
+    @property
+    def enabled(self):
+        return bool(self.handles)
+
+    def enable(self):
+        if self.enabled:
+            return self
+        for name, module in self.modules():
+            self.module_types_of[name] = type(module).__name__
+            self.handles.append(module.register_forward_pre_hook(self._make_pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._make_post_hook(name)))
+        return self
+
+    def disable(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.stack = []
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _make_pre_hook(self, name):
+        def pre_hook(module, inputs):
+            label = torch.autograd.profiler.record_function(name) if self.tracing else None
+            if label is not None:
+                label.__enter__()
+            self.stack.append([name, self._now(), 0.0, label])      # name, start, time of instrumented children, trace range
+        return pre_hook
+
+    def _make_post_hook(self, name):
+        def post_hook(module, inputs, output):
+            end = self._now()
+            if not self.stack or self.stack[-1][0] != name:
+                return                                              # hooks attached in the middle of a forward
+            _, start, children, label = self.stack.pop()
+            if label is not None:
+                label.__exit__(None, None, None)
+            elapsed = end - start
+            self.self_time[name] += elapsed - children
+            self.calls[name] += 1
+            if self.stack:
+                self.stack[-1][2] += elapsed
+        return post_hook
+
+    @contextmanager
+    def request(self, request_id=None, reset=True):
+        """aggregate one request (or keep summing over requests with reset=False), traced with torch.profiler
+        for a sampled fraction of requests"""
+        self.num_requests += 1
+        self.stack = []
+        if reset:
+            self.reset()
+        trace = self.trace_dir is not None and random.random() < self.trace_sample_rate
+        if not trace:
+            yield self
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.tracing = True
+        try:
+            with torch.profiler.profile(activities=activities) as prof:
+                yield self
+        finally:
+            self.tracing = False
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f'trace_{request_id if request_id is not None else self.num_requests}.json')
+        prof.export_chrome_trace(path)
+        print(f'[!] saved profiler trace to {path}')
+
+    def report(self, by='type'):
+        """
+        :param str by: 'type' to sum over module classes, 'name' for every module
+        :return list: dicts with key, self time (s), calls and share of the total, slowest first
+        """
+        totals, calls = defaultdict(float), defaultdict(int)
+        for name, seconds in self.self_time.items():
+            key = name if by == 'name' else (name.split('.')[-1] if name.split('.')[-1] in self.module_names else self.module_types_of[name])
+            totals[key] += seconds
+            calls[key] += self.calls[name]
+        total = sum(totals.values()) or 1.0
+        return [{'key': key, 'self_time': seconds, 'calls': calls[key], 'share': seconds / total}
+                for key, seconds in sorted(totals.items(), key=lambda item: -item[1])]
+
+    def format_report(self, by='type', top=20):
+        lines = [f'{"module":<48} {"self ms":>10} {"calls":>8} {"share":>7}']
+        for row in self.report(by)[:top]:
+            lines.append(f'{row["key"]:<48} {row["self_time"] * 1000:>10.2f} {row["calls"]:>8d} {row["share"]:>7.1%}')
+        return '\n'.join(lines)
@@ -0,0 +1,227 @@
+"""Weight-only int8 / int4 quantization of the LLaMA decoder for inference.
+
+Linear layers of the decoder and lm_head keep their weights as int8 (per output
+channel scales) or packed int4 (per group scales) and dequantize block by block
+inside the matmul, so decoding reads 2x / 4x fewer weight bytes than fp16.
+Conversion is calibration-free; LoRA deltas are merged before quantizing:
+
+    python -m model.utils.quantization --vicuna-ckpt-path vicuna_7b/ \
+        --delta-ckpt-path lamm_7b_lora32_186k/pytorch_model.pt --lora-r 32 --lora-alpha 32 \
+        --bits 4 --output llama_int4.pt
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANTIZATION_BITS = [8, 4]
+CHECKPOINT_FORMAT = 'lamm-llama-weight-only'
+
+
+def quantize_weight(weight, bits=8, group_size=128):
+    """symmetric weight-only quantization
+
+    :param tensor weight: out_features x in_features
+    :param int bits: 8 for per-channel int8, 4 for group-wise int4
+    :param int group_size: input features sharing one scale for int4
+    :return tensor, tensor: int8 weight (out x in) or uint8 with two int4 per byte (out x in/2), fp16 scales (out x 1 or out x in/group_size)
+    """
+    weight = weight.float()
+    if bits == 8:
+        scales = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        qweight = torch.round(weight / scales).clamp(-127, 127).to(torch.int8)
+        return qweight, scales.half()
+    out_features, in_features = weight.shape
+    grouped = weight.reshape(out_features, in_features // group_size, group_size)
+    scales = grouped.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 7
+    q = (torch.round(grouped / scales).clamp(-8, 7) + 8).to(torch.uint8).reshape(out_features, in_features)
+    qweight = q[:, 0::2] | (q[:, 1::2] << 4)
+    return qweight, scales.squeeze(-1).half()
+
+
+class QuantLinear(nn.Module):
+    """bias-free linear layer with int8 / int4 weights, dequantized per block of output rows on the fly
+
+    :param int bits: 8 or 4
+    :param int group_size: input features sharing one scale for int4
+    :param int block_size: output rows dequantized at once, bounds the temporary fp weight to block_size x in_features
+        (1 MB in fp32 for 64 x 4096); the block stays in cache from dequantization to the matmul, so only the
+        int weights are read from memory. Larger blocks spill to memory and decode slower than fp32 weights
+    """
+
+    def __init__(self, in_features, out_features, bits=8, group_size=128, block_size=64, device=None):
+        super().__init__()
+        assert bits in QUANTIZATION_BITS, f'{bits}-bit quantization not implemented'
+        assert bits == 8 or in_features % group_size == 0, f'in_features {in_features} is not a multiple of group_size {group_size}'
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.block_size = block_size
+        if bits == 8:
+            qweight = torch.empty(out_features, in_features, dtype=torch.int8, device=device)
+            scales = torch.empty(out_features, 1, dtype=torch.float16, device=device)
+        else:
+            qweight = torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device)
+            scales = torch.empty(out_features, in_features // group_size, dtype=torch.float16, device=device)
+        self.register_buffer('qweight', qweight)
+        self.register_buffer('scales', scales)
+
+    @classmethod
+    @torch.no_grad()
+    def from_weight(cls, weight, bits=8, group_size=128, block_size=64):
+        out_features, in_features = weight.shape
+        if bits == 4 and in_features % group_size != 0:
+            print(f'[!] in_features {in_features} is not a multiple of group_size {group_size}, quantize to int8 instead')
+            bits = 8
+        layer = cls(in_features, out_features, bits, group_size, block_size, device=weight.device)
+        layer.qweight, layer.scales = quantize_weight(weight, bits, group_size)
+        return layer
+
+    def dequantize(self, start=0, end=None, dtype=torch.float32):
+        """fp weight of output rows [start, end)"""
+        qweight, scales = self.qweight[start:end], self.scales[start:end].to(dtype)
+        if self.bits == 8:
+            return qweight.to(dtype) * scales
+        rows = qweight.shape[0]
+        q = torch.stack([qweight & 0x0F, qweight >> 4], dim=-1).reshape(rows, -1, self.group_size)
+        return ((q.to(dtype) - 8) * scales.unsqueeze(-1)).reshape(rows, self.in_features)
+
+    def _block(self, x, start, end):
+        if self.bits == 8:
+            # per-channel scales apply to the output columns, the weight block is only converted
+            return F.linear(x, self.qweight[start:end].to(x.dtype)) * self.scales[start:end, 0].to(x.dtype)
+        return F.linear(x, self.dequantize(start, end, dtype=x.dtype))
+
+    def forward(self, x):
+        if self.out_features <= self.block_size:
+            return self._block(x, 0, self.out_features)
+        return torch.cat([
+            self._block(x, start, start + self.block_size)
+            for start in range(0, self.out_features, self.block_size)
+        ], dim=-1)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}'
+
+
+def quantizable_linears(model):
+    """names of the linear layers of the decoder layers and lm_head of a LlamaForCausalLM
+
+    The lora_A / lora_B linears inside peft LoRA layers are skipped: they are merged into their parent projection,
+    which is quantized (and replaced) as a whole.
+    """
+    return [name for name, module in model.named_modules()
+            if isinstance(module, nn.Linear) and (name.startswith('model.layers.') or name == 'lm_head')
+            and '.lora_' not in name]
+
+
+@torch.no_grad()
+def quantize_model(model, bits=8, group_size=128, block_size=64, empty=False):
+    """replace the decoder linear layers and lm_head of a LlamaForCausalLM by QuantLinear, in place
+
+    Peft LoRA layers are merged into their weights first and dropped, the adapters do not survive quantization.
+
+    :param bool empty: only swap in uninitialized QuantLinear layers, used to load a quantized checkpoint
+    :return model: the quantized model
+    """
+    from ..modeling_llama import merged_linear_weight
+
+    for name in quantizable_linears(model):
+        parent_name, _, child_name = name.rpartition('.')
+        parent = model.get_submodule(parent_name) if parent_name else model
+        linear = getattr(parent, child_name)
+        if empty:
+            layer_bits = bits if bits == 8 or linear.in_features % group_size == 0 else 8
+            quantized = QuantLinear(linear.in_features, linear.out_features, layer_bits, group_size, block_size, device=linear.weight.device)
+        else:
+            quantized = QuantLinear.from_weight(merged_linear_weight(linear), bits, group_size, block_size)
+        setattr(parent, child_name, quantized)
+    return model
+
+
+@torch.no_grad()
+def merge_lora_delta(model, delta_state_dict, lora_r, lora_alpha):
+    """merge the LoRA weights of a LAMM delta checkpoint into a plain LlamaForCausalLM
+
+    :param dict delta_state_dict: keys like llama_model.base_model.model.model.layers.0.self_attn.q_proj.lora_A[.default].weight
+    :return int: number of merged layers
+    """
+    scaling = lora_alpha / lora_r
+    merged = 0
+    for key, lora_A in delta_state_dict.items():
+        if '.lora_A.' not in key or 'base_model.model.' not in key:
+            continue
+        name = key.split('base_model.model.', 1)[1].split('.lora_A.')[0]
+        lora_B = delta_state_dict[key.replace('.lora_A.', '.lora_B.')]
+        linear = model.get_submodule(name)
+        delta = (lora_B.float() @ lora_A.float()) * scaling
+        linear.weight.add_(delta.to(device=linear.weight.device, dtype=linear.weight.dtype))
+        merged += 1
+    return merged
+
+
+def save_quantized(model, path):
+    """save a quantized LlamaForCausalLM with its config, load it back with `load_quantized`"""
+    layer = next(module for module in model.modules() if isinstance(module, QuantLinear))
+    torch.save({
+        'format': CHECKPOINT_FORMAT,
+        'bits': layer.bits,
+        'group_size': layer.group_size,
+        'config': model.config.to_dict(),
+        'state_dict': model.state_dict(),
+    }, path)
+
+
+def load_quantized(path, device='cpu', dtype=torch.float32):
+    """build a LlamaForCausalLM from a `save_quantized` checkpoint without materializing fp weights
+
+    :param dtype: dtype of the embeddings and norms, also the compute dtype of the matmuls
+    """
+    from transformers.models.llama.configuration_llama import LlamaConfig
+    from ..modeling_llama import LlamaForCausalLM
+
+    checkpoint = torch.load(path, map_location='cpu')
+    assert checkpoint.get('format') == CHECKPOINT_FORMAT, f'{path} is not a quantized LLaMA checkpoint'
+    config = LlamaConfig.from_dict(checkpoint['config'])
+    if hasattr(nn.Module, 'to_empty') and hasattr(torch.device, '__enter__'):
+        # skip the random init of the fp weights that are replaced anyway
+        with torch.device('meta'):
+            model = LlamaForCausalLM(config)
+        quantize_model(model, checkpoint['bits'], checkpoint['group_size'], empty=True)
+        model = model.to(dtype).to_empty(device=device)
+    else:
+        model = quantize_model(LlamaForCausalLM(config), checkpoint['bits'], checkpoint['group_size'], empty=True)
+        model = model.to(device=device, dtype=dtype)
+    model.load_state_dict(checkpoint['state_dict'])
+    for module in model.modules():
+        if hasattr(module, 'reset_buffers'):
+            module.reset_buffers(device)
+    return model.eval()
+
+
+def main():
+    from ..modeling_llama import load_pretrained_llama, load_state_dict_file
+
+    parser = argparse.ArgumentParser(description='Weight-only quantization of the LAMM LLaMA decoder')
+    parser.add_argument('--vicuna-ckpt-path', required=True)
+    parser.add_argument('--delta-ckpt-path', default=None, help='LAMM delta checkpoint, its LoRA weights are merged before quantizing')
+    parser.add_argument('--lora-r', type=int, default=32)
+    parser.add_argument('--lora-alpha', type=int, default=32)
+    parser.add_argument('--bits', type=int, default=8, choices=QUANTIZATION_BITS)
+    parser.add_argument('--group-size', type=int, default=128)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    model = load_pretrained_llama(args.vicuna_ckpt_path, torch_dtype=torch.float16)
+    if args.delta_ckpt_path:
+        merged = merge_lora_delta(model, load_state_dict_file(args.delta_ckpt_path), args.lora_r, args.lora_alpha)
+        print(f'[!] merged {merged} LoRA layers')
+    quantize_model(model, args.bits, args.group_size)
+    save_quantized(model, args.output)
+    print(f'[!] saved {args.bits}-bit model to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
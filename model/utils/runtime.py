@@ -0,0 +1,59 @@
+"""Device, dtype and thread selection for inference on GPU or CPU."""
+import os
+
+import torch
+
+DTYPES = {
+    'fp32': torch.float32,
+    'float32': torch.float32,
+    'bf16': torch.bfloat16,
+    'bfloat16': torch.bfloat16,
+    'fp16': torch.float16,
+    'float16': torch.float16,
+}
+
+
+def resolve_device(device=None):
+    """`device` as a torch.device, cuda if available when None"""
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def parse_dtype(dtype):
+    """torch.dtype from a torch.dtype or one of DTYPES"""
+    if isinstance(dtype, str):
+        assert dtype in DTYPES, f'dtype [{dtype}] not supported, choose from {list(DTYPES)}'
+        return DTYPES[dtype]
+    return dtype
+
+
+def resolve_dtype(dtype=None, device='cpu'):
+    """
+    :param dtype: torch.dtype or one of DTYPES; fp16 on GPU and fp32 on CPU when None
+    :return torch.dtype: inference dtype, fp16 is rejected on CPU where its matmuls and norms are slow or missing
+    """
+    device = torch.device(device)
+    if dtype is None:
+        return torch.float16 if device.type == 'cuda' else torch.float32
+    dtype = parse_dtype(dtype)
+    if device.type == 'cpu' and dtype == torch.float16:
+        raise ValueError('fp16 inference is not supported on CPU, use bf16 or fp32')
+    return dtype
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    """
+    Set the intra-op (matmul) and inter-op thread pools. Defaults to OMP_NUM_THREADS or the physical cores
+    torch detected; the inter-op pool can only be sized before the first parallel op runs.
+    """
+    if num_threads is None and 'OMP_NUM_THREADS' in os.environ:
+        num_threads = int(os.environ['OMP_NUM_THREADS'])
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            print(f'[!] can not set inter-op threads to {num_interop_threads}: {e}')
+    return torch.get_num_threads(), torch.get_num_interop_threads()
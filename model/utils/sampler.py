@@ -0,0 +1,184 @@
+"""Token-budget batching: batches of similar-length samples under a maximum of padded tokens.
+
+The length of a sample is what it occupies in the LLaMA input: bos, the prompt header,
+the image tokens and its tokenized conversation (cut at max_tgt_len). Lengths are
+computed once and saved:
+
+    python -m model.utils.sampler --data-file LAMM_instruct_186k.json --tokenizer vicuna_7b/ --output lengths.json
+
+Every epoch the indices are shuffled, cut into buckets, sorted by length inside each
+bucket and split into batches whose padded size (batch size x longest sample) stays
+under `max_tokens`; the order of the batches is shuffled again across buckets:
+
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=16384, rank=rank, world_size=world_size)
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=dataset.collate, num_workers=8)
+"""
+import argparse
+import json
+import math
+import random
+
+from torch.utils.data import Sampler
+
+
+def prompt_prefix_length(tokenizer, num_vision_token, system_header=False, vision_type='image', task_type='normal'):
+    """tokens in front of the conversation: bos, the prompt header and the image tokens (see LAMMPEFTModel.prompt_wrap)"""
+    from ..openlamm import make_prompt_start
+    from .tokenization import encode_texts
+
+    header = make_prompt_start(system_header=system_header, vision_type=vision_type, task_type=[task_type])
+    header = header[0] if isinstance(header, list) else header
+    return 1 + len(encode_texts(tokenizer, [header])[0]) + num_vision_token
+
+
+def sample_lengths(samples, tokenizer, num_vision_token=256, max_tgt_len=1024, system_header=False, vision_type='image',
+                   conversation_lengths=None):
+    """
+    :param list samples: instruction samples with "conversations" and optionally "task_type"
+    :param list conversation_lengths: tokens of every conversation if known, e.g. TokenStore.lengths(); tokenized otherwise
+    :return list: LLaMA input length of every sample
+    """
+    import copy
+    from ..openlamm import build_one_instance
+
+    prefix_lengths = {}
+    lengths = []
+    for index, sample in enumerate(samples):
+        task_type = sample['task_type'] if 'task_type' in sample else 'normal'
+        if task_type not in prefix_lengths:
+            prefix_lengths[task_type] = prompt_prefix_length(tokenizer, num_vision_token, system_header, vision_type, task_type)
+        if conversation_lengths is not None:
+            length = int(conversation_lengths[index])
+        else:
+            length = len(build_one_instance(tokenizer, copy.deepcopy(sample['conversations']), vision_type)[1])
+        lengths.append(prefix_lengths[task_type] + min(length, max_tgt_len))
+    return lengths
+
+
+def padding_efficiency(batches, lengths):
+    """share of the padded positions of `batches` that hold tokens"""
+    tokens = sum(lengths[i] for batch in batches for i in batch)
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return tokens / max(padded, 1)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    :param list lengths: token length of every sample
+    :param int max_tokens: budget of padded tokens per batch; a longer sample gets a batch of its own
+    :param int bucket_size: samples sorted together, larger buckets pad less and mix less
+    :param int max_batch_size: optional cap on samples per batch
+    :param int rank, world_size: data-parallel ranks get the same number of batches
+    """
+
+    def __init__(self, lengths, max_tokens, bucket_size=4096, max_batch_size=None, shuffle=True, seed=0,
+                 rank=0, world_size=1, drop_last=False):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def all_batches(self):
+        """batches of every rank in the current epoch"""
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches = []
+        for begin in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[begin: begin + self.bucket_size], key=lambda i: self.lengths[i])
+            batch, longest = [], 0
+            for index in bucket:
+                length = max(longest, self.lengths[index])
+                full = self.max_batch_size is not None and len(batch) == self.max_batch_size
+                if batch and (length * (len(batch) + 1) > self.max_tokens or full):
+                    batches.append(batch)
+                    batch, length = [], self.lengths[index]
+                batch.append(index)
+                longest = length
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def batches(self):
+        """batches of this rank; every rank gets the same count, the last ones repeat from the start unless drop_last"""
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return self._cache[1]
+        batches = self.all_batches()
+        if self.drop_last:
+            num_batches = len(batches) // self.world_size
+        else:
+            num_batches = math.ceil(len(batches) / self.world_size)
+            batches += batches[:num_batches * self.world_size - len(batches)]
+        batches = batches[self.rank::self.world_size][:num_batches]
+        self._cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        yield from self.batches()
+
+    def __len__(self):
+        return len(self.batches())
+
+    def stats(self):
+        """batches, mean / max padded tokens per batch and padding efficiency of this rank in the current epoch"""
+        batches = self.batches()
+        padded = [len(batch) * max(self.lengths[i] for i in batch) for batch in batches]
+        return {
+            'batches': len(batches),
+            'mean_tokens': sum(padded) / max(len(padded), 1),
+            'max_tokens': max(padded, default=0),
+            'padding_efficiency': padding_efficiency(batches, self.lengths),
+        }
+
+
+def main():
+    from .tokenization import TokenizationService
+
+    parser = argparse.ArgumentParser(description='Token lengths of a LAMM instruction dataset for token-budget batching')
+    parser.add_argument('--data-file', required=True)
+    parser.add_argument('--tokenizer', required=True, help='LLaMA checkpoint directory')
+    parser.add_argument('--token-store', default=None, help='conversation lengths from a token_store.py store instead of tokenizing')
+    parser.add_argument('--num-vision-token', type=int, default=256)
+    parser.add_argument('--max-tgt-len', type=int, default=1024)
+    parser.add_argument('--system-header', action='store_true')
+    parser.add_argument('--vision-type', default='image', choices=['image', 'pcl'])
+    parser.add_argument('--max-tokens', type=int, default=None, help='also report the batches of this budget')
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    with open(args.data_file) as f:
+        samples = json.load(f)
+    tokenizer = TokenizationService.from_pretrained(args.tokenizer)
+    conversation_lengths = None
+    if args.token_store:
+        from .token_store import TokenStore
+
+        store = TokenStore(args.token_store)
+        store.check_compatible(tokenizer.slow, args.vision_type, len(samples))
+        conversation_lengths = store.lengths()
+    lengths = sample_lengths(samples, tokenizer, args.num_vision_token, args.max_tgt_len, args.system_header, args.vision_type,
+                             conversation_lengths)
+    with open(args.output, 'w') as f:
+        json.dump(lengths, f)
+    print(f'[!] saved {len(lengths)} sample lengths to {args.output}, mean {sum(lengths) / len(lengths):.1f}, max {max(lengths)}')
+    if args.max_tokens:
+        stats = TokenBudgetBatchSampler(lengths, args.max_tokens).stats()
+        print(f'[!] {stats["batches"]} batches of at most {args.max_tokens} tokens, mean {stats["mean_tokens"]:.0f}, '
+              f'padding efficiency {stats["padding_efficiency"]:.1%}')
+
+
+if __name__ == '__main__':
+    main()
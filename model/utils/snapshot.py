@@ -0,0 +1,267 @@
+"""Inference snapshot: everything LAMMPEFTModel needs to serve, in one memory-mapped file.
+
+    snapshot/
+        model.safetensors   llama.* (LoRA merged), visual.* and llama_proj.* in the serving dtype
+        config.json         LLaMA config
+        snapshot.json       LAMM model args
+        tokenizer.model ... tokenizer files
+
+model.safetensors follows the safetensors layout (8-byte header size, json header with
+dtype / shape / data offsets, raw little-endian data) and is written and mapped here
+without the safetensors package. Tensors are views of the mapped file, so startup reads
+no pickles and pages the weights in when they are first used. Export once after training:
+
+    python -m model.utils.snapshot --vicuna-ckpt-path vicuna_7b/ --encoder-ckpt-path ViT-L-14.pt \
+        --delta-ckpt-path lamm_7b_lora32_186k/pytorch_model.pt --dtype fp16 --output lamm_snapshot/
+
+and serve with LAMMPEFTModel(snapshot_path='lamm_snapshot/').
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+
+import torch
+import torch.nn as nn
+
+SNAPSHOT_TENSORS = 'model.safetensors'
+SNAPSHOT_ARGS = 'snapshot.json'
+
+_DTYPE_NAMES = {
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+_NAME_DTYPES = {name: dtype for dtype, name in _DTYPE_NAMES.items()}
+
+
+def _tensor_bytes(tensor):
+    tensor = tensor.detach().cpu().contiguous().reshape(-1)
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)           # numpy has no bfloat16, the bytes are the same
+    return memoryview(tensor.numpy()).cast('B')
+
+
+def save_tensors(tensors, path, metadata=None):
+    """write tensors in the safetensors layout
+
+    :param dict tensors: name -> tensor
+    :param dict metadata: optional string metadata stored in the header
+    """
+    # larger elements first keeps every tensor aligned to its element size without padding between tensors
+    entries = sorted(tensors.items(), key=lambda item: (-item[1].element_size(), item[0]))
+    header, offset = {}, 0
+    for name, tensor in entries:
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': _DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header['__metadata__'] = {key: str(value) for key, value in metadata.items()}
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, tensor in entries:
+            if tensor.numel():
+                f.write(_tensor_bytes(tensor))
+
+
+def load_tensors(path):
+    """map a safetensors file; the tensors share copy-on-write pages of the file and nothing is read until used
+
+    :return dict, dict: name -> tensor, header metadata
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    metadata = header.pop('__metadata__', {})
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        dtype = _NAME_DTYPES[info['dtype']]
+        begin, end = info['data_offsets']
+        if end == begin:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + begin).reshape(info['shape'])
+    return tensors, metadata
+
+
+def _snapshot_args(args):
+    """LAMM model args worth keeping in a snapshot: json values, without checkpoint paths and device choices"""
+    kept = {}
+    for key, value in args.items():
+        if key.endswith('_path') or key in ['device', 'llama_dtype', 'vision_feature_store']:
+            continue
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        kept[key] = value
+    return kept
+
+
+@torch.no_grad()
+def export_snapshot(model, output_dir, dtype=torch.float16):
+    """write an inference snapshot of a LAMMPEFTModel with its delta checkpoint loaded
+
+    The LoRA deltas are merged into the LLaMA weights. Export before `fuse_llama_projections` / `quantize_llama`,
+    and apply them after loading the snapshot.
+    """
+    from ..modeling_llama import merged_linear_weight
+    from .quantization import QuantLinear
+
+    llama = model.llama_base_model()
+    for module in llama.modules():
+        if isinstance(module, QuantLinear) or getattr(module, 'qkv_proj', None) is not None:
+            raise ValueError('Export the snapshot before fusing or quantizing the LLaMA projections')
+        if hasattr(module, 'lora_A'):
+            merged_linear_weight(module)
+
+    tensors = {}
+    for name, tensor in llama.state_dict().items():
+        if '.lora_' not in name:
+            tensors['llama.' + name] = tensor
+    for name, tensor in model.visual_encoder.state_dict().items():
+        tensors['visual.' + name] = tensor
+    for name, tensor in model.llama_proj.state_dict().items():
+        tensors['llama_proj.' + name] = tensor
+    tensors = {name: tensor.to(dtype) if tensor.is_floating_point() else tensor for name, tensor in tensors.items()}
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_tensors(tensors, os.path.join(output_dir, SNAPSHOT_TENSORS), metadata={'format': 'pt', 'dtype': str(dtype)})
+    llama.config.save_pretrained(output_dir)
+    if getattr(llama, 'generation_config', None) is not None:
+        llama.generation_config.save_pretrained(output_dir)
+    model.llama_tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, SNAPSHOT_ARGS), 'w') as f:
+        json.dump({'args': _snapshot_args(model.args), 'dtype': str(dtype)}, f, indent=2)
+    return output_dir
+
+
+def load_snapshot(snapshot_dir):
+    """
+    :return dict, dict: LAMM model args stored at export, tensors mapped from the snapshot
+    """
+    with open(os.path.join(snapshot_dir, SNAPSHOT_ARGS)) as f:
+        args = json.load(f)['args']
+    tensors, _ = load_tensors(os.path.join(snapshot_dir, SNAPSHOT_TENSORS))
+    return args, tensors
+
+
+def sub_state_dict(tensors, prefix):
+    return {name[len(prefix):]: tensor for name, tensor in tensors.items() if name.startswith(prefix)}
+
+
+@torch.no_grad()
+def llama_from_snapshot(snapshot_dir, tensors, shard=None, stream_layers=None):
+    """LlamaForCausalLM whose parameters are the mapped snapshot tensors when torch supports assigning them
+
+    :param tuple shard: (rank, world_size) to load only the tensor-parallel shard of this rank
+    :param int stream_layers: keep the decoder layers on disk and at most this many in memory, see layer_streaming.py
+    """
+    from transformers.models.llama.configuration_llama import LlamaConfig
+    from ..modeling_llama import LlamaForCausalLM
+    from .layer_streaming import stream_llama_layers
+    from .tensor_parallel import shard_llama, shard_state_dict
+
+    config = LlamaConfig.from_pretrained(snapshot_dir)
+    state_dict = sub_state_dict(tensors, 'llama.')
+    dtype = state_dict['lm_head.weight'].dtype
+    meta_init = hasattr(nn.Module, 'to_empty') and hasattr(torch.device, '__enter__')
+    if stream_layers:
+        if not meta_init or shard is not None:
+            raise ValueError('Layer streaming needs torch >= 2.0 and can not be combined with tensor parallelism')
+        with torch.device('meta'):
+            model = LlamaForCausalLM(config)
+        # only the embeddings, final norm and lm_head are loaded, the decoder layers are paged in as they run
+        for name, param in model.named_parameters():
+            if not name.startswith('model.layers.'):
+                param.data = state_dict[name].clone()
+        stream_llama_layers(model, [sub_state_dict(state_dict, f'model.layers.{i}.') for i in range(config.num_hidden_layers)], stream_layers)
+    elif meta_init:
+        with torch.device('meta'):
+            model = LlamaForCausalLM(config)
+        if shard is not None:
+            # slices are copied out of the mapping, only the pages of this shard are read
+            shard_llama(model, *shard)
+            model = model.to(dtype).to_empty(device='cpu')
+            model.load_state_dict(shard_state_dict(state_dict, *shard))
+        else:
+            try:
+                model.load_state_dict(state_dict, assign=True)      # zero-copy, torch >= 2.1
+            except TypeError:
+                model = model.to(dtype).to_empty(device='cpu')
+                model.load_state_dict(state_dict)
+    else:
+        model = LlamaForCausalLM(config).to(dtype)
+        model.load_state_dict(state_dict)
+        if shard is not None:
+            shard_llama(model, *shard)
+
+    for module in model.modules():
+        if hasattr(module, 'reset_buffers'):
+            module.reset_buffers('cpu')
+    try:
+        from transformers import GenerationConfig
+
+        model.generation_config = GenerationConfig.from_pretrained(snapshot_dir)
+    except (ImportError, OSError):
+        pass
+    return model.eval()
+
+
+def main():
+    from ..openlamm import LAMMPEFTModel
+    from .runtime import parse_dtype
+
+    parser = argparse.ArgumentParser(description='Export a LAMM inference snapshot')
+    parser.add_argument('--vicuna-ckpt-path', required=True)
+    parser.add_argument('--encoder-ckpt-path', required=True)
+    parser.add_argument('--delta-ckpt-path', required=True)
+    parser.add_argument('--lora-r', type=int, default=32)
+    parser.add_argument('--lora-alpha', type=int, default=32)
+    parser.add_argument('--lora-target-modules', nargs='+', default=['q_proj', 'k_proj', 'v_proj', 'o_proj'])
+    parser.add_argument('--vision-feature-type', default='local', choices=['local', 'global'])
+    parser.add_argument('--num-vision-token', type=int, default=256)
+    parser.add_argument('--max-tgt-len', type=int, default=128)
+    parser.add_argument('--dtype', default='fp16')
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    dtype = parse_dtype(args.dtype)
+    model = LAMMPEFTModel(
+        encoder_ckpt_path=args.encoder_ckpt_path,
+        vicuna_ckpt_path=args.vicuna_ckpt_path,
+        encoder_pretrain='clip',
+        stage=2,
+        max_tgt_len=args.max_tgt_len,
+        lora_r=args.lora_r,
+        lora_alpha=args.lora_alpha,
+        lora_dropout=0.0,
+        lora_target_modules=args.lora_target_modules,
+        vision_type='image',
+        vision_feature_type=args.vision_feature_type,
+        num_vision_token=args.num_vision_token,
+        system_header=True,
+        device='cpu',
+        llama_dtype=dtype,
+    )
+    model.load_delta_checkpoint(args.delta_ckpt_path)
+    export_snapshot(model, args.output, dtype=dtype)
+    print(f'[!] saved inference snapshot to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
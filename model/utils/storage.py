@@ -0,0 +1,154 @@
+"""Storage backends for vision inputs: local files, http(s) with pooled connections
+and an on-disk read-through cache, and s3 through a petrel-style client."""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class StorageError(IOError):
+    """Raised when a remote object can not be fetched within the configured limits."""
+
+
+class DiskCache:
+    """read-through cache of remote objects keyed by url, validated by the server ETag
+
+    :param str root: cache directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], key)
+
+    def etag(self, url):
+        """ETag of the cached copy of url, None if not cached"""
+        try:
+            with open(self._path(url) + '.json') as f:
+                return json.load(f)['etag']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def read(self, url):
+        with open(self._path(url), 'rb') as f:
+            return f.read()
+
+    def put(self, url, etag, data):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file and rename, so that concurrent readers never see partial files
+        for target, content in [(path, data), (path + '.json', json.dumps({'url': url, 'etag': etag}).encode('utf-8'))]:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, target)
+
+
+class HTTPStorage:
+    """http(s) fetching over a pooled session with size and time limits
+
+    :param int pool_size: connections kept alive per host, match the number of concurrent fetchers
+    :param float connect_timeout: seconds to establish a connection
+    :param float timeout: seconds for the whole transfer of one object
+    :param int max_bytes: objects larger than this are rejected
+    :param DiskCache cache: optional read-through cache; cached objects are revalidated with If-None-Match
+    """
+
+    def __init__(self, pool_size=16, connect_timeout=5.0, timeout=30.0, max_bytes=64 * 1024 * 1024, retries=2, cache=None):
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=['GET']),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url):
+        etag = self.cache.etag(url) if self.cache is not None else None
+        headers = {'If-None-Match': etag} if etag else {}
+        deadline = time.monotonic() + self.timeout
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=(self.connect_timeout, self.timeout)) as response:
+                if response.status_code == 304 and etag:
+                    return self.cache.read(url)
+                response.raise_for_status()
+                content_length = int(response.headers.get('Content-Length', 0))
+                if content_length > self.max_bytes:
+                    raise StorageError(f'{url} is {content_length} bytes, larger than the limit of {self.max_bytes}')
+                chunks, size = [], 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise StorageError(f'{url} is larger than the limit of {self.max_bytes} bytes')
+                    if time.monotonic() > deadline:
+                        raise StorageError(f'{url} took longer than {self.timeout}s')
+                    chunks.append(chunk)
+                data = b''.join(chunks)
+                if self.cache is not None and response.headers.get('ETag'):
+                    self.cache.put(url, response.headers['ETag'], data)
+                return data
+        except requests.RequestException as e:
+            raise StorageError(f'Can not fetch {url}: {e}') from e
+
+
+class Storage:
+    """dispatch reads by path scheme: local files, http(s):// and s3://
+
+    :param HTTPStorage http: http(s) backend, a pooled one without cache by default
+    :param s3_client: client with a `get(path)` method returning bytes, e.g. petrel_client.client.Client
+    """
+
+    def __init__(self, http=None, s3_client=None, max_workers=16):
+        self.http = http if http is not None else HTTPStorage(pool_size=max_workers)
+        self.s3_client = s3_client
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return self.http.get(path)
+        if path.startswith('s3://'):
+            if self.s3_client is None:
+                raise StorageError(f'No s3 client configured for {path}')
+            return self.s3_client.get(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def get_many(self, paths):
+        """fetch all paths concurrently, in order"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='storage')
+        return list(self._executor.map(self.get, paths))
+
+
+def build_storage(cache_dir=None, s3_client=None, pool_size=16, timeout=30.0, max_bytes=64 * 1024 * 1024):
+    cache = DiskCache(cache_dir) if cache_dir else None
+    return Storage(HTTPStorage(pool_size=pool_size, timeout=timeout, max_bytes=max_bytes, cache=cache), s3_client=s3_client, max_workers=pool_size)
+
+
+_default_storage = None
+
+
+def get_default_storage():
+    """shared pooled storage for http(s) paths when no client is given"""
+    global _default_storage
+    if _default_storage is None:
+        _default_storage = Storage()
+    return _default_storage
@@ -0,0 +1,182 @@
+"""Tensor-parallel LLaMA inference over torch.distributed (gloo on CPU, nccl on GPU).
+
+Every rank holds 1/N of the attention heads (q/k/v rows, o_proj columns), of the MLP
+(gate/up rows, down_proj columns) and of the lm_head vocabulary. The o_proj and
+down_proj outputs are all-reduced and the logits all-gathered, so every rank sees the
+full result and samples the same tokens from the same seed. Embeddings, norms and the
+vision encoder are replicated. Run on local processes or across hosts with torchrun:
+
+    torchrun --nproc_per_node 2 -m model.utils.tensor_parallel --self-test
+    torchrun --nnodes 2 --nproc_per_node 1 --rdzv_endpoint host0:29500 -m model.utils.tensor_parallel \
+        --snapshot lamm_snapshot/ --image images/demo.jpg --prompt "Describe the image."
+"""
+import argparse
+import copy
+import os
+from functools import partial
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+# projections whose output features are split across ranks
+COLUMN_PARALLEL = ['q_proj', 'k_proj', 'v_proj', 'gate_proj', 'up_proj', 'lm_head']
+# projections whose input features are split across ranks, their partial outputs are summed
+ROW_PARALLEL = ['o_proj', 'down_proj']
+
+
+def init_distributed(backend=None):
+    """init the default process group from the torchrun environment (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT)
+
+    :return int, int: rank, world size
+    """
+    if not dist.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+        dist.init_process_group(backend or ('nccl' if torch.cuda.is_available() else 'gloo'))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def shard_dim(name):
+    """dimension of a weight that is split across ranks, None for replicated tensors
+
+    LoRA factors follow their projection: for column-parallel layers lora_B (out x r) is split by rows and
+    lora_A replicated, for row-parallel layers lora_A (r x in) is split by columns and lora_B replicated.
+    """
+    parts = name.split('.')
+    if parts[-1] != 'weight':
+        return None
+    projection = next((part for part in reversed(parts) if part in COLUMN_PARALLEL + ROW_PARALLEL), None)
+    if projection is None:
+        return None
+    if projection in COLUMN_PARALLEL:
+        return None if 'lora_A' in parts else 0
+    return None if 'lora_B' in parts else 1
+
+
+def shard_tensor(name, tensor, rank, world_size):
+    dim = shard_dim(name)
+    if dim is None or world_size == 1:
+        return tensor
+    assert tensor.shape[dim] % world_size == 0, f'{name}: size {tensor.shape[dim]} is not divisible by {world_size} ranks'
+    return tensor.chunk(world_size, dim=dim)[rank]
+
+
+def shard_state_dict(state_dict, rank, world_size):
+    """the slices of this rank, for LLaMA checkpoints, snapshots and LAMM delta checkpoints alike"""
+    return {name: shard_tensor(name, tensor, rank, world_size) for name, tensor in state_dict.items()}
+
+
+def _all_reduce_output(group, module, inputs, output):
+    if output.dtype == torch.bfloat16 and dist.get_backend(group) == 'gloo':
+        # gloo has no bf16 reduction
+        reduced = output.float()
+        dist.all_reduce(reduced, group=group)
+        return reduced.to(output.dtype)
+    dist.all_reduce(output, group=group)
+    return output
+
+
+def _all_gather_output(group, world_size, module, inputs, output):
+    gathered = output.contiguous()
+    if output.dtype == torch.bfloat16 and dist.get_backend(group) == 'gloo':
+        # gloo has no bf16 collectives, the fp32 round trip is exact
+        gathered = gathered.float()
+    parts = [torch.empty_like(gathered) for _ in range(world_size)]
+    dist.all_gather(parts, gathered, group=group)
+    return torch.cat(parts, dim=-1).to(output.dtype)
+
+
+@torch.no_grad()
+def shard_llama(model, rank, world_size, group=None):
+    """split a LlamaForCausalLM in place to the shard of `rank`
+
+    Works on materialized models and on models still on the meta device (see llama_from_snapshot), with plain or
+    peft LoRA projections. Shard before `fuse_projections` / quantization, both work on the local shards afterwards.
+    """
+    from .quantization import QuantLinear
+
+    config = model.config
+    assert config.num_attention_heads % world_size == 0, f'{config.num_attention_heads} heads can not be split over {world_size} ranks'
+    assert config.intermediate_size % world_size == 0, f'intermediate size {config.intermediate_size} can not be split over {world_size} ranks'
+    assert config.vocab_size % world_size == 0, f'vocabulary of {config.vocab_size} can not be split over {world_size} ranks'
+    for module in model.modules():
+        if isinstance(module, QuantLinear) or getattr(module, 'qkv_proj', None) is not None:
+            raise ValueError('Shard the LLaMA model before fusing or quantizing its projections')
+
+    for layer in model.model.layers:
+        layer.self_attn.num_heads //= world_size
+        layer.mlp.intermediate_size //= world_size
+        layer.self_attn.o_proj.register_forward_hook(partial(_all_reduce_output, group))
+        layer.mlp.down_proj.register_forward_hook(partial(_all_reduce_output, group))
+    model.lm_head.register_forward_hook(partial(_all_gather_output, group, world_size))
+
+    for name, param in model.named_parameters():
+        if shard_dim(name) is not None:
+            param.data = shard_tensor(name, param.data, rank, world_size).clone()      # clone frees the full tensor
+    for module in model.modules():
+        if isinstance(module, nn.Linear):
+            module.out_features, module.in_features = module.weight.shape
+    model.tensor_parallel = (rank, world_size)
+    return model
+
+
+@torch.no_grad()
+def self_test(rank, world_size, seed=0, dtype=torch.float32):
+    """compare the logits of a small random LLaMA with its tensor-parallel shards, prefill and one cached decode step"""
+    from transformers.models.llama.configuration_llama import LlamaConfig
+    from ..modeling_llama import LlamaForCausalLM
+
+    config = LlamaConfig(vocab_size=512, hidden_size=128, intermediate_size=352, num_hidden_layers=2, num_attention_heads=8)
+    torch.manual_seed(seed)                                     # same weights on every rank
+    full = LlamaForCausalLM(config).to(dtype).eval()
+    sharded = shard_llama(copy.deepcopy(full), rank, world_size)
+    input_ids = torch.randint(0, config.vocab_size, (2, 16), generator=torch.Generator().manual_seed(seed))
+
+    expected = full(input_ids[:, :-1], use_cache=True)
+    actual = sharded(input_ids[:, :-1], use_cache=True)
+    prefill_error = (expected.logits.float() - actual.logits.float()).abs().max().item()
+    expected = full(input_ids[:, -1:], past_key_values=expected.past_key_values).logits
+    actual = sharded(input_ids[:, -1:], past_key_values=actual.past_key_values).logits
+    decode_error = (expected.float() - actual.float()).abs().max().item()
+    print(f'[rank {rank}/{world_size}] max logit error: prefill {prefill_error:.2e}, decode {decode_error:.2e}')
+    return max(prefill_error, decode_error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tensor-parallel LAMM inference')
+    parser.add_argument('--self-test', action='store_true', help='check a small random model against its shards')
+    parser.add_argument('--snapshot', help='inference snapshot written by model.utils.snapshot')
+    parser.add_argument('--image', help='image of the prompt, required with --snapshot')
+    parser.add_argument('--prompt', default='Describe the image.')
+    parser.add_argument('--dtype', default=None)
+    parser.add_argument('--max-tgt-len', type=int, default=128)
+    parser.add_argument('--top-p', type=float, default=0.9)
+    parser.add_argument('--temperature', type=float, default=1.0)
+    args = parser.parse_args()
+
+    rank, world_size = init_distributed()
+    if args.self_test:
+        error = self_test(rank, world_size)
+        assert error < 1e-4, f'tensor-parallel logits differ by {error}'
+        return
+
+    from ..openlamm import LAMMPEFTModel
+
+    device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+    model = LAMMPEFTModel(snapshot_path=args.snapshot, tensor_parallel=True, device=device)
+    model = model.to_inference(device=device, dtype=args.dtype)
+    response = model.generate({
+        'prompt': [args.prompt],
+        'image_paths': [args.image],
+        'top_p': args.top_p,
+        'temperature': args.temperature,
+        'max_tgt_len': args.max_tgt_len,
+        'modality_embeds': [],
+    })
+    if rank == 0:
+        print(response[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Parameter-free compression of the CLIP patch tokens before llama_proj.
+
+The 256 patch tokens of an image dominate the LLaMA prefill of a LAMM prompt. They can be
+reduced to fewer tokens without new weights, either by average pooling on the patch grid
+('pool') or by merging similar tokens with a few k-means steps initialized from that
+pooling ('cluster'); num_vision_token then counts the compressed tokens:
+
+    LAMMPEFTModel(..., vision_token_compression='pool', num_compressed_token=64)
+
+Compression runs on the encoder output, so precomputed feature stores hold uncompressed tokens.
+"""
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+COMPRESSION_MODES = ['none', 'pool', 'cluster']
+
+
+def spatial_pool(features, num_tokens):
+    """average pool patch tokens to num_tokens
+
+    :param tensor features: bsz x N x C; N tokens on a square grid (row-major), otherwise pooled as a sequence
+    :param int num_tokens: number of output tokens, a square number for 2D pooling (e.g. 64 for 2x2 pooling of 16x16)
+    :return tensor: bsz x num_tokens x C
+    """
+    bsz, num_input, channels = features.shape
+    grid, out_grid = math.isqrt(num_input), math.isqrt(num_tokens)
+    if grid * grid == num_input and out_grid * out_grid == num_tokens:
+        x = features.transpose(1, 2).reshape(bsz, channels, grid, grid)         # bsz x C x grid x grid
+        x = F.adaptive_avg_pool2d(x, out_grid)
+        return x.flatten(2).transpose(1, 2)
+    return F.adaptive_avg_pool1d(features.transpose(1, 2), num_tokens).transpose(1, 2)
+
+
+def cluster_merge(features, num_tokens, iters=3):
+    """parameter-free k-means over the patch tokens, initialized from spatial pooling so that the clusters keep a spatial order
+
+    :param tensor features: bsz x N x C
+    :param int num_tokens: number of clusters
+    :return tensor: bsz x num_tokens x C, mean feature of every cluster
+    """
+    x = features.float()
+    centers = spatial_pool(x, num_tokens)                                       # bsz x K x C
+    x_norm = F.normalize(x, dim=-1)
+    for _ in range(iters):
+        assign = (x_norm @ F.normalize(centers, dim=-1).transpose(1, 2)).argmax(dim=-1)   # bsz x N
+        one_hot = F.one_hot(assign, num_tokens).to(x.dtype)                     # bsz x N x K
+        counts = one_hot.sum(dim=1).unsqueeze(-1)                               # bsz x K x 1
+        new_centers = one_hot.transpose(1, 2) @ x / counts.clamp(min=1)
+        centers = torch.where(counts > 0, new_centers, centers)                 # keep empty clusters at their init
+    return centers.to(features.dtype)
+
+
+class VisionTokenCompressor(nn.Module):
+    """Parameter-free compression of the vision tokens before llama_proj to shorten the LLM prefill
+
+    :param str mode: 'none', 'pool' (adaptive average pooling on the patch grid) or 'cluster' (k-means merging)
+    :param int num_tokens: number of tokens after compression
+    """
+
+    def __init__(self, mode='none', num_tokens=None):
+        super().__init__()
+        assert mode in COMPRESSION_MODES, f'Vision token compression [{mode}] not implemented'
+        assert mode == 'none' or num_tokens, 'num_tokens is required for vision token compression'
+        self.mode = mode
+        self.num_tokens = num_tokens
+
+    def num_output_tokens(self, num_input_tokens):
+        if self.mode == 'none':
+            return num_input_tokens
+        return min(self.num_tokens, num_input_tokens)
+
+    def forward(self, features):
+        num_tokens = self.num_output_tokens(features.shape[1])
+        if self.mode == 'none' or num_tokens == features.shape[1]:
+            return features
+        if self.mode == 'pool':
+            return spatial_pool(features, num_tokens)
+        return cluster_merge(features, num_tokens)
+
+    def extra_repr(self):
+        return f'mode={self.mode}, num_tokens={self.num_tokens}'
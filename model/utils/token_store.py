@@ -0,0 +1,175 @@
+"""Offline store of tokenized training conversations.
+
+Every conversation is tokenized once with the training tokenization (build_one_instance:
+vision tag stripping, turn templates, -100 targets on the human turns) and written into
+memory-mapped arrays, so that training steps read token ids instead of running the
+LlamaTokenizer:
+
+    input_ids.npy   int32, all tokens of all samples back to back
+    target_mask.npy uint8, 1 where the token is a target, 0 where the target is -100
+    offsets.npy     int64, N + 1 offsets of the samples into the token arrays
+    samples.json    per sample: vision path, task type
+    meta.json       tokenizer, vision type, counts
+
+    python -m model.utils.token_store --data-file LAMM_instruct_186k.json --vision-root images/ \
+        --tokenizer vicuna_7b/ --output lamm_tokens/
+
+Samples keep the order of the data file, so the store index of a sample is its index there.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+from torch.nn.utils import rnn
+
+
+def tokenizer_fingerprint(tokenizer):
+    """hash of the tokenizer vocabulary, stores are only valid for the tokenizer that wrote them"""
+    vocab = tokenizer.get_vocab()
+    return hashlib.sha256(json.dumps(sorted(vocab.items())).encode('utf-8')).hexdigest()[:16]
+
+
+class TokenStore:
+    """read-only access to a store written by `build_token_store`
+
+    :param str root: store directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(root, 'samples.json')) as f:
+            self.samples = json.load(f)
+        self.input_ids = np.load(os.path.join(root, 'input_ids.npy'), mmap_mode='r')
+        self.target_mask = np.load(os.path.join(root, 'target_mask.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(root, 'offsets.npy'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self, max_tgt_len=None):
+        """tokens of every conversation, cut at max_tgt_len like process_batch_instance"""
+        lengths = np.diff(self.offsets)
+        return np.minimum(lengths, max_tgt_len) if max_tgt_len else lengths
+
+    def get(self, index):
+        """
+        :return tensor, tensor: input ids and target ids (-100 outside the answers) of one conversation
+        """
+        begin, end = self.offsets[index], self.offsets[index + 1]
+        input_ids = torch.from_numpy(self.input_ids[begin:end].astype(np.int64))
+        target_ids = input_ids.masked_fill(torch.from_numpy(self.target_mask[begin:end] == 0), -100)
+        return input_ids, target_ids
+
+    def batch(self, indices, max_tgt_len, pad_token_id=None):
+        """the output of process_batch_instance for the samples `indices`, without tokenizing
+
+        :return tensor, tensor, tensor: input ids, target ids and attention mask, bsz x s2
+        """
+        pad_token_id = self.meta['pad_token_id'] if pad_token_id is None else pad_token_id
+        pairs = [self.get(index) for index in indices]
+        input_ids = rnn.pad_sequence([ids for ids, _ in pairs], batch_first=True, padding_value=pad_token_id)
+        target_ids = rnn.pad_sequence([targets for _, targets in pairs], batch_first=True, padding_value=-100)
+        input_ids = input_ids[:, :max_tgt_len]
+        target_ids = target_ids[:, :max_tgt_len]
+        attention_mask = input_ids.ne(pad_token_id)
+        return input_ids, target_ids, attention_mask.long()
+
+    def check_compatible(self, tokenizer, vision_type, num_samples=None):
+        meta = self.meta
+        if meta['tokenizer_fingerprint'] != tokenizer_fingerprint(tokenizer):
+            raise ValueError(f'Token store {self.root} was written with another tokenizer ({meta["tokenizer"]})')
+        if meta['vision_type'] != vision_type:
+            raise ValueError(f'Token store {self.root} holds {meta["vision_type"]} conversations, expected {vision_type}')
+        if num_samples is not None and len(self) != num_samples:
+            raise ValueError(f'Token store {self.root} holds {len(self)} samples, the data file {num_samples}')
+
+
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize(conversation_and_type):
+    from ..openlamm import build_one_instance
+
+    conversation, vision_type = conversation_and_type
+    _, input_ids, target_ids = build_one_instance(_worker_tokenizer, copy.deepcopy(conversation), vision_type)
+    return np.asarray(input_ids, dtype=np.int32), np.asarray(target_ids, dtype=np.int64) != -100
+
+
+def build_token_store(samples, tokenizer_path, root, vision_root='', vision_type='image', num_workers=8):
+    """tokenize every conversation once and write the store
+
+    :param list samples: instruction samples with "image" and "conversations"
+    :return TokenStore: the written store
+    """
+    from .tokenization import TokenizationService
+
+    os.makedirs(root, exist_ok=True)
+    # the fast backend is built and checked once, the workers get a pickled copy
+    tokenizer = TokenizationService.from_pretrained(tokenizer_path)
+    jobs = [(sample['conversations'], vision_type) for sample in samples]
+    with Pool(num_workers, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+        tokenized = []
+        for i, result in enumerate(pool.imap(_tokenize, jobs, chunksize=64)):
+            tokenized.append(result)
+            if (i + 1) % 1000 == 0 or i + 1 == len(jobs):
+                print(f'[!] tokenized {i + 1}/{len(jobs)} conversations', end='\r')
+    print()
+
+    offsets = np.zeros(len(tokenized) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(input_ids) for input_ids, _ in tokenized])
+    input_ids = open_memmap(os.path.join(root, 'input_ids.npy'), mode='w+', dtype=np.int32, shape=(int(offsets[-1]),))
+    target_mask = open_memmap(os.path.join(root, 'target_mask.npy'), mode='w+', dtype=np.uint8, shape=(int(offsets[-1]),))
+    for i, (ids, mask) in enumerate(tokenized):
+        input_ids[offsets[i]:offsets[i + 1]] = ids
+        target_mask[offsets[i]:offsets[i + 1]] = mask
+    input_ids.flush()
+    target_mask.flush()
+    np.save(os.path.join(root, 'offsets.npy'), offsets)
+
+    with open(os.path.join(root, 'samples.json'), 'w') as f:
+        json.dump([{'vision_path': os.path.join(vision_root, sample['image']) if 'image' in sample else None,
+                    'task_type': sample['task_type'] if 'task_type' in sample else 'normal'} for sample in samples], f)
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump({
+            'tokenizer': tokenizer_path,
+            'tokenizer_fingerprint': tokenizer_fingerprint(tokenizer.slow),
+            'vision_type': vision_type,
+            'pad_token_id': tokenizer.eos_token_id,             # LAMMPEFTModel pads with eos
+            'num_samples': len(samples),
+            'num_tokens': int(offsets[-1]),
+        }, f, indent=2)
+    return TokenStore(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tokenize a LAMM instruction dataset once for training')
+    parser.add_argument('--data-file', required=True)
+    parser.add_argument('--vision-root', default='')
+    parser.add_argument('--tokenizer', required=True, help='LLaMA checkpoint directory')
+    parser.add_argument('--vision-type', default='image', choices=['image', 'pcl'])
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    with open(args.data_file) as f:
+        samples = json.load(f)
+    store = build_token_store(samples, args.tokenizer, args.output, args.vision_root, args.vision_type, args.num_workers)
+    lengths = store.lengths()
+    print(f'[!] saved {len(store)} conversations ({int(lengths.sum())} tokens, mean {lengths.mean():.1f}) to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Batched LLaMA tokenization with a fast backend, held to the ids of the slow tokenizer.
+
+LAMMPEFTModel, the training tokenization (build_one_instance / process_batch_instance)
+and the data pipeline encode through one TokenizationService: whole batches go through
+the Rust `LlamaTokenizerFast` in one call, and fixed strings (prompt headers, system
+prompts) are cached. The fast backend is only used when it reproduces the slow
+`LlamaTokenizer` id for id on the LAMM templates, checked when the service is built;
+otherwise the service keeps the slow tokenizer. Check a tokenizer (and optionally every
+conversation of a data file) by hand with:
+
+    python -m model.utils.tokenization --tokenizer vicuna_7b/ --data-file LAMM_instruct_186k.json
+"""
+import argparse
+import copy
+import json
+import sys
+import time
+from collections import OrderedDict
+
+# prompts around which the templates are checked: spacing, newlines, numbers, boxes, tags, non-ascii
+SAMPLE_PROMPTS = [
+    'What is in the image?',
+    'Describe the image in detail.',
+    '  Leading and trailing spaces  ',
+    'Double  spaces,\ttabs and\nnew\n\nlines',
+    'How many people are there? Answer with a number: 3, 12 or 105.',
+    'The dog is at [0.12, 0.34, 0.56, 0.78] and the cat at (0.5, 0.5, 0.9, 1.0).',
+    '<image>\nWhat color is the car?',
+    'Is it a "red" car... or not?!',
+    '这张图片里有什么？',
+    'Café, naïve façade – émoji 🙂',
+    '',
+]
+
+
+def lamm_template_texts(prompts=None):
+    """every string the LAMM templates hand to the tokenizer: prompt headers and the turns of build_one_instance /
+    prepare_generation_embedding around `prompts`"""
+    from ..conversations import conversation_dict
+    from ..openlamm import VISION_TAGS, make_prompt_start
+
+    texts = []
+    for vision_type in ['image', 'pcl']:
+        texts.append(make_prompt_start(vision_type=vision_type))
+        texts.append(make_prompt_start(system_header=True, vision_type=vision_type))
+        texts += make_prompt_start(system_header=True, vision_type=vision_type, task_type=list(conversation_dict))
+        eov = VISION_TAGS['eov'][vision_type]
+        for prompt in prompts or SAMPLE_PROMPTS:
+            texts += [f'{eov} ' + prompt + '\n### Assistant:', 'Human: ' + prompt + '\n### Assistant:', prompt + '\n###']
+    return texts
+
+
+class TokenizationService:
+    """
+    :param slow: LlamaTokenizer, the reference ids
+    :param fast: LlamaTokenizerFast giving the same ids, or None to encode with the slow tokenizer
+    :param int cache_size: fixed strings kept by `encode_cached`
+    """
+
+    def __init__(self, slow, fast=None, cache_size=256):
+        self.slow = slow
+        self.fast = fast
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @classmethod
+    def from_pretrained(cls, path, slow=None, backend='fast', check=True):
+        """
+        :param slow: an already loaded LlamaTokenizer of `path`
+        :param str backend: 'fast' to use LlamaTokenizerFast when it matches the slow tokenizer, 'slow' to never use it
+        :param bool check: compare the fast ids with the slow ones on the LAMM templates first
+        """
+        from transformers import LlamaTokenizer
+
+        assert backend in ['fast', 'slow'], f'Tokenizer backend [{backend}] not supported'
+        if slow is None:
+            slow = LlamaTokenizer.from_pretrained(path, use_fast=False)
+        fast = None
+        if backend == 'fast':
+            try:
+                from transformers import LlamaTokenizerFast
+
+                fast = LlamaTokenizerFast.from_pretrained(path)     # converted from tokenizer.model without tokenizer.json
+            except (ImportError, ValueError, OSError) as e:
+                print(f'[!] fast tokenizer not available, encoding with the slow one: {e}')
+        service = cls(slow, fast)
+        if fast is not None and check:
+            mismatches = service.check_parity(lamm_template_texts())
+            if mismatches:
+                print(f'[!] fast tokenizer differs from the slow one on {len(mismatches)} LAMM templates '
+                      f'(e.g. {mismatches[0][0]!r}), encoding with the slow one')
+                service.fast = None
+        return service
+
+    @property
+    def backend(self):
+        return 'fast' if self.fast is not None else 'slow'
+
+    @property
+    def pad_token_id(self):
+        return self.slow.pad_token_id
+
+    @property
+    def bos_token_id(self):
+        return self.slow.bos_token_id
+
+    @property
+    def eos_token_id(self):
+        return self.slow.eos_token_id
+
+    def encode_slow(self, texts):
+        return [self.slow(text, add_special_tokens=False).input_ids for text in texts]
+
+    def encode_batch(self, texts):
+        """
+        :param list texts: strings encoded without bos / eos
+        :return list: token ids of every text
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        if self.fast is None:
+            return self.encode_slow(texts)
+        return self.fast(texts, add_special_tokens=False).input_ids
+
+    def encode(self, text):
+        return self.encode_batch([text])[0]
+
+    def encode_cached(self, text):
+        """ids of a repeated fixed string, least recently used strings are dropped"""
+        if text in self.cache:
+            self.cache.move_to_end(text)
+            return self.cache[text]
+        ids = self.encode(text)
+        self.cache[text] = ids
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return ids
+
+    def check_parity(self, texts):
+        """
+        :return list: (text, slow ids, fast ids) of every text the backends encode differently
+        """
+        if self.fast is None:
+            return []
+        texts = list(texts)
+        fast_ids = self.fast(texts, add_special_tokens=False).input_ids
+        return [(text, slow, fast) for text, slow, fast in zip(texts, self.encode_slow(texts), fast_ids) if slow != fast]
+
+
+def encode_texts(tokenizer, texts):
+    """token ids of `texts` without bos / eos, through a TokenizationService or a HuggingFace tokenizer"""
+    if isinstance(tokenizer, TokenizationService):
+        return tokenizer.encode_batch(texts)
+    return [tokenizer(text, add_special_tokens=False).input_ids for text in texts]
+
+
+def conversation_texts(samples, vision_type='image'):
+    """the turn strings build_one_instance encodes for every conversation of an instruction dataset"""
+    from ..openlamm import conversation_turns
+
+    texts = []
+    for sample in samples:
+        texts += conversation_turns(copy.deepcopy(sample['conversations']), vision_type)[0]
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the fast LLaMA tokenizer against the slow one on LAMM prompts')
+    parser.add_argument('--tokenizer', required=True, help='LLaMA checkpoint directory')
+    parser.add_argument('--data-file', default=None, help='also check every conversation turn of an instruction json')
+    parser.add_argument('--vision-type', default='image', choices=['image', 'pcl'])
+    parser.add_argument('--max-samples', type=int, default=None)
+    args = parser.parse_args()
+
+    service = TokenizationService.from_pretrained(args.tokenizer, check=False)
+    if service.fast is None:
+        print('[!] no fast tokenizer to check')
+        sys.exit(1)
+    texts = lamm_template_texts()
+    if args.data_file:
+        with open(args.data_file) as f:
+            samples = json.load(f)
+        texts += conversation_texts(samples[:args.max_samples] if args.max_samples else samples, args.vision_type)
+
+    start = time.perf_counter()
+    service.encode_slow(texts)
+    slow_time = time.perf_counter() - start
+    start = time.perf_counter()
+    service.encode_batch(texts)
+    fast_time = time.perf_counter() - start
+    print(f'[!] {len(texts)} texts: slow {slow_time:.2f}s, fast batched {fast_time:.2f}s ({slow_time / max(fast_time, 1e-9):.1f}x)')
+
+    mismatches = service.check_parity(texts)
+    for text, slow_ids, fast_ids in mismatches[:20]:
+        print(f'[!] mismatch on {text!r}:\n    slow {slow_ids}\n    fast {fast_ids}')
+    if mismatches:
+        print(f'[!] {len(mismatches)}/{len(texts)} texts differ, the service would encode with the slow tokenizer')
+        sys.exit(1)
+    print(f'[!] all {len(texts)} texts encode to the same ids')
+
+
+if __name__ == '__main__':
+    main()
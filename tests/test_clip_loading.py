@@ -0,0 +1,61 @@
+"""Visual-only loading of CLIP checkpoints: JIT archives are read without torch.jit.load, state dicts are memory-mapped."""
+import pytest
+
+torch = pytest.importorskip('torch')
+clip = pytest.importorskip('model.CLIP.clip')
+
+
+class TinyCLIP(torch.nn.Module):
+    """a visual tower and a stand-in text tower, traced like the released JIT checkpoints"""
+
+    def __init__(self, visual):
+        super().__init__()
+        self.visual = visual
+        self.text_projection = torch.nn.Parameter(torch.randn(32, 16))
+        self.token_embedding = torch.nn.Embedding(64, 32)
+
+    def forward(self, images):
+        return self.visual(images)
+
+
+@pytest.fixture(scope='module')
+def visual():
+    from model.utils.benchmark import build_visual
+
+    return build_visual('tiny')
+
+
+@pytest.fixture(scope='module')
+def jit_path(visual, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('clip') / 'tiny_clip_jit.pt')
+    with torch.no_grad():
+        traced = torch.jit.trace(TinyCLIP(visual).eval(), torch.randn(1, 3, 224, 224), check_trace=False)
+    traced.save(path)
+    return path
+
+
+def test_jit_archive_visual_tensors(visual, jit_path):
+    assert clip._is_jit_archive(jit_path)
+    state_dict = clip._load_visual_state_dict(jit_path)
+    expected = {'visual.' + name: tensor for name, tensor in visual.state_dict().items()}
+    assert sorted(state_dict) == sorted(expected)
+    for name, tensor in expected.items():
+        assert state_dict[name].dtype == tensor.dtype
+        assert state_dict[name].equal(tensor), name
+    # the same tensors as the full TorchScript load
+    scripted = torch.jit.load(jit_path, map_location='cpu').state_dict()
+    for name, tensor in state_dict.items():
+        assert scripted[name].equal(tensor), name
+
+
+def test_load_visual_from_jit_and_extracted(visual, jit_path, tmp_path):
+    images = torch.randn(2, 3, 224, 224)
+    with torch.no_grad():
+        expected = visual(images)
+        loaded, _ = clip.load_visual(jit_path, device='cpu', dtype=torch.float32)
+        assert loaded(images).equal(expected)
+
+        extracted = clip.extract_visual(jit_path, str(tmp_path / 'visual.pt'), dtype=torch.float32)
+        assert not clip._is_jit_archive(extracted)
+        loaded, _ = clip.load_visual(extracted, device='cpu', dtype=torch.float32)
+        assert loaded(images).equal(expected)
@@ -0,0 +1,79 @@
+"""TrainDataset / TrainLoader on a tiny instruction json: resuming mid-epoch and equal batch counts across ranks."""
+import json
+import os
+import random
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+pytest.importorskip('sentencepiece')
+data_pipeline = pytest.importorskip('model.utils.data_pipeline')
+from PIL import Image
+
+NUM_SAMPLES = 22
+SHARD_SIZE = 4          # 6 shards, the last one holds 2 samples
+
+
+@pytest.fixture(scope='module')
+def tokenizer_dir(tmp_path_factory):
+    from model.utils.benchmark import train_tokenizer
+
+    path = str(tmp_path_factory.mktemp('tokenizer'))
+    train_tokenizer(path)
+    return path
+
+
+@pytest.fixture(scope='module')
+def data_file(tmp_path_factory):
+    from model.utils.benchmark import synthetic_conversation
+
+    root = tmp_path_factory.mktemp('data')
+    rng = random.Random(0)
+    samples = []
+    for i in range(NUM_SAMPLES):
+        Image.new('RGB', (32, 24), (i * 10, 0, 0)).save(str(root / f'image_{i}.png'))
+        samples.append({'image': f'image_{i}.png', 'conversations': synthetic_conversation(rng)})
+    path = root / 'data.json'
+    path.write_text(json.dumps(samples))
+    return str(path)
+
+
+def dataset(data_file, tokenizer_dir, batch_size=2, **kwargs):
+    source = data_pipeline.JsonSource(data_file, os.path.dirname(data_file), shard_size=SHARD_SIZE)
+    return data_pipeline.TrainDataset(source, tokenizer_dir, batch_size, max_tgt_len=64, **kwargs)
+
+
+def test_resume_mid_epoch_covers_the_epoch_once(data_file, tokenizer_dir):
+    loader = data_pipeline.TrainLoader(dataset(data_file, tokenizer_dir), num_workers=2, prefetch_factor=2, pin_memory=False)
+    seen = []
+    for index, batch in enumerate(loader):
+        seen += batch['vision_paths']
+        if index == 4:
+            break
+    state = json.loads(json.dumps(loader.state_dict()))           # as saved in a checkpoint
+
+    resumed = data_pipeline.TrainLoader(dataset(data_file, tokenizer_dir), num_workers=2, prefetch_factor=2, pin_memory=False)
+    resumed.load_state_dict(state)
+    for batch in resumed:
+        seen += batch['vision_paths']
+    assert len(seen) == NUM_SAMPLES
+    assert sorted(seen) == sorted(set(seen))
+    assert resumed.state_dict()['epoch'] == 1
+
+
+@pytest.mark.parametrize('drop_last', [True, False])
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_ranks_yield_equal_batch_counts(data_file, tokenizer_dir, drop_last, num_workers):
+    world_size = 4          # 6 shards: two ranks read 2 shards, two ranks 1 shard
+    counts = []
+    for rank in range(world_size):
+        rank_dataset = dataset(data_file, tokenizer_dir, batch_size=3, rank=rank, world_size=world_size, drop_last=drop_last)
+        planned = sum(rank_dataset.worker_batches(num_workers))
+        loader = data_pipeline.TrainLoader(rank_dataset, num_workers=num_workers, prefetch_factor=2, pin_memory=False)
+        batches = list(loader)
+        assert len(batches) == planned
+        assert all(len(batch['vision_paths']) == 3 for batch in batches)
+        counts.append(len(batches))
+    assert len(set(counts)) == 1
+    assert drop_last or counts[0] > 0
@@ -0,0 +1,38 @@
+"""Feature store write / read / compatibility checks with a stand-in encoder and image pipeline."""
+import pytest
+
+torch = pytest.importorskip('torch')
+feature_store = pytest.importorskip('model.utils.feature_store')
+
+META = {'feature_type': 'local', 'feature_layer': -2, 'tome_ratio': 0, 'token_compression': 'none'}
+
+
+class FakePipeline:
+    """yields (paths, images) like ImagePipeline.prefetch, the image of a path is filled with its index"""
+
+    def prefetch(self, batches, device='cpu'):
+        for paths in batches:
+            yield paths, torch.stack([torch.full((3, 4, 4), float(path.split('_')[1])) for path in paths])
+
+
+def encode_fn(images):
+    return images.flatten(1)[:, :8].unsqueeze(-1).expand(-1, 8, 16)         # bsz x 8 tokens x 16
+
+
+def test_build_and_read(tmp_path):
+    paths = [f'image_{i}' for i in range(5)] + ['image_2']          # duplicates are stored once
+    store = feature_store.build_feature_store(encode_fn, FakePipeline(), paths, str(tmp_path), batch_size=2, meta=META)
+    assert len(store) == 5 and store.features.shape == (5, 8, 16)
+    features = store.get(['image_3', 'image_0'])
+    assert features.dtype == torch.float16
+    assert features[0].eq(3).all() and features[1].eq(0).all()
+    store.check_compatible('local', -2, num_tokens=8)
+    with pytest.raises(ValueError):
+        store.check_compatible('local', -1, num_tokens=8)
+    with pytest.raises(ValueError):
+        store.check_compatible('local', -2, num_tokens=8, tome_ratio=0.5)
+
+
+def test_empty_store_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        feature_store.build_feature_store(encode_fn, FakePipeline(), [], str(tmp_path / 'empty'), meta=META)
@@ -0,0 +1,59 @@
+"""VisionPreprocessor against the PIL / torchvision transforms it replaced, on synthetic JPEG and PNG images."""
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torchvision')
+image_transform = pytest.importorskip('model.PROCESS.image_transform')
+from PIL import Image
+
+# normalized units, one uint8 level is about 0.015
+MAX_ABS_DIFF = 0.1
+MEAN_ABS_DIFF = 0.02
+DRAFT_MEAN_ABS_DIFF = 0.05
+
+
+def synthetic_image(width, height, seed=0):
+    """smooth gradients with a few discs, like a photo rather than noise"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = [x / width, y / height, (x + y) / (width + height)]
+    image = np.stack(channels, axis=-1) * 255
+    for _ in range(4):
+        cx, cy, r = rng.uniform(0, width), rng.uniform(0, height), rng.uniform(0.05, 0.3) * min(width, height)
+        image[(x - cx) ** 2 + (y - cy) ** 2 < r ** 2] = rng.uniform(0, 255, size=3)
+    return Image.fromarray(image.clip(0, 255).astype(np.uint8))
+
+
+@pytest.fixture(scope='module')
+def image_paths(tmp_path_factory):
+    root = tmp_path_factory.mktemp('images')
+    paths = []
+    for i, (width, height, ext) in enumerate([(640, 480, 'jpg'), (480, 900, 'jpg'), (300, 500, 'png'), (160, 120, 'png')]):
+        path = str(root / f'image_{i}.{ext}')
+        image = synthetic_image(width, height, seed=i)
+        if ext == 'jpg':
+            image.save(path, quality=95)
+        else:
+            image.save(path)
+        paths.append(path)
+    rgba = str(root / 'rgba.png')
+    synthetic_image(400, 300, seed=9).convert('RGBA').save(rgba)
+    return paths + [rgba]
+
+
+@pytest.mark.parametrize('resize_mode', ['shorter', 'squash'])
+def test_parity_with_legacy_transform(image_paths, resize_mode):
+    report = image_transform.check_parity(image_paths, n_px=224, resize_mode=resize_mode)
+    assert report['full']['max_abs_diff'] < MAX_ABS_DIFF
+    assert report['full']['mean_abs_diff'] < MEAN_ABS_DIFF
+    # reduced-resolution JPEG decode changes the pixels a little more
+    assert report['draft']['mean_abs_diff'] < DRAFT_MEAN_ABS_DIFF
+
+
+def test_batch_of_mixed_sizes_matches_single_images(image_paths):
+    preprocessor = image_transform.VisionPreprocessor(224, 'shorter')
+    images = [preprocessor.decode(path) for path in image_paths]
+    batch = preprocessor.batch(images)
+    assert batch.shape == (len(images), 3, 224, 224)
+    for image, output in zip(images, batch):
+        assert preprocessor.batch([image])[0].equal(output)
@@ -0,0 +1,39 @@
+"""Layer streaming from an inference snapshot of a tiny random-weight LAMM model, against the fully loaded snapshot."""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('sentencepiece')
+if not hasattr(torch.device, '__enter__'):
+    pytest.skip('layer streaming needs torch >= 2.0', allow_module_level=True)
+
+
+@pytest.fixture(scope='module')
+def snapshot_dir(tmp_path_factory):
+    from model.utils.benchmark import build_lamm_model
+    from model.utils.snapshot import export_snapshot
+
+    root = tmp_path_factory.mktemp('streaming')
+    model = build_lamm_model(str(root / 'checkpoints'))
+    return export_snapshot(model, str(root / 'snapshot'), dtype=torch.float32)
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+def test_streamed_forward_matches_loaded_snapshot(snapshot_dir, dtype):
+    from model.openlamm import LAMMPEFTModel
+
+    reference = LAMMPEFTModel(snapshot_path=snapshot_dir, device='cpu').to_inference('cpu', dtype)
+    streamed = LAMMPEFTModel(snapshot_path=snapshot_dir, stream_layers=2, device='cpu').to_inference('cpu', dtype)
+    assert streamed.llama_streams_layers()
+    assert streamed.llama_base_model().lm_head.weight.dtype == dtype
+
+    input_ids = torch.randint(3, reference.llama_base_model().config.vocab_size, (2, 12))
+    with torch.no_grad():
+        expected = reference.llama_model(input_ids=input_ids).logits
+        logits = streamed.llama_model(input_ids=input_ids).logits
+    assert logits.dtype == expected.dtype
+    assert torch.allclose(logits.float(), expected.float(), atol=1e-2 if dtype == torch.bfloat16 else 1e-5)
+
+    streamer = streamed.llama_base_model().model.layer_streamer
+    assert len(streamer.resident) + len(streamer.pending) <= 2
+    num_layers = len(streamed.llama_base_model().model.layers)
+    assert streamer.stats['loads'] >= num_layers
@@ -0,0 +1,95 @@
+"""Sequence packing: first-fit-decreasing bins, the packed rows against the unpacked ones, and the segment mask."""
+import random
+
+import pytest
+
+torch = pytest.importorskip('torch')
+packing = pytest.importorskip('model.utils.packing')
+
+LENGTHS = [5, 9, 3, 12, 7, 1, 4]
+
+
+def padded_batch(lengths, embed_dim=4):
+    """right-padded batch whose targets identify every token: row * 100 + position, -100 on padding"""
+    bsz, seq_len = len(lengths), max(lengths)
+    attention_mask = torch.zeros(bsz, seq_len, dtype=torch.long)
+    targets = torch.full((bsz, seq_len), -100)
+    for row, length in enumerate(lengths):
+        attention_mask[row, :length] = 1
+        targets[row, :length] = row * 100 + torch.arange(length)
+    torch.manual_seed(0)
+    inputs_embeds = torch.randn(bsz, seq_len, embed_dim) * attention_mask[..., None]
+    return inputs_embeds, targets, attention_mask
+
+
+def locate(packed_targets, row):
+    """packed row and positions of the tokens of an unpacked row"""
+    where = (packed_targets // 100 == row) & packed_targets.ge(0)
+    packed_row = where.any(dim=1).nonzero()[:, 0]
+    assert len(packed_row) == 1, 'a sequence must not be split over packed rows'
+    positions = where[packed_row[0]].nonzero()[:, 0]
+    return packed_row[0].item(), positions
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_first_fit_decreasing(seed):
+    rng = random.Random(seed)
+    lengths = [rng.randint(1, 40) for _ in range(30)]
+    bins = packing.first_fit_decreasing(lengths, 48)
+    assert sorted(index for bin_ in bins for index in bin_) == list(range(len(lengths)))
+    for bin_ in bins:
+        assert sum(lengths[index] for index in bin_) <= 48
+    assert packing.first_fit_decreasing([50, 10], 48) == [[0], [1]]           # too long for a shared row
+
+
+@pytest.mark.parametrize('max_len', [None, 16, 24])
+def test_packed_rows_round_trip(max_len):
+    inputs_embeds, targets, attention_mask = padded_batch(LENGTHS)
+    embeds, packed_targets, segment_ids, position_ids, stats = packing.pack_sequences(inputs_embeds, targets, attention_mask, max_len)
+    assert embeds.shape[:2] == packed_targets.shape == segment_ids.shape == position_ids.shape
+    assert embeds.shape[1] <= (max_len or max(LENGTHS))
+    assert stats['rows_after'] == embeds.shape[0] <= stats['rows_before']
+    assert stats['tokens'] == sum(LENGTHS) == segment_ids.ne(0).sum().item()
+
+    for row, length in enumerate(LENGTHS):
+        packed_row, positions = locate(packed_targets, row)
+        assert positions.tolist() == list(range(positions[0], positions[0] + length))          # contiguous, in order
+        assert packed_targets[packed_row, positions].equal(targets[row, :length])
+        assert embeds[packed_row, positions].equal(inputs_embeds[row, :length])
+        assert position_ids[packed_row, positions].tolist() == list(range(length))
+        segment = segment_ids[packed_row, positions]
+        assert segment.ne(0).all() and segment.eq(segment[0]).all()
+        # no other sequence shares the segment id in that row
+        assert segment_ids[packed_row].eq(segment[0]).sum().item() == length
+
+    padding = segment_ids.eq(0)
+    assert packed_targets[padding].eq(-100).all() and embeds[padding].eq(0).all()
+
+
+def test_segment_mask_blocks_other_segments():
+    from model.modeling_llama import _expand_segment_mask
+
+    segment_ids = torch.tensor([[1, 1, 2, 2, 2, 0]])
+    mask = _expand_segment_mask(segment_ids, torch.float32)
+    same = segment_ids[0, :, None] == segment_ids[0, None, :]
+    assert mask.shape == (1, 1, 6, 6)
+    assert mask[0, 0][same].eq(0).all()
+    assert mask[0, 0][~same].eq(torch.finfo(torch.float32).min).all()
+
+
+@torch.no_grad()
+def test_packed_forward_matches_unpacked_rows():
+    from model.utils.benchmark import build_llama
+
+    llama = build_llama('tiny', vocab_size=512)
+    _, targets, attention_mask = padded_batch(LENGTHS)
+    input_ids = torch.randint(3, 512, attention_mask.shape, generator=torch.Generator().manual_seed(0)) * attention_mask
+    inputs_embeds = llama.model.embed_tokens(input_ids)
+    embeds, packed_targets, segment_ids, position_ids, _ = packing.pack_sequences(inputs_embeds, targets, attention_mask, 16)
+    logits = llama(inputs_embeds=embeds, attention_mask=segment_ids.ne(0).long(), position_ids=position_ids,
+                   segment_ids=segment_ids).logits
+
+    for row, length in enumerate(LENGTHS):
+        expected = llama(inputs_embeds=inputs_embeds[row: row + 1, :length]).logits[0]
+        packed_row, positions = locate(packed_targets, row)
+        assert torch.allclose(logits[packed_row, positions], expected, atol=1e-5)
@@ -0,0 +1,128 @@
+"""Weight-only int8 / int4 quantization round trips on a tiny random-weight LLaMA, with and without merged LoRA deltas."""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('peft')
+quantization = pytest.importorskip('model.utils.quantization')
+QuantLinear = quantization.QuantLinear
+
+# cosine similarity of the logits to the fp32 model
+MIN_LOGIT_SIMILARITY = {8: 0.999, 4: 0.97}
+
+
+def build_llama():
+    from model.utils.benchmark import build_llama
+
+    return build_llama('tiny', vocab_size=512)
+
+
+def build_lora_llama(seed=0):
+    """peft LoRA wrapper with random (not zero-initialized) lora_B, so the deltas change the logits"""
+    from peft import LoraConfig, TaskType, get_peft_model
+
+    config = LoraConfig(task_type=TaskType.CAUSAL_LM, inference_mode=True, r=8, lora_alpha=16, lora_dropout=0.0,
+                        target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj'])
+    model = get_peft_model(build_llama(), config)
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if 'lora_B' in name:
+                param.normal_(std=0.02)
+    return model.eval()
+
+
+def logits(model, input_ids):
+    with torch.no_grad():
+        return model(input_ids=input_ids).logits.float()
+
+
+def similarity(a, b):
+    return torch.nn.functional.cosine_similarity(a.flatten(), b.flatten(), dim=0).item()
+
+
+@pytest.fixture
+def input_ids():
+    torch.manual_seed(1)
+    return torch.randint(3, 512, (2, 16))
+
+
+@pytest.mark.parametrize('bits', [8, 4])
+def test_quantize_weight_error_within_half_step(bits):
+    torch.manual_seed(0)
+    weight = torch.randn(96, 256)
+    layer = QuantLinear.from_weight(weight, bits=bits, group_size=64)
+    assert layer.bits == bits
+    assert layer.qweight.dtype == (torch.int8 if bits == 8 else torch.uint8)
+    # one quantization step is one scale, rounding moves every weight by at most half of it;
+    # the fp16 scales add up to 127 x 2^-11 of a step for int8
+    scales = layer.scales.float()
+    step = scales if bits == 8 else scales.repeat_interleave(64, dim=1)
+    assert ((layer.dequantize() - weight).abs() <= 0.6 * step).all()
+
+
+@pytest.mark.parametrize('bits', [8, 4])
+def test_blocked_forward_matches_dequantized_weight(bits):
+    torch.manual_seed(0)
+    # 200 output rows: three full blocks of 64 and a partial one
+    layer = QuantLinear.from_weight(torch.randn(200, 128), bits=bits, group_size=64, block_size=64)
+    x = torch.randn(3, 5, 128)
+    expected = torch.nn.functional.linear(x, layer.dequantize())
+    assert torch.allclose(layer(x), expected, atol=1e-4)
+
+
+def test_int4_falls_back_to_int8_on_uneven_groups():
+    layer = QuantLinear.from_weight(torch.randn(16, 96), bits=4, group_size=64)
+    assert layer.bits == 8
+
+
+@pytest.mark.parametrize('bits', [8, 4])
+def test_quantize_model_close_to_fp(bits, input_ids):
+    model = build_llama()
+    expected = logits(model, input_ids)
+    quantization.quantize_model(model, bits=bits)
+    assert quantization.quantizable_linears(model) == []
+    assert isinstance(model.lm_head, QuantLinear)
+    assert similarity(logits(model, input_ids), expected) > MIN_LOGIT_SIMILARITY[bits]
+
+
+@pytest.mark.parametrize('bits', [8, 4])
+def test_quantize_model_merges_peft_lora(bits, input_ids):
+    model = build_lora_llama()
+    expected = logits(model, input_ids)
+    base = model.base_model.model
+    quantization.quantize_model(base, bits=bits)
+    assert not any('lora_' in name for name, _ in base.named_modules())
+    assert similarity(logits(base, input_ids), expected) > MIN_LOGIT_SIMILARITY[bits]
+
+
+@pytest.mark.parametrize('bits', [8, 4])
+def test_merge_lora_delta_save_and_load(bits, input_ids, tmp_path):
+    lora = build_lora_llama()
+    expected = logits(lora, input_ids)
+    # keys as in a LAMM delta checkpoint
+    delta = {'llama_model.' + name: tensor for name, tensor in lora.state_dict().items() if 'lora_' in name}
+
+    model = build_llama()
+    assert quantization.merge_lora_delta(model, delta, lora_r=8, lora_alpha=16) == 4 * model.config.num_hidden_layers
+    assert torch.allclose(logits(model, input_ids), expected, atol=1e-4)
+
+    quantization.quantize_model(model, bits=bits)
+    quantized = logits(model, input_ids)
+    path = str(tmp_path / f'llama_int{bits}.pt')
+    quantization.save_quantized(model, path)
+    loaded = quantization.load_quantized(path)
+    loaded_state_dict = loaded.state_dict()
+    for name, buffer in model.state_dict().items():
+        assert loaded_state_dict[name].equal(buffer), name
+    assert logits(loaded, input_ids).equal(quantized)
+    assert similarity(quantized, expected) > MIN_LOGIT_SIMILARITY[bits]
+
+
+def test_load_quantized_dtype(input_ids, tmp_path):
+    model = quantization.quantize_model(build_llama(), bits=8)
+    path = str(tmp_path / 'llama_int8.pt')
+    quantization.save_quantized(model, path)
+    loaded = quantization.load_quantized(path, dtype=torch.bfloat16)
+    assert loaded.model.embed_tokens.weight.dtype == torch.bfloat16
+    assert loaded.lm_head.qweight.dtype == torch.int8
+    assert similarity(logits(loaded, input_ids), logits(model, input_ids)) > 0.99
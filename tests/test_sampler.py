@@ -0,0 +1,68 @@
+"""TokenBudgetBatchSampler: token budget, one pass over the data per epoch and equal batch counts across ranks."""
+import random
+
+import pytest
+
+pytest.importorskip('torch')
+sampler = pytest.importorskip('model.utils.sampler')
+TokenBudgetBatchSampler = sampler.TokenBudgetBatchSampler
+
+MAX_TOKENS = 2048
+
+
+def synthetic_lengths(num_samples=1000, seed=0):
+    """mostly short conversations with a long tail, a few longer than the budget"""
+    rng = random.Random(seed)
+    lengths = [min(int(rng.lognormvariate(5.5, 0.6)), 1500) + 260 for _ in range(num_samples)]
+    for index in range(0, num_samples, 250):
+        lengths[index] = MAX_TOKENS + 500
+    return lengths
+
+
+def padded_tokens(batch, lengths):
+    return len(batch) * max(lengths[i] for i in batch)
+
+
+@pytest.mark.parametrize('bucket_size', [64, 4096])
+@pytest.mark.parametrize('max_batch_size', [None, 8])
+def test_batches_within_budget(bucket_size, max_batch_size):
+    lengths = synthetic_lengths()
+    batches = TokenBudgetBatchSampler(lengths, MAX_TOKENS, bucket_size=bucket_size, max_batch_size=max_batch_size).batches()
+    for batch in batches:
+        assert len(batch) == 1 or padded_tokens(batch, lengths) <= MAX_TOKENS
+        assert max_batch_size is None or len(batch) <= max_batch_size
+    assert any(len(batch) == 1 and lengths[batch[0]] > MAX_TOKENS for batch in batches)
+
+
+@pytest.mark.parametrize('epoch', [0, 1, 2])
+def test_every_index_once_per_epoch(epoch):
+    lengths = synthetic_lengths()
+    batch_sampler = TokenBudgetBatchSampler(lengths, MAX_TOKENS, bucket_size=128)
+    batch_sampler.set_epoch(epoch)
+    indices = [index for batch in batch_sampler for index in batch]
+    assert sorted(indices) == list(range(len(lengths)))
+    assert len(batch_sampler) == len(list(batch_sampler))
+
+
+def test_epochs_shuffle_differently():
+    batch_sampler = TokenBudgetBatchSampler(synthetic_lengths(), MAX_TOKENS, bucket_size=128)
+    first = batch_sampler.batches()
+    batch_sampler.set_epoch(1)
+    assert batch_sampler.batches() != first
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+@pytest.mark.parametrize('world_size', [2, 3, 8])
+def test_ranks_get_equal_batch_counts(world_size, drop_last):
+    lengths = synthetic_lengths(997)
+    ranks = [TokenBudgetBatchSampler(lengths, MAX_TOKENS, bucket_size=128, rank=rank, world_size=world_size, drop_last=drop_last).batches()
+             for rank in range(world_size)]
+    assert len({len(batches) for batches in ranks}) == 1
+    total = len(TokenBudgetBatchSampler(lengths, MAX_TOKENS, bucket_size=128).all_batches())
+    indices = [index for batches in ranks for batch in batches for index in batch]
+    if drop_last:
+        assert len(ranks[0]) == total // world_size
+        assert len(indices) == len(set(indices))                # nothing repeated
+    else:
+        assert len(ranks[0]) == -(-total // world_size)
+        assert set(indices) == set(range(len(lengths)))         # nothing left out
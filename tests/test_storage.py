@@ -0,0 +1,112 @@
+"""HTTPStorage / DiskCache against a local http.server: ETag revalidation, retries, size cap and deadline."""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+storage = pytest.importorskip('model.utils.storage')        # the model package needs torch, requests, ...
+DiskCache, HTTPStorage, StorageError = storage.DiskCache, storage.HTTPStorage, storage.StorageError
+
+PAYLOAD = b'\xff\xd8 synthetic image bytes ' * 64
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests_seen = []          # (path, If-None-Match header)
+    failures_left = {}          # path -> 503 answers before a 200
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, etag=None, content_length=True):
+        self.send_response(200)
+        if etag:
+            self.send_header('ETag', etag)
+        if content_length:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        Handler.requests_seen.append((self.path, self.headers.get('If-None-Match')))
+        if self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+            else:
+                self.send_body(PAYLOAD, etag='"v1"')
+        elif self.path == '/flaky':
+            if Handler.failures_left.get(self.path, 0) > 0:
+                Handler.failures_left[self.path] -= 1
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_body(PAYLOAD)
+        elif self.path == '/large':
+            self.send_body(b'x' * 4096)
+        elif self.path == '/large-unsized':
+            self.send_body(b'x' * 4096, content_length=False)
+        elif self.path == '/slow':
+            chunk = b'x' * 64 * 1024
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(chunk) * 5))
+            self.end_headers()
+            for _ in range(5):
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                time.sleep(0.3)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+@pytest.fixture(scope='module')
+def server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def reset_handler():
+    Handler.requests_seen.clear()
+    Handler.failures_left.clear()
+
+
+def test_etag_cache_hit(server_url, tmp_path):
+    storage = HTTPStorage(cache=DiskCache(str(tmp_path)))
+    url = server_url + '/etag'
+    assert storage.get(url) == PAYLOAD
+    assert storage.cache.etag(url) == '"v1"'
+    assert storage.get(url) == PAYLOAD              # answered 304, served from the cache
+    assert Handler.requests_seen == [('/etag', None), ('/etag', '"v1"')]
+
+
+def test_retry_on_5xx(server_url):
+    Handler.failures_left['/flaky'] = 1
+    assert HTTPStorage(retries=2).get(server_url + '/flaky') == PAYLOAD
+    assert [path for path, _ in Handler.requests_seen] == ['/flaky', '/flaky']
+
+
+def test_retries_exhausted(server_url):
+    Handler.failures_left['/flaky'] = 5
+    with pytest.raises(StorageError):
+        HTTPStorage(retries=1).get(server_url + '/flaky')
+
+
+@pytest.mark.parametrize('path', ['/large', '/large-unsized'])
+def test_size_cap(server_url, path):
+    with pytest.raises(StorageError):
+        HTTPStorage(max_bytes=1024).get(server_url + path)
+
+
+def test_deadline(server_url):
+    start = time.monotonic()
+    with pytest.raises(StorageError):
+        HTTPStorage(timeout=0.5).get(server_url + '/slow')
+    assert time.monotonic() - start < 1.5
@@ -0,0 +1,46 @@
+"""Tensor-parallel LLaMA on two local gloo processes against the unsharded model."""
+import os
+import socket
+
+import pytest
+
+torch = pytest.importorskip('torch')
+tensor_parallel = pytest.importorskip('model.utils.tensor_parallel')
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+WORLD_SIZE = 2
+# max absolute logit error; bf16 partial sums are rounded before the all-reduce
+MAX_LOGIT_ERROR = {'float32': 1e-4, 'bfloat16': 5e-2}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_rank(rank, world_size, port, dtype_name):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        torch.set_num_threads(1)
+        error = tensor_parallel.self_test(rank, world_size, dtype=getattr(torch, dtype_name))
+        assert error < MAX_LOGIT_ERROR[dtype_name], f'rank {rank}: tensor-parallel logits differ by {error}'
+
+        # the lm_head hook gathers the vocabulary shards of every rank
+        logits = torch.randn(2, 3, 16, generator=torch.Generator().manual_seed(0)).to(getattr(torch, dtype_name))
+        shard = logits.chunk(world_size, dim=-1)[rank]
+        gathered = tensor_parallel._all_gather_output(None, world_size, None, None, shard)
+        assert gathered.dtype == logits.dtype
+        assert gathered.equal(logits)
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.parametrize('dtype_name', ['float32', 'bfloat16'])
+def test_sharded_logits_match_full_model(dtype_name):
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+    mp.spawn(run_rank, args=(WORLD_SIZE, free_port(), dtype_name), nprocs=WORLD_SIZE, join=True)
@@ -0,0 +1,67 @@
+"""Token store batches against the training tokenization (process_batch_instance), with the synthetic tokenizer."""
+import copy
+import random
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('sentencepiece')
+token_store = pytest.importorskip('model.utils.token_store')
+
+
+@pytest.fixture(scope='module')
+def tokenizer_dir(tmp_path_factory):
+    from model.utils.benchmark import train_tokenizer
+
+    path = str(tmp_path_factory.mktemp('tokenizer'))
+    train_tokenizer(path)
+    return path
+
+
+@pytest.fixture(scope='module')
+def samples():
+    from model.utils.benchmark import synthetic_conversation
+
+    rng = random.Random(0)
+    return [{'image': f'image_{i}.jpg', 'conversations': synthetic_conversation(rng, turns=rng.randint(1, 3)),
+             'task_type': 'normal'} for i in range(24)]
+
+
+@pytest.fixture(scope='module')
+def store(samples, tokenizer_dir, tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('tokens'))
+    return token_store.build_token_store(samples, tokenizer_dir, root, vision_root='images', num_workers=1)
+
+
+@pytest.fixture(scope='module')
+def tokenizer(tokenizer_dir):
+    from transformers import LlamaTokenizer
+
+    tokenizer = LlamaTokenizer.from_pretrained(tokenizer_dir)
+    tokenizer.pad_token = tokenizer.eos_token           # as LAMMPEFTModel and BatchBuilder
+    return tokenizer
+
+
+@pytest.mark.parametrize('max_tgt_len', [16, 1024])
+@pytest.mark.parametrize('indices', [[0, 1, 2, 3], [23, 5, 11], [7]])
+def test_batch_matches_process_batch_instance(store, samples, tokenizer, indices, max_tgt_len):
+    from model.openlamm import process_batch_instance
+
+    conversations = [copy.deepcopy(samples[index]['conversations']) for index in indices]
+    expected = process_batch_instance(tokenizer, conversations, max_tgt_len)
+    batch = store.batch(indices, max_tgt_len)
+    for reference, value in zip(expected, batch):
+        assert value.dtype == reference.dtype
+        assert value.equal(reference)
+
+
+def test_store_metadata(store, samples, tokenizer):
+    assert len(store) == len(samples)
+    store.check_compatible(tokenizer, 'image', len(samples))
+    with pytest.raises(ValueError):
+        store.check_compatible(tokenizer, 'pcl')
+    with pytest.raises(ValueError):
+        store.check_compatible(tokenizer, 'image', len(samples) + 1)
+    assert store.meta['pad_token_id'] == tokenizer.eos_token_id
+    assert store.samples[3]['vision_path'] == 'images/image_3.jpg'
+    assert store.lengths(16).max() <= 16
@@ -0,0 +1,58 @@
+"""Fast / slow LLaMA tokenizer parity on the LAMM templates, with the synthetic SentencePiece model of benchmark.py."""
+import copy
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('sentencepiece')
+pytest.importorskip('tokenizers')
+
+
+@pytest.fixture(scope='module')
+def tokenizer_dir(tmp_path_factory):
+    from model.utils.benchmark import train_tokenizer
+
+    path = str(tmp_path_factory.mktemp('tokenizer'))
+    train_tokenizer(path)
+    return path
+
+
+@pytest.fixture(scope='module')
+def service(tokenizer_dir):
+    from model.utils.tokenization import TokenizationService
+
+    service = TokenizationService.from_pretrained(tokenizer_dir, check=False)
+    assert service.fast is not None, 'no fast tokenizer could be built'
+    return service
+
+
+def test_fast_matches_slow_on_lamm_templates(service):
+    from model.utils.tokenization import lamm_template_texts
+
+    assert service.check_parity(lamm_template_texts()) == []
+
+
+def test_fast_backend_kept_after_check(tokenizer_dir):
+    from model.utils.tokenization import TokenizationService
+
+    assert TokenizationService.from_pretrained(tokenizer_dir).backend == 'fast'
+
+
+def test_batch_instances_match_slow_tokenizer(service):
+    import random
+    from model.openlamm import process_batch_instance
+    from model.utils.benchmark import synthetic_conversation
+
+    service.slow.pad_token = service.slow.eos_token
+    rng = random.Random(0)
+    conversations = [synthetic_conversation(rng, turns=rng.randint(1, 3)) for _ in range(8)]
+    expected = process_batch_instance(service.slow, copy.deepcopy(conversations), 64)
+    batched = process_batch_instance(service, copy.deepcopy(conversations), 64)
+    for reference, value in zip(expected, batched):
+        assert reference.equal(value)
+
+
+def test_encode_cached(service):
+    header = '### Human: <Img>'
+    assert service.encode_cached(header) == service.encode_slow([header])[0]
+    assert header in service.cache
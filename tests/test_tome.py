@@ -0,0 +1,77 @@
+"""Token merging (ToMe) of the CLIP ViT on a tiny random-weight encoder: token count and order, class token, ratio 0."""
+import pytest
+
+torch = pytest.importorskip('torch')
+tome = pytest.importorskip('model.CLIP.tome')
+
+NUM_PATCHES = 256           # 224 px / 14 px patches
+
+
+@pytest.fixture(scope='module')
+def visual():
+    from model.utils.benchmark import build_visual
+
+    return build_visual('tiny')
+
+
+@pytest.fixture(scope='module')
+def images():
+    torch.manual_seed(0)
+    return torch.randn(2, 3, 224, 224)
+
+
+@pytest.fixture
+def merging(visual):
+    def set_ratio(ratio):
+        visual.set_token_merging(ratio)
+        return visual
+    yield set_ratio
+    visual.set_token_merging(0)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize('ratio', [0.25, 0.5])
+@pytest.mark.parametrize('feature_layer', [-1, -2])
+def test_patch_features_keep_all_tokens(merging, images, ratio, feature_layer):
+    features = merging(ratio).forward_patch_features(images, feature_layer)
+    assert features.shape == (2, NUM_PATCHES, 256)
+    assert torch.isfinite(features).all()
+
+
+@torch.no_grad()
+def test_unmerged_tokens_stay_in_place(visual, merging, images):
+    # after the first block only the merged tokens change: attention runs before merging, the mlp is per token
+    reference = visual.forward_patch_features(images, 1)
+    features = merging(0.5).forward_patch_features(images, 1)
+    r = tome.merge_schedule(NUM_PATCHES + 1, visual.transformer.layers, 0.5)[0]
+    unchanged = torch.isclose(features, reference, atol=1e-4).all(dim=-1)           # bsz x patches
+    # r tokens are merged into at most r others, every other token is where it was
+    assert (unchanged.sum(dim=-1) >= NUM_PATCHES - 2 * r).all()
+
+
+@torch.no_grad()
+def test_class_token_never_merged(visual, images):
+    x = visual.embed(images)
+    _, size, source = visual.transformer.forward_merging(x, 0.75)
+    assert source[:, 0].eq(0).all()
+    assert source[:, 1:].ne(0).all()
+    assert size[:, 0].eq(1).all()
+
+
+def test_class_token_protected_when_most_similar():
+    metric = torch.ones(1, 9, 4)            # every token equally similar, the class token included
+    merge, new_pos = tome.bipartite_soft_matching(metric, r=4)
+    assert new_pos[0, 0] == 0
+    assert new_pos[0, 1:].ne(0).all()
+    x = torch.arange(9, dtype=torch.float32).reshape(1, 9, 1)
+    assert merge(x)[0, 0, 0] == 0
+
+
+@torch.no_grad()
+def test_ratio_zero_matches_unmerged_exactly(visual, merging, images):
+    reference_global, reference_local = visual.forward_features(images, -2, return_global=True)
+    merging(0.5).forward_patch_features(images)
+    global_features, local_features = merging(0).forward_features(images, -2, return_global=True)
+    assert global_features.equal(reference_global)
+    assert local_features.equal(reference_local)
+    assert tome.merge_schedule(NUM_PATCHES + 1, visual.transformer.layers, 0) == [0] * visual.transformer.layers
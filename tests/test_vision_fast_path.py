@@ -0,0 +1,41 @@
+"""The batch-first fused-attention path of the CLIP ViT against the default path, on a tiny random-weight encoder."""
+import pytest
+
+torch = pytest.importorskip('torch')
+clip_model = pytest.importorskip('model.CLIP.model')
+
+# fp32, the paths only differ in the order of the floating point operations
+MAX_ABS_DIFF = 5e-4
+
+
+@pytest.fixture(scope='module')
+def visual():
+    from model.utils.benchmark import build_visual
+
+    return build_visual('tiny')
+
+
+@pytest.fixture(scope='module')
+def images():
+    torch.manual_seed(0)
+    return torch.randn(2, 3, 224, 224)
+
+
+@pytest.mark.parametrize('feature_layer', [-1, -2, 2])
+def test_fast_path_matches_default(visual, images, feature_layer):
+    global_diff, local_diff = clip_model.compare_fast_path(visual, images, feature_layer)
+    assert global_diff < MAX_ABS_DIFF
+    assert local_diff < MAX_ABS_DIFF
+    assert not visual.fast_path             # the setting is restored
+
+
+@torch.no_grad()
+def test_fast_path_patch_features(visual, images):
+    reference = visual.forward_patch_features(images, -2)
+    visual.set_fast_path(True)
+    try:
+        features = visual.forward_patch_features(images, -2)
+    finally:
+        visual.set_fast_path(False)
+    assert features.shape == reference.shape == (2, 256, 256)
+    assert (features - reference).abs().max().item() < MAX_ABS_DIFF